@@ -1,8 +1,11 @@
-from typing import List
+from typing import List, Optional
 from fastapi import APIRouter, Depends
 
+import app.exceptions as exceptions
+
 from app.api.deps import v2_get_current_support_user
 from app.core.constants import Role
+from app.functions import routing_trace
 from app.functions.admin.support_services import (
     list_support_users,
     create_and_get_support_user,
@@ -11,6 +14,8 @@ from app.functions.admin.support_services import (
 from app.schemas.GenericScheme import GenericListResponseWithTypes
 from app.schemas.admin.SupportScheme import (
     CreateSupportRequestScheme,
+    RoutingTraceResponseScheme,
+    RoutingTraceSwitchRequestScheme,
     UpdateSupportRequestScheme,
     V2SupportResponseScheme
 )
@@ -44,6 +49,40 @@ async def list(
     return GenericListResponseWithTypes(items=supports)
 
 
+@router.get("/routing-trace/merchants")
+async def list_routing_trace_merchants(
+    current_user: UserSupportScheme = Depends(v2_get_current_support_user),
+) -> List[str]:
+    return await routing_trace.list_enabled()
+
+
+@router.put("/routing-trace/merchants/{merchant_id}")
+async def switch_routing_trace(
+    merchant_id: str,
+    request: RoutingTraceSwitchRequestScheme,
+    current_user: UserSupportScheme = Depends(v2_get_current_support_user),
+) -> List[str]:
+    await routing_trace.set_enabled(merchant_id, request.enabled)
+    return await routing_trace.list_enabled()
+
+
+@router.get("/routing-trace")
+async def get_routing_trace(
+    request_id: Optional[str] = None,
+    merchant_id: Optional[str] = None,
+    merchant_transaction_id: Optional[str] = None,
+    current_user: UserSupportScheme = Depends(v2_get_current_support_user),
+) -> RoutingTraceResponseScheme:
+    trace = None
+    if request_id is not None:
+        trace = await routing_trace.get(request_id)
+    elif merchant_id is not None and merchant_transaction_id is not None:
+        trace = await routing_trace.find(merchant_id, merchant_transaction_id)
+    if trace is None:
+        raise exceptions.RoutingTraceNotFoundException()
+    return RoutingTraceResponseScheme(**trace)
+
+
 @router.patch("/{id}")
 async def update(
     id: str,
@@ -7,6 +7,7 @@ from starlette.requests import Request
 
 import app.exceptions as exceptions
 import app.functions.external_transaction as e_t_f
+from app.functions import device_events
 import app.schemas.ExternalTransactionScheme as ETs
 import app.schemas.UserScheme as Us
 from app.schemas.WhitelistScheme import WhiteListPayerAddRequest
@@ -28,6 +29,7 @@ from app.api.deps import (
     v2_get_current_support_user,
     get_current_user_any_role
 )
+from app.core import config
 from app.core.session import async_session
 from app.core.constants import Limit, Role, Status, Type, get_class_fields, ReasonName, translations_reason, Direction
 from app.core.file_storage import download_file
@@ -475,28 +477,60 @@ async def download_file_route(
 async def update_transaction_file_route(
         update_from_device: ETs.RequestUpdateFromDevice,
         request: Request,
-) -> ETs.Response | None:
+) -> ETs.Response:
     data = json.loads(await request.body())
     data.pop('api_secret', None)
     print('__update_transaction_file_route', data)
     if len(update_from_device.message.title) > Limit.MAX_STRING_LENGTH_SMALL:
         raise exceptions.TitleResponseLengthLimitException()
 
-    result = await e_t_f.external_transaction_update_from_device(
+    request_db = ETs.RequestUpdateFromDeviceDB(
+        bank=update_from_device.message.title,
+        package_name=update_from_device.message.package_name,
+        message=update_from_device.message.extra_text,
+        device_hash=update_from_device.device_hash,
+        api_secret=update_from_device.api_secret,
+        timestamp=(
+            update_from_device.message.timestamp // 1000
+            if update_from_device.message.timestamp is not None
+            else None
+        ),
+    )
+    if config.settings.DEVICE_EVENTS_ASYNC:
+        event_id = await device_events.enqueue(request_db)
+        return JSONResponse(status_code=202, content={"detail": "queued", "event_id": event_id})
+
+    result = await e_t_f.external_transaction_update_from_device(request_db)
+    return result
+
+
+@router.put("/accept-from-device/batch")
+async def update_transaction_from_device_batch_route(
+        update_from_device: ETs.RequestUpdateFromDeviceBatch,
+) -> ETs.ResponseUpdateFromDeviceBatch:
+    for message in update_from_device.messages:
+        if len(message.title) > Limit.MAX_STRING_LENGTH_SMALL:
+            raise exceptions.TitleResponseLengthLimitException()
+
+    requests_db = [
         ETs.RequestUpdateFromDeviceDB(
-            bank=update_from_device.message.title,
-            package_name=update_from_device.message.package_name,
-            message=update_from_device.message.extra_text,
+            bank=message.title,
+            package_name=message.package_name,
+            message=message.extra_text,
             device_hash=update_from_device.device_hash,
             api_secret=update_from_device.api_secret,
-            timestamp=(
-                update_from_device.message.timestamp // 1000
-                if update_from_device.message.timestamp is not None
-                else None
-            ),
+            timestamp=message.timestamp // 1000 if message.timestamp is not None else None,
         )
-    )
-    return result
+        for message in update_from_device.messages
+    ]
+    if config.settings.DEVICE_EVENTS_ASYNC:
+        event_ids = await device_events.enqueue_batch(requests_db)
+        return ETs.ResponseUpdateFromDeviceBatch(results=[
+            ETs.ResponseUpdateFromDeviceBatchItem(status_code=202, detail="queued", event_id=event_id)
+            for event_id in event_ids
+        ])
+
+    return await e_t_f.external_transaction_update_from_device_batch(requests_db)
 
 
 @router.get("/categories")
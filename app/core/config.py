@@ -87,6 +87,12 @@ class Settings(BaseSettings):
     ANALIZATOR_REPORT_ID: str = os.environ["ANALIZATOR_REPORT_ID"]
     ANALIZATOR_GROUP_ID: str = os.environ["ANALIZATOR_GROUP_ID"]
 
+    # accept-from-device queues messages for app.functions.device_events instead of handling them
+    DEVICE_EVENTS_ASYNC: bool = os.environ.get("DEVICE_EVENTS_ASYNC", "false").lower() == "true"
+
+    # accepts and closes go through app.functions.balance_writer and commit in groups
+    BALANCE_GROUP_COMMIT: bool = os.environ.get("BALANCE_GROUP_COMMIT", "false").lower() == "true"
+
     POOL_SIZE: int = 1000
     MAX_OVERFLOW: int = 0
     POOL_TIMEOUT: int = 60 * 10
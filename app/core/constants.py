@@ -22,6 +22,8 @@ class Bank:
         self.schema = schema
         self.package_names = package_names or []
         self.merchants_names = merchants_names or []
+        # BankParser with the bank's own SMS rules, set by app.functions.device.register_parser
+        self.parser = None
 
 class Banks:
     # RUB
@@ -1114,6 +1116,7 @@ class EconomicModel:
 class Limit:
     MAX_OUTBOUND_PENDING_PER_TOKEN = 10
     MESSAGE_BACK_TIME_S = 60 * 60
+    MAX_DEVICE_BATCH_MESSAGES = 2 ** 9
     INTERNAL_INBOUND_BACK_TIME_S = 80 * 60
     MAX_ITEMS_PER_QUERY = 2 ** 8
     MAX_STRING_LENGTH_SMALL = 2 ** 6
@@ -1197,6 +1200,48 @@ class Params:
     AUTO_ACCEPT_APPEALS_INTERVAL_S = 3 * 60
     AUTO_CLOSE_PAYOUTS_INTERVAL_S = 60
     DISABLED_REQS_AUTO_CONFIRM_NOT_WORKING_INTERVAL_S = 30
+    ROUTING_INDEX_TTL_S = 30
+    ROUTING_INDEX_MAX_MERCHANTS = 10_000
+    OUTBOUND_ROUTING_TTL_S = 60
+    OUTBOUND_ROUTING_MAX_MERCHANTS = 10_000
+    INBOUND_RESERVATION_TTL_MS = 30 * 1000
+    INBOUND_RESERVATION_CANDIDATES = 5
+    INBOUND_CREATE_ATTEMPTS = 3
+    TRANSACTION_TIMERS_INTERVAL_S = 2
+    TRANSACTION_TIMERS_RUN_BUDGET_S = 10
+    TRANSACTION_TIMERS_BATCH_SIZE = 100
+    TRANSACTION_TIMERS_LEASE_S = 60
+    TRANSACTION_TIMERS_SWEEP_INTERVAL_S = 60
+    ERRORS_450_TTL_S = 24 * 60 * 60
+    ROUTING_TRACE_TTL_S = 24 * 60 * 60
+    ROUTING_TRACE_OPT_IN_CACHE_S = 5
+    DEVICE_MESSAGE_CLAIM_S = 60
+    TEAM_RESOLUTION_TTL_S = 60
+    TEAM_RESOLUTION_MAX_ENTRIES = 100_000
+    DEVICE_EVENTS_PARTITIONS = 32
+    DEVICE_EVENTS_CONCURRENCY = 8
+    DEVICE_EVENTS_INTERVAL_S = 1
+    DEVICE_EVENTS_RUN_BUDGET_S = 10
+    DEVICE_EVENTS_BATCH_SIZE = 50
+    DEVICE_EVENTS_LEASE_S = 60
+    DEVICE_EVENTS_MAX_ATTEMPTS = 5
+    DEVICE_EVENTS_MAX_BACKLOG = 10_000
+    DEVICE_EVENTS_DEAD_LETTER_MAX_LEN = 100_000
+    BALANCE_STRIPES = 8
+    BALANCE_COMPACTION_INTERVAL_S = 10
+    BALANCE_COMPACTION_RUN_BUDGET_S = 5
+    BALANCE_COMPACTION_BATCH_SIZE = 1000
+    BALANCE_SNAPSHOT_TTL_S = 5 * 60
+    BALANCE_SNAPSHOT_VERSION_TTL_S = 24 * 60 * 60
+    BALANCE_GROUP_COMMIT_WINDOW_MS = 5
+    BALANCE_GROUP_COMMIT_MAX_WORKS = 64
+    BALANCE_GROUP_COMMIT_LOCK_TIMEOUT_MS = 500
+    LEDGER_PARTITIONS_AHEAD = 3
+    LEDGER_PARTITIONS_INTERVAL_S = 24 * 60 * 60
+    LEDGER_ROLLUP_INTERVAL_S = 60
+    LEDGER_ROLLUP_RUN_BUDGET_S = 30
+    LEDGER_ROLLUP_BATCH_TXIDS = 100_000
+    LEDGER_RECONCILE_INTERVAL_S = 60
     
 
 
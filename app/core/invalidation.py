@@ -0,0 +1,77 @@
+"""Invalidation of in-process caches across API workers.
+
+Writers call ``publish`` after their transaction commits. The event is applied
+to the local process right away and fanned out to the other processes over
+Redis pub/sub, where ``listen`` dispatches it to the registered handlers.
+A handler called with ``key=None`` must drop everything it holds; this is
+done after every (re)subscribe, since events may have been missed meanwhile.
+"""
+import asyncio
+import json
+import logging
+from collections import defaultdict
+from typing import Callable
+
+from app.core.config import settings
+from app.core.redis import rediss
+
+logger = logging.getLogger(__name__)
+
+INVALIDATION_CHANNEL = f"{settings.REDIS_NOTIFICATIONS_CHANNEL}:invalidation"
+
+
+class Topic:
+    TEAM = "team"
+    MERCHANT = "merchant"
+    DEVICE = "device"
+
+
+_handlers: dict[str, list[Callable[[str | None], None]]] = defaultdict(list)
+
+
+def register(topic: str, handler: Callable[[str | None], None]) -> None:
+    _handlers[topic].append(handler)
+
+
+def _dispatch(topic: str, key: str | None) -> None:
+    for handler in _handlers.get(topic, []):
+        try:
+            handler(key)
+        except Exception as e:
+            logger.error(f"[Invalidation] - handler failed, topic = {topic}, key = {key}, error = {e}")
+
+
+def _dispatch_all() -> None:
+    for topic in list(_handlers):
+        _dispatch(topic, None)
+
+
+async def publish(topic: str, key: str | None = None) -> None:
+    _dispatch(topic, key)
+    try:
+        await rediss.publish(INVALIDATION_CHANNEL, json.dumps({"topic": topic, "key": key}))
+    except Exception as e:
+        logger.error(f"[Invalidation] - publish failed, topic = {topic}, key = {key}, error = {e}")
+
+
+async def listen() -> None:
+    while True:
+        pubsub = rediss.pubsub()
+        try:
+            await pubsub.subscribe(INVALIDATION_CHANNEL)
+            _dispatch_all()
+            async for message in pubsub.listen():
+                if message["type"] != "message":
+                    continue
+                data = json.loads(message["data"])
+                _dispatch(data["topic"], data.get("key"))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"[Invalidation] - listener failed, error = {e}")
+            await asyncio.sleep(1)
+        finally:
+            try:
+                await pubsub.aclose()
+            except Exception:
+                pass
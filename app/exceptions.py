@@ -454,3 +454,19 @@ class TeamNotFoundException(HTTPException):
             detail="Team not found",
             status_code=http_status.HTTP_404_NOT_FOUND,
         )
+
+
+class DeviceEventsBacklogFullException(HTTPException):
+    def __init__(self):
+        super().__init__(
+            detail="Too many device messages are waiting, retry later",
+            status_code=http_status.HTTP_503_SERVICE_UNAVAILABLE,
+        )
+
+
+class RoutingTraceNotFoundException(HTTPException):
+    def __init__(self):
+        super().__init__(
+            detail="Routing trace not found",
+            status_code=http_status.HTTP_404_NOT_FOUND,
+        )
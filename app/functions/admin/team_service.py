@@ -1,5 +1,6 @@
 from typing import Dict, List, Tuple
 
+from app.core import invalidation
 from app.core.security import generate_password, get_password_hash
 from app.core.session import ro_async_session
 from app.functions.admin.base_services import (
@@ -230,4 +231,5 @@ async def regenerate_team_user(team_id: str) -> V2TeamResponseScheme:
             }
             updated_team_user = team_user.model_copy(update=update)
             await session.commit()
+            await invalidation.publish(invalidation.Topic.TEAM, team_id)
             return updated_team_user
@@ -7,7 +7,7 @@ from openpyxl import Workbook
 from openpyxl.styles import numbers, PatternFill, Border, Side
 from sqlalchemy import text, select, and_, true
 
-from app.core.constants import Direction, Status
+from app.core.constants import Direction, Status, Params
 from app.core.session import async_session
 from app.core import redis
 from app.models import BankDetailModel, UserModel, TeamModel, MerchantModel
@@ -448,6 +448,58 @@ order by card_profiles desc;
     wk.save(output)
     return output.getvalue()
 
+def _450errors_key(merchant_id: str, bucket: str, ts: int) -> str:
+    return f"/count/450errors/{merchant_id}/{bucket}/{ts}"
+
+
+async def add_450error(
+    merchant_id: str,
+    type: str | None,
+    bank: str | None,
+    payment_system: str | None,
+    is_vip: bool
+) -> None:
+    current_time = int(datetime.utcnow().timestamp())
+    field = f"{type}/{bank}/{payment_system}/{str(is_vip).lower()}"
+    minute_key = _450errors_key(merchant_id, "m", current_time - current_time % 60)
+    hour_key = _450errors_key(merchant_id, "h", current_time - current_time % 3600)
+    pipeline = redis.rediss.pipeline(transaction=False)
+    pipeline.hincrby(minute_key, field, 1)
+    pipeline.expire(minute_key, Params.ERRORS_450_TTL_S)
+    pipeline.hincrby(hour_key, field, 1)
+    pipeline.expire(hour_key, Params.ERRORS_450_TTL_S + 3600)
+    await pipeline.execute()
+
+
+def _450errors_range_keys(merchant_id: str, date_from_ts: int, date_to_ts: int) -> list[str]:
+    """Covers [date_from_ts, date_to_ts] with whole-hour buckets and minute buckets at the edges,
+    from no further back than the buckets live."""
+    date_from_ts = max(date_from_ts, int(datetime.utcnow().timestamp()) - Params.ERRORS_450_TTL_S)
+    keys = []
+    ts = date_from_ts - date_from_ts % 60
+    while ts <= date_to_ts:
+        if ts % 3600 == 0 and ts + 3600 - 1 <= date_to_ts:
+            keys.append(_450errors_key(merchant_id, "h", ts))
+            ts += 3600
+        else:
+            keys.append(_450errors_key(merchant_id, "m", ts))
+            ts += 60
+    return keys
+
+
+async def unlink_legacy_450errors() -> int:
+    """Unlinks the per-event ZSETs and index sets of the old /count/errors/450/ layout."""
+    cursor = 0
+    unlinked = 0
+    while True:
+        cursor, keys = await redis.rediss.scan(cursor=cursor, match="/count/errors/450/*", count=500)
+        if keys:
+            unlinked += await redis.rediss.unlink(*keys)
+        if cursor == 0:
+            break
+    return unlinked
+
+
 async def get_450errors_count(
     merchant_id: str,
     type: str | None,
@@ -466,35 +518,25 @@ async def get_450errors_count(
 
     is_vip_options = [is_vip] if is_vip is not None else ["true", "false"]
 
-    keys = await redis.rediss.smembers(f"/count/errors/450/index/{merchant_id}")
-    if not keys:
-        return 0
-
-    filtered_keys = []
-    for key in keys:
-        key_str = key.decode()
-        *_, k_type, k_bank, k_payment, k_is_vip = key_str.split("/")
-        if k_type != type:
-            continue
-        if bank != 'None' and k_bank != bank:
-            continue
-        if payment_system != 'None' and k_payment != payment_system:
-            continue
-        if k_is_vip not in is_vip_options:
-            continue
-        filtered_keys.append(key)
-
-    if len(filtered_keys) == 0:
-        return 0
-
-    counts = await asyncio.gather(*[
-        redis.rediss.zcount(key, date_from_ts, date_to_ts)
-        for key in filtered_keys
-    ])
-    return sum(counts)
-
-
-
+    pipeline = redis.rediss.pipeline(transaction=False)
+    for key in _450errors_range_keys(merchant_id, date_from_ts, date_to_ts):
+        pipeline.hgetall(key)
+    buckets = await pipeline.execute()
+
+    total = 0
+    for bucket in buckets:
+        for field, count in bucket.items():
+            k_type, k_bank, k_payment, k_is_vip = field.decode().split("/")
+            if k_type != type:
+                continue
+            if bank != 'None' and k_bank != bank:
+                continue
+            if payment_system != 'None' and k_payment != payment_system:
+                continue
+            if k_is_vip not in is_vip_options:
+                continue
+            total += int(count)
+    return total
 
 
 if __name__ == '__main__':
@@ -1,4 +1,6 @@
 import asyncio
+import time
+import zlib
 from datetime import datetime
 from typing import Tuple
 
@@ -9,9 +11,10 @@ from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.dialects.postgresql import dialect
 
 from app import exceptions
-from app.core.constants import DECIMALS, Direction, Role, Status
+from app.core.constants import DECIMALS, Direction, Params, Role, Status
 from app.core.session import async_session, ro_async_session
-from app.models import CurrencyModel, UserBalanceChangeNonceModel, UserModel
+from app.functions import balance_snapshot, ledger
+from app.models import CurrencyModel, UserBalanceChangeNonceModel, UserBalanceStripeModel, UserModel
 from app.models.UserBalanceChangeModel import UserBalanceChangeModel
 from app.schemas.BalanceScheme import (
     BalanceStatsResponse,
@@ -22,6 +25,17 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+BALANCE_COLUMNS = (
+    "trust_balance",
+    "locked_balance",
+    "profit_balance",
+    "fiat_trust_balance",
+    "fiat_locked_balance",
+    "fiat_profit_balance",
+)
+# set on a session by app.functions.balance_writer, which writes the changes for its whole group
+GROUP_CHANGES_KEY = "balance_group_changes"
+
 
 async def get_balance_id_by_user_id(user_id: str, session: AsyncSession):
     balance_id_q = await session.execute(
@@ -53,21 +67,56 @@ async def add_balance_changes(session: AsyncSession, changes: list[dict[str, int
     #     .returning(UserBalanceChangeModel)
     # )
 
+    group_changes = session.info.get(GROUP_CHANGES_KEY)
+    if group_changes is not None:
+        group_changes.extend(changes)
+        return
+
     await session.execute(
         insert(UserBalanceChangeModel).values(changes)
     )
 
+    nonce_values = {}
+    stripe_values = {}
+    for change in changes:
+        deltas = [change.get(name) or 0 for name in BALANCE_COLUMNS]
+        transaction_id = change.get("transaction_id")
+        if transaction_id is None or Params.BALANCE_STRIPES <= 1:
+            key, values = change["balance_id"], nonce_values
+        else:
+            key, values = (change["balance_id"], balance_stripe(transaction_id)), stripe_values
+        values[key] = [a + b for a, b in zip(values.get(key, [0] * len(deltas)), deltas)]
+        balance_snapshot.record(session, change["balance_id"])
+
+    # stripes first, compact_balance_stripes locks them before the nonce rows too
+    if stripe_values:
+        stmt = pg_insert(UserBalanceStripeModel).values([
+            {"balance_id": balance_id, "stripe": stripe, **dict(zip(BALANCE_COLUMNS, deltas))}
+            for (balance_id, stripe), deltas in sorted(stripe_values.items())
+        ])
+        await session.execute(stmt.on_conflict_do_update(
+            index_elements=[UserBalanceStripeModel.balance_id, UserBalanceStripeModel.stripe],
+            set_={
+                name: getattr(UserBalanceStripeModel, name) + getattr(stmt.excluded, name)
+                for name in BALANCE_COLUMNS
+            },
+        ))
+        # readers join the nonce row, DO NOTHING creates it without taking its row lock
+        await session.execute(
+            pg_insert(UserBalanceChangeNonceModel)
+            .values([
+                {"balance_id": balance_id, **dict.fromkeys(BALANCE_COLUMNS, 0)}
+                for balance_id in sorted({balance_id for balance_id, _ in stripe_values})
+            ])
+            .on_conflict_do_nothing(index_elements=[UserBalanceChangeNonceModel.balance_id])
+        )
+
+    if not nonce_values:
+        return
+
     values = [
-        {
-            "balance_id": change["balance_id"],
-            "trust_balance": change.get("trust_balance", 0),
-            "locked_balance": change.get("locked_balance", 0),
-            "profit_balance": change.get("profit_balance", 0),
-            "fiat_trust_balance": change.get("fiat_trust_balance", 0),
-            "fiat_locked_balance": change.get("fiat_locked_balance", 0),
-            "fiat_profit_balance": change.get("fiat_profit_balance", 0),
-        }
-        for change in changes
+        {"balance_id": balance_id, **dict(zip(BALANCE_COLUMNS, deltas))}
+        for balance_id, deltas in sorted(nonce_values.items())
     ]
 
     stmt = pg_insert(UserBalanceChangeNonceModel).values(values)
@@ -87,6 +136,72 @@ async def add_balance_changes(session: AsyncSession, changes: list[dict[str, int
 
     await session.execute(stmt)
 
+
+def balance_stripe(transaction_id: str) -> int:
+    """stripe of a transaction's balance changes, the same in every process"""
+    return zlib.crc32(transaction_id.encode()) % Params.BALANCE_STRIPES
+
+
+def striped_balance(name: str, balance_id):
+    """sum of the stripes of balance_id for a nonce column, 0 without stripes;
+    add it to the nonce column wherever a balance is read"""
+    return func.coalesce(
+        select(func.sum(getattr(UserBalanceStripeModel, name)))
+        .where(UserBalanceStripeModel.balance_id == balance_id)
+        .scalar_subquery(),
+        0,
+    )
+
+
+def _nonce_with_stripes():
+    return [
+        (getattr(UserBalanceChangeNonceModel, name)
+         + striped_balance(name, UserBalanceChangeNonceModel.balance_id)).label(name)
+        for name in BALANCE_COLUMNS
+    ]
+
+
+async def compact_balance_stripes() -> int:
+    """Folds the stripes into the nonce rows, batch by batch. Stripes a pending
+    transaction holds are skipped and picked up next run. Returns rows folded."""
+    columns = ", ".join(BALANCE_COLUMNS)
+    sums = ", ".join(f"sum({name})" for name in BALANCE_COLUMNS)
+    updates = ", ".join(f"{name} = nm.{name} + EXCLUDED.{name}" for name in BALANCE_COLUMNS)
+    query = text(
+        f"""
+        WITH batch AS (
+            SELECT balance_id, stripe
+            FROM user_balance_stripe_model
+            ORDER BY balance_id, stripe
+            LIMIT :limit
+            FOR UPDATE SKIP LOCKED
+        ), moved AS (
+            DELETE FROM user_balance_stripe_model s
+            USING batch
+            WHERE s.balance_id = batch.balance_id AND s.stripe = batch.stripe
+            RETURNING s.*
+        ), folded AS (
+            INSERT INTO user_balance_change_nonce_model AS nm (balance_id, change_id, {columns})
+            SELECT balance_id, txid_current(), {sums}
+            FROM moved
+            GROUP BY balance_id
+            ON CONFLICT (balance_id) DO UPDATE SET {updates}, change_id = EXCLUDED.change_id
+        )
+        SELECT count(*) FROM moved
+        """
+    )
+    started = time.time()
+    total = 0
+    while time.time() - started < Params.BALANCE_COMPACTION_RUN_BUDGET_S:
+        async with async_session() as session:
+            moved = (await session.execute(query, {"limit": Params.BALANCE_COMPACTION_BATCH_SIZE})).scalar()
+            await session.commit()
+        total += moved
+        if moved < Params.BALANCE_COMPACTION_BATCH_SIZE:
+            break
+    logger.info(f"[CompactBalanceStripes] - folded = {total}")
+    return total
+
 async def get_balances_for_multiple_ids(session: AsyncSession, balance_ids: list[str]):
     # nonce_q = await session.execute(
     #     select(
@@ -157,12 +272,7 @@ async def get_balances_for_multiple_ids(session: AsyncSession, balance_ids: list
     nonce_q = await session.execute(
         select(
             UserBalanceChangeNonceModel.balance_id,
-            UserBalanceChangeNonceModel.trust_balance,
-            UserBalanceChangeNonceModel.locked_balance,
-            UserBalanceChangeNonceModel.profit_balance,
-            UserBalanceChangeNonceModel.fiat_trust_balance,
-            UserBalanceChangeNonceModel.fiat_locked_balance,
-            UserBalanceChangeNonceModel.fiat_profit_balance,
+            *_nonce_with_stripes(),
         ).filter(UserBalanceChangeNonceModel.balance_id.in_(balance_ids))
     )
 
@@ -186,6 +296,24 @@ async def get_balances_for_multiple_ids(session: AsyncSession, balance_ids: list
 
 
 
+async def get_balance_snapshot(
+        user_id: str,
+        session: AsyncSession,
+        balance_id: str | None = None,
+) -> Tuple[int, int, int, int, int, int]:
+    """get_balances from the Redis snapshot, for notifications and dashboards;
+    anything that must not overdraw a balance reads get_balances"""
+    if balance_id is None:
+        balance_id = await get_balance_id_by_user_id(user_id, session)
+    balances = await balance_snapshot.read(balance_id)
+    if balances is not None:
+        return balances
+    version = await balance_snapshot.version(balance_id)
+    balances = await get_balances(user_id, session, balance_id=balance_id)
+    await balance_snapshot.store(balance_id, version, balances)
+    return balances
+
+
 async def get_balances(
         user_id: str,
         session: AsyncSession,
@@ -208,12 +336,7 @@ async def get_balances(
     nonce_q = await session.execute(
         select(
             UserBalanceChangeNonceModel.change_id,
-            UserBalanceChangeNonceModel.trust_balance,
-            UserBalanceChangeNonceModel.locked_balance,
-            UserBalanceChangeNonceModel.profit_balance,
-            UserBalanceChangeNonceModel.fiat_trust_balance,
-            UserBalanceChangeNonceModel.fiat_locked_balance,
-            UserBalanceChangeNonceModel.fiat_profit_balance,
+            *_nonce_with_stripes(),
         ).filter(balance_id == UserBalanceChangeNonceModel.balance_id)
     )
     nonce = nonce_q.first()
@@ -332,9 +455,7 @@ async def get_balances_transaction(
         user_id: str, is_update: bool = True, currency_id: str | None = None
 ) -> Tuple[int, int, int, int, int, int]:
     async with async_session() as session:
-        balances = await get_balances(
-            user_id=user_id, session=session, is_update=is_update
-        )
+        balances = await get_balance_snapshot(user_id=user_id, session=session)
         await session.commit()
         if currency_id is not None:
             currency: CurrencyModel = await _get_currency(
@@ -366,9 +487,7 @@ async def get_estimated_fiat_balance(
         currency_id: str
 ) -> int:
     async with ro_async_session() as session:
-        balances = await get_balances(
-            user_id=user_id, session=session, is_update=False
-        )
+        balances = await get_balance_snapshot(user_id=user_id, session=session)
         await session.commit()
         currency: CurrencyModel = await _get_currency(
             currency_id=currency_id, session=session
@@ -395,13 +514,13 @@ async def get_balance_stats(
         )
         await session.commit()
         
+        sums = await ledger.direction_sums(session, balance_id, date_from, date_to)
         if role == Role.TEAM:
             query = f"""
                 SELECT
-                    SUM(fiat_profit_balance),
                     SUM(
                         CASE
-                            WHEN direction = '{Direction.OUTBOUND}' AND status = '{Status.ACCEPT}' AND c.trust_balance > 0
+                            WHEN c.trust_balance > 0
                             THEN c.locked_balance +
                                 (c.trust_balance::numeric(38, 0) -
                                 amount::numeric(38, 0) *
@@ -411,15 +530,10 @@ async def get_balance_stats(
                     )
                 FROM (
                     SELECT
-                        MAX(c.create_timestamp) AS create_timestamp,
                         SUM(trust_balance) AS trust_balance,
                         SUM(locked_balance) AS locked_balance,
-                        SUM(fiat_profit_balance) AS fiat_profit_balance,
-                        status,
-                        direction,
                         amount,
-                        exchange_rate,
-                        balance_id
+                        exchange_rate
                     FROM
                         user_balance_change_model c
                     INNER JOIN
@@ -430,28 +544,19 @@ async def get_balance_stats(
                         c.balance_id = '{balance_id}'
                         AND c.create_timestamp >= '{date_from}'
                         AND c.create_timestamp < '{date_to}'
+                        AND e.direction = '{Direction.OUTBOUND}'
+                        AND e.status = '{Status.ACCEPT}'
                     GROUP BY
-                        c.transaction_id, status, direction, amount, exchange_rate, balance_id
+                        c.transaction_id, amount, exchange_rate
                 ) c;
                 """
-            profit_balances_q = await session.execute(text(query))
-        else:
-            profit_balances_q = await session.execute(
-                text(
-                    f"""
-SELECT sum(CASE when direction = '{Direction.INBOUND}'
-          then c.trust_balance + c.locked_balance + c.profit_balance else 0 end ),
-       sum(CASE when direction = '{Direction.OUTBOUND}'
-          then c.trust_balance + c.locked_balance + c.profit_balance else 0 end)
-FROM user_balance_change_model c INNER JOIN
-     external_transaction_model e on c.transaction_id = e.id
-WHERE balance_id = '{balance_id}'
-  AND c.create_timestamp >= '{date_from}'
-  AND c.create_timestamp < '{date_to}'
-                """
-                )
+            outbound_accepted = (await session.execute(text(query))).scalar()
+            profit_balances = (
+                sums[Direction.INBOUND][3] + sums[Direction.OUTBOUND][3],
+                outbound_accepted,
             )
-        profit_balances = profit_balances_q.first()
+        else:
+            profit_balances = tuple(sum(sums[direction][:3]) for direction in (Direction.INBOUND, Direction.OUTBOUND))
 
         return BalanceStatsResponse(
             trust_balance=balances[0] or 0,
@@ -0,0 +1,135 @@
+"""Write-through snapshot of balances in Redis for non-authoritative reads.
+
+``add_balance_changes`` records the balances it changes on the session. Once
+that session commits, their snapshot hashes are deleted and a per-balance
+version is bumped; a rollback drops the record. A missing snapshot is loaded
+from Postgres and only stored if the version did not move in between. So a
+snapshot is never older than a commit that was applied, and a commit racing
+the load is never counted twice. Snapshots expire after
+``Params.BALANCE_SNAPSHOT_TTL_S`` as a backstop against a missed invalidation.
+
+Low-balance notifications and balance dashboards read the snapshot; checks that
+must not let a balance go below its credit factor keep reading Postgres.
+"""
+import asyncio
+import logging
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from app.core.constants import Params
+from app.core.redis import rediss
+
+logger = logging.getLogger(__name__)
+
+_SESSION_KEY = "balance_snapshot_changed"
+# in the order get_balances returns them
+_FIELDS = ("trust", "locked", "profit", "fiat_trust", "fiat_locked", "fiat_profit")
+
+_INVALIDATE_SCRIPT = rediss.register_script(
+    """
+    redis.call('DEL', KEYS[1])
+    local version = redis.call('INCR', KEYS[2])
+    redis.call('EXPIRE', KEYS[2], ARGV[1])
+    return version
+    """
+)
+
+_STORE_SCRIPT = rediss.register_script(
+    """
+    local version = redis.call('GET', KEYS[2]) or '0'
+    if version ~= ARGV[1] then
+        return 0
+    end
+    redis.call('DEL', KEYS[1])
+    redis.call('HSET', KEYS[1], 'version', version, unpack(ARGV, 3))
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+    return 1
+    """
+)
+
+# keeps the invalidate tasks referenced until they finish
+_pending: set[asyncio.Task] = set()
+
+
+def _snapshot_key(balance_id: str) -> str:
+    return f"/balances/snapshot/{balance_id}"
+
+
+def _version_key(balance_id: str) -> str:
+    return f"/balances/version/{balance_id}"
+
+
+def record(session: AsyncSession, balance_id: str) -> None:
+    """balance_id changes in the session, its snapshot is invalidated once the session commits"""
+    session.info.setdefault(_SESSION_KEY, set()).add(balance_id)
+
+
+async def _invalidate(balance_ids: set[str]) -> None:
+    for balance_id in balance_ids:
+        try:
+            await _INVALIDATE_SCRIPT(
+                keys=[_snapshot_key(balance_id), _version_key(balance_id)],
+                args=[Params.BALANCE_SNAPSHOT_VERSION_TTL_S],
+            )
+        except Exception as e:
+            logger.error(f"[BalanceSnapshot] - invalidate failed, balance_id = {balance_id}, error = {e}")
+
+
+@event.listens_for(Session, "after_commit")
+def _after_commit(session: Session) -> None:
+    pending = session.info.pop(_SESSION_KEY, None)
+    if not pending:
+        return
+    try:
+        task = asyncio.get_running_loop().create_task(_invalidate(pending))
+    except RuntimeError:
+        # no loop to run on, the snapshots catch up when they expire
+        return
+    _pending.add(task)
+    task.add_done_callback(_pending.discard)
+
+
+@event.listens_for(Session, "after_transaction_end")
+def _after_transaction_end(session: Session, transaction) -> None:
+    if transaction.parent is None:
+        # rolled back or closed without a commit
+        session.info.pop(_SESSION_KEY, None)
+
+
+async def read(balance_id: str) -> tuple[int, int, int, int, int, int] | None:
+    try:
+        snapshot = await rediss.hgetall(_snapshot_key(balance_id))
+    except Exception as e:
+        logger.error(f"[BalanceSnapshot] - read failed, balance_id = {balance_id}, error = {e}")
+        return None
+    snapshot = {(k.decode() if isinstance(k, bytes) else k): int(v) for k, v in snapshot.items()}
+    if not all(field in snapshot for field in _FIELDS):
+        return None
+    return tuple(snapshot[field] for field in _FIELDS)
+
+
+async def version(balance_id: str) -> str | None:
+    """to pass to store after loading the balance, None if Redis is not reachable"""
+    try:
+        value = await rediss.get(_version_key(balance_id))
+    except Exception as e:
+        logger.error(f"[BalanceSnapshot] - version failed, balance_id = {balance_id}, error = {e}")
+        return None
+    if value is None:
+        return "0"
+    return value.decode() if isinstance(value, bytes) else str(value)
+
+
+async def store(balance_id: str, loaded_version: str | None, balances) -> None:
+    """stores balances loaded from Postgres unless a commit changed them since loaded_version"""
+    if loaded_version is None:
+        return
+    args = [loaded_version, Params.BALANCE_SNAPSHOT_TTL_S]
+    for field, value in zip(_FIELDS, balances):
+        args += [field, int(value or 0)]
+    try:
+        await _STORE_SCRIPT(keys=[_snapshot_key(balance_id), _version_key(balance_id)], args=args)
+    except Exception as e:
+        logger.error(f"[BalanceSnapshot] - store failed, balance_id = {balance_id}, error = {e}")
@@ -0,0 +1,134 @@
+"""Group commit of transaction updates that change balances.
+
+With ``settings.BALANCE_GROUP_COMMIT`` on, ``run`` hands the caller's unit of
+work to a writer task of the process instead of giving it a session of its own.
+The writer collects the works that come in within
+``Params.BALANCE_GROUP_COMMIT_WINDOW_MS`` (at most
+``Params.BALANCE_GROUP_COMMIT_MAX_WORKS``) and runs them one after another in a
+single session, each in a savepoint, while ``add_balance_changes`` only
+collects their changes. The changes of the whole group are then written with
+one ledger insert and one upsert per balance row, and the group commits once:
+every caller gets its result after that commit, so what it saw acknowledged is
+durable. A work that raises is rolled back to its savepoint and its changes are
+dropped, the rest of the group still commits; if the commit fails, every caller
+of the group gets the error.
+
+The works of a group are serialized: a row lock a work takes (the
+``FOR UPDATE`` on the transaction) is held until the group commits, and while
+one work waits on a lock held elsewhere (the device accept path, a timer close
+in another process) the rest of the group waits behind it. Works only run in
+the shared session because their transaction updates have to commit
+atomically with the balance changes written for them. To bound the stall,
+every work runs with ``lock_timeout`` set to
+``Params.BALANCE_GROUP_COMMIT_LOCK_TIMEOUT_MS``: a work that cannot get its
+locks in time fails alone and the group goes on. The group write itself runs
+with the default ``lock_timeout``.
+"""
+import asyncio
+import logging
+from typing import Awaitable, Callable, TypeVar
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.config import settings
+from app.core.constants import Params
+from app.core.session import async_session
+from app.functions.balance import BALANCE_COLUMNS, GROUP_CHANGES_KEY, add_balance_changes
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+_queue: asyncio.Queue | None = None
+_writer: asyncio.Task | None = None
+
+
+async def run(work: Callable[[AsyncSession], Awaitable[T]]) -> T:
+    """Runs work(session) and commits, in a group when BALANCE_GROUP_COMMIT is on.
+    work must not commit the session itself."""
+    if not settings.BALANCE_GROUP_COMMIT:
+        async with async_session() as session:
+            result = await work(session)
+            await session.commit()
+            return result
+    future = asyncio.get_running_loop().create_future()
+    await _get_queue().put((work, future))
+    return await future
+
+
+def _get_queue() -> asyncio.Queue:
+    global _queue, _writer
+    if _writer is None or _writer.done() or _writer.get_loop() is not asyncio.get_running_loop():
+        _queue = asyncio.Queue()
+        _writer = asyncio.get_running_loop().create_task(_write_groups(_queue))
+    return _queue
+
+
+async def _write_groups(queue: asyncio.Queue) -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+        group = [await queue.get()]
+        deadline = loop.time() + Params.BALANCE_GROUP_COMMIT_WINDOW_MS / 1000
+        while len(group) < Params.BALANCE_GROUP_COMMIT_MAX_WORKS:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                group.append(await asyncio.wait_for(queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        try:
+            await _commit_group(group)
+        except Exception as e:
+            # session could not even be opened or closed
+            logger.error(f"[BalanceWriter] - group failed, works = {len(group)}, error = {e}")
+            for _, future in group:
+                if not future.done():
+                    future.set_exception(e)
+
+
+def _uniform(changes: list[dict]) -> list[dict]:
+    """same keys in every change, as one multi-row insert needs"""
+    keys = set().union(*changes)
+    return [
+        {key: change.get(key, 0 if key in BALANCE_COLUMNS else None) for key in keys}
+        for change in changes
+    ]
+
+
+async def _commit_group(group: list[tuple[Callable, asyncio.Future]]) -> None:
+    async with async_session() as session:
+        await session.execute(text(f"SET LOCAL lock_timeout = {int(Params.BALANCE_GROUP_COMMIT_LOCK_TIMEOUT_MS)}"))
+        changes = []
+        done = []
+        for work, future in group:
+            if future.done():
+                # the caller went away
+                continue
+            session.info[GROUP_CHANGES_KEY] = work_changes = []
+            try:
+                async with session.begin_nested():
+                    result = await work(session)
+            except Exception as e:
+                future.set_exception(e)
+                continue
+            finally:
+                session.info.pop(GROUP_CHANGES_KEY, None)
+            changes += work_changes
+            done.append((future, result))
+        try:
+            await session.execute(text("SET LOCAL lock_timeout = DEFAULT"))
+            if changes:
+                await add_balance_changes(session, _uniform(changes))
+            await session.commit()
+        except Exception as e:
+            logger.error(f"[BalanceWriter] - commit failed, works = {len(done)}, error = {e}")
+            for future, _ in done:
+                if not future.done():
+                    future.set_exception(e)
+            return
+    logger.info(f"[BalanceWriter] - committed, works = {len(done)}, changes = {len(changes)}")
+    for future, result in done:
+        if not future.done():
+            future.set_result(result)
@@ -3,6 +3,7 @@ from sqlalchemy import select, false, or_, true, func, literal, delete, text, up
 
 #from app.worker.celery import regenerate_details_daily_task
 from app import exceptions
+from app.core import invalidation
 from app.core.constants import Type, DECIMALS
 import logging
 from app.core.session import async_session, ro_async_session
@@ -129,6 +130,9 @@ async def create_bank_detail(
         #                                  bank_detail_model.transactions_count_limit,
         #                                  min(bank_detail_model.is_active, bank_detail_model.is_deleted == False))
         await session.commit()
+        await invalidation.publish(invalidation.Topic.TEAM, bank_detail_model.team_id)
+        if bank_detail_model.device_hash is not None:
+            await invalidation.publish(invalidation.Topic.DEVICE, bank_detail_model.device_hash)
         return BankDetailSchemeResponse(
             **bank_detail_model.__dict__,
             period_time=[
@@ -390,6 +394,9 @@ async def delete_bank_detail(
         )
 
         await session.commit()
+        await invalidation.publish(invalidation.Topic.TEAM, bank_detail_model.team_id)
+        if bank_detail_model.device_hash is not None:
+            await invalidation.publish(invalidation.Topic.DEVICE, bank_detail_model.device_hash)
         
         result = BankDetailSchemeResponse(
             **bank_detail_model.__dict__,
@@ -538,6 +545,9 @@ async def update_bank_detail(
                 )
                 await session.execute(update_stmt)
         await session.commit()
+        await invalidation.publish(invalidation.Topic.TEAM, bank_detail_model.team_id)
+        if bank_detail_model.device_hash is not None:
+            await invalidation.publish(invalidation.Topic.DEVICE, bank_detail_model.device_hash)
         data = bank_detail_model.__dict__.copy()
         data.pop("today_amount_used", None)
         data.pop("today_transactions_count", None)
@@ -2,6 +2,7 @@ from sqlalchemy import select, false
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from app import exceptions
+from app.core import invalidation
 from app.core.session import async_session
 from app.models.FeeContractModel import FeeContractModel
 from app.models.TrafficWeightContractModel import TrafficWeightContractModel
@@ -60,6 +61,7 @@ async def create_traffic_weight_contract(
         )
         session.add(contract_model)
         await session.commit()
+        await invalidation.publish(invalidation.Topic.MERCHANT, contract_model.merchant_id)
         
         return TrafficWeightResponse(
             **contract_model.__dict__
@@ -124,6 +126,7 @@ async def delete_traffic_weight_contract(
         )
         contract_model.is_deleted = True
         await session.commit()
+        await invalidation.publish(invalidation.Topic.MERCHANT, contract_model.merchant_id)
         
         return TrafficWeightResponse(
             **contract_model.__dict__
@@ -163,6 +166,7 @@ async def update_traffic_weight_contract(
             contract_scheme_request_update.__dict__
         )
         await session.commit()
+        await invalidation.publish(invalidation.Topic.MERCHANT, contract_model.merchant_id)
         
         return TrafficWeightResponse(
             **contract_model.__dict__
@@ -4,6 +4,7 @@ import json
 
 from app import exceptions
 from app.core.constants import DECIMALS, Banks, Bank, Type
+from app.utils.aho_corasick import AhoCorasick
 
 
 def preprocess_message(message: str) -> str:
@@ -32,8 +33,84 @@ def preprocess_message(message: str) -> str:
     return message
 
 
+def _keyword_pattern(keywords) -> re.Pattern:
+    """One regex matching any of the keywords, with the alternatives merged into a trie
+    so that the engine tests each position against one branch per first letter"""
+    trie = {}
+    for keyword in keywords:
+        node = trie
+        for ch in keyword:
+            node = node.setdefault(ch, {})
+        node[''] = {}
+
+    def emit(node) -> str:
+        if '' in node:
+            return ''
+        branches = [re.escape(ch) + emit(child) for ch, child in sorted(node.items())]
+        return branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+
+    return re.compile(emit(trie))
+
+
+_CARD_LAST_DIGITS = re.compile(r'(karta|сч|карта|счет|счёт|schet|visa|mastercard|мир|mir)(\D|){4}[0-9]{4}')
+_HEADER_CARD_LAST_DIGITS = re.compile(r'(сч|karta|карт|счет|счёт|schet|visa|mastercard|мир|ecmc|mc|mir|ecmc|·)\D{0,4}[0-9]{4}')
+_INR = re.compile(r'rs([0-9., ]*[0-9.,][0-9., ]*)')
+_NUMBER_WITHOUT_R = re.compile(r'(?<!\d)(\d+(?:\.\d+)?)(?!р)')
+
+_BLOCKED = _keyword_pattern(('заблокирован', 'отказ', 'компрометаци', 'не поступил', 'заблокировали'))
+_CREDITED_RUR = re.compile(r'зачислено [^A-Za-z\u0400-\u04FF]+ rur')
+_PAYOUT_ACCOUNT = re.compile(r'(?<!\w)(mir|сч|мир|ecmc|mc|visa|mastercard|счёт|счет)(?!\w)')
+_TJS_CARD = re.compile(r'karta \d{12}(\d{4})')
+_TJS_SUMMA = re.compile(r'summa .* tjs')
+_TJS_KOMIS = re.compile(r'komis .* tjs')
+_KZT_CARD = re.compile(r'\*(\d{4})')
+_SBER_TRANSFER = re.compile(r"перевод.*\b(от|из)\b")
+_SBER_CREDIT = re.compile(r'(?<!["])\bзачисление\b(?!["])')
+_WALLET_TOP_UP = re.compile(r"(кошелёк пополнен на\s+)(\d+[.,]?\d*)")
+_SUM = re.compile(r"(сумма:\s+)(\d+[.,]?\d*)")
+_SENDER = re.compile(r"отправитель:\s*\d+[*·]+\d+")
+_SOLIDARNOST_ACCOUNT = re.compile(r'сч\s\d{5}\.\.\.\d{3}')
+_YOOMONEY_WALLET = re.compile(r'кошельке\s+(\d+)')
+# messages containing any of these are never an incoming payment
+_IGNORED = _keyword_pattern((
+    'отклон', 'отмен', 'выдач', 'наличн', 'снят', 'вывод', 'запрос ', 'расход ', 'otmena', 'otpravlen perevod',
+    'карта пэй', ' код', 'списан', 'spisanie', 'течение 24ч выберите', 'текстовое сообщение: ',
+    'успешно завершен', 'otklone', 'покупка', 'код!', 'nikomu ne soobshhajte', 'spisano ', 'p2p mkb-mobile',
+    'q.tb.ru', 'запрашивает',
+))
+_DONE_TRANSFER = re.compile('исполнен|выполнен|не прошел')
+_LETTERS = frozenset('абвгдеёжзиклмнопрстфхцчшщъыьэюяabcdefghijklmnopqrstuvwxyz')
+
+# Collapses the lowercase letters below to "a" and drops every other non-ascii character in one
+# bytes.translate: all of them are single bytes in cp1251 and whatever cp1251 can't encode
+# is non-ascii anyway.
+_TO_ASCII_LETTERS = 'абвгдеёжзиклмнопрстфхцчшщъыьэюя'.encode('cp1251')
+_TO_ASCII_TABLE = bytes(ord('a') if i in _TO_ASCII_LETTERS else i for i in range(256))
+_TO_ASCII_DROP = bytes(i for i in range(0x80, 0x100) if i not in _TO_ASCII_LETTERS)
+_CURRENCY_MARKERS = (
+    (' сом', 'rub'),
+    ('₸', 'rub'),
+    ('azn', 'rub'),
+    ('kgs', 'rub'),
+    ('uzs', 'rub'),
+    ('rur', 'rub'),
+    ('tjs', 'rub'),
+    ('rub', 'р '),
+    ('kzt', 'р '),
+    (' ₽', 'р '),
+    (' руб', 'р '),
+    ('r', 'р'),
+    ('p', 'р'),
+    ('₽', 'р'),
+    ('р ', 'rub'),
+    ('р.', 'rub'),
+    (' р', 'rub'),
+    ('р\n', 'rub'),
+)
+
+
 def get_card_last_digits(sms: str) -> str | None:
-    result = re.search(r'(karta|сч|карта|счет|счёт|schet|visa|mastercard|мир|mir)(\D|){4}[0-9]{4}', sms)
+    result = _CARD_LAST_DIGITS.search(sms)
     if result is None:
         return None
     return result[0][-4:]
@@ -42,32 +119,138 @@ def get_card_last_digits(sms: str) -> str | None:
 def try_get_card_last_digits(header):
     if header is None:
         return None
-    result = re.search(r'(сч|karta|карт|счет|счёт|schet|visa|mastercard|мир|ecmc|mc|mir|ecmc|·)\D{0,4}[0-9]{4}', header)
+    result = _HEADER_CARD_LAST_DIGITS.search(header)
     if result is None:
         return None
     return result[0][-4:]
 
 
 def replace_inr(s: str):
-    for i in range(len(s) - 1):
-        if s[i] == 'r' and s[i + 1] == 's':
-            t = ''
-            g = ''
-            t += s[i]
-            t += s[i + 1]
-            ind = i + 2
-            while ind < len(s) and s[ind] in '0123456789., ':
-                g += s[ind]
-                ind += 1
-            if len(g.replace(' ', '')) > 0:
-                return s[0:i] + g + t.replace('rs', 'rub ') + s[ind:]
-
-    return s
+    if 'rs' not in s:
+        return s
+    match = _INR.search(s)
+    if match is None:
+        return s
+    return s[:match.start()] + match[1] + 'rub ' + s[match.end():]
 
 
 def add_r_after_numbers(text: str) -> str:
     # Добавляем "р" после чисел (включая десятичные), но только если "р" не стоит уже сразу после
-    return re.sub(r'(?<!\d)(\d+(?:\.\d+)?)(?!р)', r'\1р', text)
+    return _NUMBER_WITHOUT_R.sub(r'\1р', text)
+
+
+def _first_amount(sms: str) -> str | None:
+    """The number right before the first standalone "р" that has one"""
+    i = sms.find('р')
+    while i != -1:
+        if sms[i + 1] not in _LETTERS:
+            head = sms[:i]
+            number = head[len(head.rstrip(' 0123456789.,')):].replace(' ', '').lstrip('.,')
+            if number:
+                if len(number) >= 4 and number[-1] not in '.,' and number[-2] not in '.,' and number[-3] not in '.,':
+                    number = number.replace(',', '').replace('.', '')
+                return number.replace(',', '.')
+        i = sms.find('р', i + 1)
+    return None
+
+
+class BankParser:
+    """Bank specific rules of parse_message.
+
+    The base class is the generic parser used for every bank without rules of its own,
+    subclasses registered with ``register_parser`` override only the hooks they need, so a
+    message is checked against the rules of its own bank and nobody else's.
+    """
+    # "c2c psb m f" is an outgoing transfer in every bank's messages but vtb's
+    accepts_c2c_psb = False
+    # "платеж" marks an outgoing payment in every bank's messages but yoomoney's
+    accepts_payments = False
+
+    def prepare(self, sms: str) -> str:
+        return sms
+
+    def rejects(self, sms: str) -> bool:
+        """True for messages of this bank that are never an incoming payment"""
+        return False
+
+    def check_card_end(self, sms: str, card_end: str) -> str | None:
+        return card_end
+
+    def override_card_end(self, sms: str, card_end: str | None) -> str | None:
+        return card_end
+
+    def mark_amounts(self, sms: str) -> str:
+        return sms.replace('postuplenie', '|postuplenie')
+
+
+GENERIC_PARSER = BankParser()
+_PARSERS: dict[str, BankParser] = {}
+
+
+def register_parser(bank: Bank):
+    def decorator(cls):
+        bank.parser = _PARSERS[bank.name] = cls()
+        return cls
+    return decorator
+
+
+def get_parser(bank: str | None) -> BankParser:
+    return _PARSERS.get(bank, GENERIC_PARSER)
+
+
+@register_parser(Banks.SBER)
+class SberParser(BankParser):
+    def rejects(self, sms: str) -> bool:
+        if not _SBER_TRANSFER.search(sms) and not _SBER_CREDIT.search(sms):
+            return True
+        if 'мир' not in sms and 'счёт' not in sms and 'mir' not in sms and 'ecmc' not in sms and 'visa' not in sms:
+            return True
+        return 'баланс' not in sms
+
+
+@register_parser(Banks.ALFABUSINESS)
+class AlfaBusinessParser(BankParser):
+    def prepare(self, sms: str) -> str:
+        return add_r_after_numbers(sms)
+
+
+@register_parser(Banks.VTB)
+class VtbParser(BankParser):
+    accepts_c2c_psb = True
+
+
+@register_parser(Banks.OZON)
+class OzonParser(BankParser):
+    def rejects(self, sms: str) -> bool:
+        return "перевод через" in sms
+
+
+@register_parser(Banks.YOOMONEY)
+class YoomoneyParser(BankParser):
+    accepts_payments = True
+
+    def rejects(self, sms: str) -> bool:
+        return "деньги получит" in sms
+
+    def override_card_end(self, sms: str, card_end: str | None) -> str | None:
+        match = _YOOMONEY_WALLET.search(sms)
+        if match:
+            return match.group(1)[-4:]
+        return card_end
+
+
+@register_parser(Banks.SOLIDARNOST)
+class SolidarnostParser(BankParser):
+    def check_card_end(self, sms: str, card_end: str) -> str | None:
+        if _SOLIDARNOST_ACCOUNT.search(sms):
+            return None
+        return card_end
+
+
+@register_parser(Banks.POCHTABANK)
+class PochtabankParser(BankParser):
+    def mark_amounts(self, sms: str) -> str:
+        return super().mark_amounts(sms).replace('popolnenie', '|popolnenie')
 
 
 def parse_message(sms: str, header: str, bank: str | None = None, recursion: int = 0) -> Tuple[int | None, str | None, str | None]:
@@ -78,157 +261,79 @@ def parse_message(sms: str, header: str, bank: str | None = None, recursion: int
     #hasName = re.search(name_pattern, header)
     #if hasName:
     #    return None, None, None
-    sms = header.lower() + " " + sms.lower()
-    if bank == 'alfabusiness':
-        sms = add_r_after_numbers(sms)
-    if 'заблокирован' in sms or 'отказ' in sms or 'компрометаци' in sms or 'не поступил' in sms or 'заблокировали' in sms:
+    parser = get_parser(bank)
+    sms = parser.prepare(header.lower() + " " + sms.lower())
+    if _BLOCKED.search(sms):
         raise exceptions.BlockedCardException()
-    result = re.findall(r'зачислено [^A-Za-z\u0400-\u04FF]+ rur', sms)
-    if result is not None and len(result) > 0:
+    result = _CREDITED_RUR.findall(sms)
+    if result:
         sms = result[-1] + sms
-    pattern = r'(?<!\w)(mir|сч|мир|ecmc|mc|visa|mastercard|счёт|счет)(?!\w)'
     if (
-            re.search(pattern, sms)
+            'перевод' in sms
             and ' от ' not in sms
             and 'получен ' not in sms
-            and 'перевод' in sms
+            and _PAYOUT_ACCOUNT.search(sms)
     ):  # sber pay out
         return None, None, None
     sms = ' ^ ' + sms + ' ^'
     header = header.lower()
-    sms = sms.replace('*', '·')
-    sms = sms.replace(' ', ' ')
+    sms = sms.replace('*', '·').replace('\xa0', ' ')
     new_amount = None
     if 'tjs' in sms:
-        sms = re.sub(r'karta \d{12}(\d{4})', r'visa\1', sms)
+        sms = _TJS_CARD.sub(r'visa\1', sms)
 
         if 'summa' in sms and 'zachislenie' in sms and 'komis' in sms:
-            new_amount, _, _ = parse_message(
-                re.sub(r'komis .* tjs', r'', re.sub(r'summa .* tjs', r'', sms))
-                , header, bank, 1)
-            print(re.sub(r'komis .* tjs', r'', re.sub(r'summa .* tjs', r'', sms)))
+            new_amount, _, _ = parse_message(_TJS_KOMIS.sub('', _TJS_SUMMA.sub('', sms)), header, bank, 1)
 
     if 'kzt' in sms:
-        sms = re.sub(r'\*(\d{4})', lambda match: f"{match.group(0)}#", sms)
-    if bank == "sber":
-        pattern1 = r"перевод.*\b(от|из)\b"
-        pattern2 = r'(?<!["])\bзачисление\b(?!["])'
-        if not re.search(pattern1, sms) and not re.search(pattern2, sms):
-            return None, None, None
-        if 'мир' not in sms and 'счёт' not in sms and 'mir' not in sms and 'ecmc' not in sms and 'visa' not in sms:
-            return None, None, None
-        if 'баланс' not in sms:
-            return None, None, None
-    #if bank == "vtb":
-    #    pattern = r'\bпоступление\b'
-    #    if not re.search(pattern, sms):
-    #        return None, None, None
-    if bank == "ozon":
-        if "перевод через" in sms:
-            return None, None, None
-    if bank == "yoomoney":
-        if "деньги получит" in sms:
-            return None, None, None
-    if len(sms) > 350 or len(sms) < 15:
+        sms = _KZT_CARD.sub(lambda match: f"{match.group(0)}#", sms)
+    if parser.rejects(sms):
         return None, None, None
-    if 'операция' in sms and 'uzs' in sms:
-        return None, None, None
-    if 'оплата' in sms and 'uzs' in sms:
-        return None, None, None
-    if 'отклон' in sms or 'отмен' in sms or 'выдач' in sms or 'наличн' in sms or 'снят' in sms or 'вывод' in sms:
+    if len(sms) > 350 or len(sms) < 15:
         return None, None, None
-    if 'запрос ' in sms or 'расход ' in sms:
+    if 'uzs' in sms and ('операция' in sms or 'оплата' in sms):
         return None, None, None
-    if ('c2c psb m f' in sms and bank != "vtb") or 'отмена' in sms or 'otmena' in sms or 'otpravlen perevod' in sms or 'карта пэй' in sms or ' код' in sms or 'списано' in sms or 'списан' in sms \
-            or 'списание' in sms or 'spisanie' in sms or 'течение 24ч выберите' in sms or 'текстовое сообщение: ' in sms + header or 'снятие' in sms \
-            or 'успешно завершен' in sms or (
-            'перевод' in sms and (
-            'исполнен' in sms or 'выполнен' in sms or 'не прошел' in sms)) or 'otklone' in sms or 'отклоне' in sms or 'покупка' in sms or 'выдача' in sms \
-            or ('платеж' in sms and bank != "yoomoney") or ('перевод сбп' in sms and ' для ' in sms and ' в ' in sms) or 'код!' in sms \
-            or ("перевод с карты" in sms and "mtsb" in sms) or 'nikomu ne soobshhajte' in sms \
-            or 'spisano ' in sms or 'p2p mkb-mobile' in sms or 'q.tb.ru' in sms or 'запрашивает' in sms:
+    if _IGNORED.search(sms) or 'текстовое сообщение: ' in header \
+            or ('c2c psb m f' in sms and not parser.accepts_c2c_psb) \
+            or ('перевод' in sms and _DONE_TRANSFER.search(sms)) \
+            or ('платеж' in sms and not parser.accepts_payments) or ('перевод сбп' in sms and ' для ' in sms and ' в ' in sms) \
+            or ("перевод с карты" in sms and "mtsb" in sms):
         return None, None, None
-    ss = r"(кошелёк пополнен на\s+)(\d+[.,]?\d*)"
-    sms = re.sub(ss, r"\1\2rub", sms)
-    ss = r"(сумма:\s+)(\d+[.,]?\d*)"
-    sms = re.sub(ss, r"\1\2rub", sms)
-    pattern = r"отправитель:\s*\d+[*·]+\d+"
-    sms = re.sub(pattern, "отправитель", sms)
+    if 'кошелёк пополнен на' in sms:
+        sms = _WALLET_TOP_UP.sub(r"\1\2rub", sms)
+    if 'сумма:' in sms:
+        sms = _SUM.sub(r"\1\2rub", sms)
+    if 'отправитель:' in sms:
+        sms = _SENDER.sub("отправитель", sms)
     card_end = try_get_card_last_digits(sms)
     if card_end is not None:
-        if bank == "solidarnost":
-            if re.search(r'сч\s\d{5}\.\.\.\d{3}', sms):
-                card_end = None
+        card_end = parser.check_card_end(sms, card_end)
         if card_end is not None:
             sms = sms.replace(card_end, f"{card_end}|")
+    card_end = parser.override_card_end(sms, card_end)
 
-    if bank == "yoomoney":
-        match = re.search(r'кошельке\s+(\d+)', sms)
-        if match:
-            wallet_number = match.group(1)
-            last_4_digits = wallet_number[-4:]
-            card_end = last_4_digits
-
-    sms = sms.replace('postuplenie', '|postuplenie')
-    if bank == "pochtabank":
-        sms = sms.replace('popolnenie', '|popolnenie')
+    sms = parser.mark_amounts(sms)
     sms = replace_inr(sms)
-    sms = sms.replace(' сом', 'rub')
-    sms = sms.replace('₸', 'rub')
-    sms = sms.replace('azn', 'rub')
-    sms = sms.replace('kgs', 'rub')
-    sms = sms.replace('uzs', 'rub')
-    sms = sms.replace('rur', 'rub')
-    sms = sms.replace('tjs', 'rub')
-    sms = sms.replace('rub', 'р ')
-    sms = sms.replace('kzt', 'р ')
-    sms = sms.replace(' ₽', 'р ')
-    sms = sms.replace(' руб', 'р ')
-    sms.replace(' rub', 'р ')
-    sms = sms.replace('r', 'р')
-    sms = sms.replace('p', 'р')
-    sms = sms.replace('₽', 'р')
-    sms = sms.replace('р ', 'rub')
-    sms = sms.replace('р.', 'rub')
-    sms = sms.replace(' р', 'rub')
-    sms = sms.replace(' р', 'rub')
-    sms = sms.replace('р\n', 'rub')
-    sms_ = []
-
-    for i in range(len(sms)):
-        if sms[i] in 'абвгдеёжзиклмнопрстфхцчшщъыьэюя':
-            sms_.append('a')
-        else:
-            sms_.append(sms[i])
-    sms = ''.join(sms_)
-    sms = sms.encode('ascii', 'ignore').decode('utf-8')
+    for old, new in _CURRENCY_MARKERS:
+        sms = sms.replace(old, new)
+    sms = sms.encode('cp1251', 'ignore').translate(_TO_ASCII_TABLE, _TO_ASCII_DROP).decode('ascii')
     sms = sms.replace('rub', 'р ')
     sms = '^' + sms + '^'
-    numbers = []
-    if 'менее' in sms or 'пополните' in sms:
-        sms = ''
-    for i in range(len(sms) - 1):
-        if sms[i] == 'р' and sms[i + 1] not in 'абвгдеёжзиклмнопрстфхцчшщъыьэюяabcdefghijklmnopqrstuvwxyz':
-            res = ''
-            j = i - 1
-            while str(sms[j]) in ' 0123456789.,':
-                res += sms[j].replace(' ', '')
-                j -= 1
-            d = 0
-            while len(res) + d > 0 and res[d - 1] not in '0123456789':
-                d -= 1
-            if d < 0:
-                res = res[:d]
-            if len(res) > 0:
-                if len(res) >= 4 and res[0] not in '.,' and res[1] not in '.,' and res[2] not in '.,':
-                    res = res.replace(',', '').replace('.', '')
-                try:
-                    numbers.append(res[::-1].replace(',', '.'))
-                except TypeError:
-                    pass
-    if len(numbers) > 0 and numbers[0].count('.') > 1:
-        numbers[0] = numbers[0].replace('.', '', numbers[0].count('.') - 1)
-    return round(float(numbers[0]) * DECIMALS) if len(numbers) > 0 else None, card_end, new_amount
+    number = _first_amount(sms)
+    if number is not None and number.count('.') > 1:
+        number = number.replace('.', '', number.count('.') - 1)
+    return round(float(number) * DECIMALS) if number is not None else None, card_end, new_amount
+
+
+# every package name of every bank in declaration order, so that the lowest match is the bank
+# the first-match loop over Banks used to return
+_SENDER_PACKAGES = [
+    (package.lower(), bank.name)
+    for bank in vars(Banks).values() if isinstance(bank, Bank)
+    for package in bank.package_names
+]
+_SENDER_INDEX = AhoCorasick([package for package, _ in _SENDER_PACKAGES])
+_SENDER_BANKS = [name for _, name in _SENDER_PACKAGES]
 
 
 def get_bank_by_sender(msg: str, text: str, package_name: str | None) -> str | None:
@@ -240,11 +345,8 @@ def get_bank_by_sender(msg: str, text: str, package_name: str | None) -> str | N
     else:
         check_bank = msg
 
-    for bank in vars(Banks).values():
-        if isinstance(bank, Bank):
-            if any(package in check_bank for package in [p.lower() for p in bank.package_names]):
-                return bank.name
-    return None
+    index = _SENDER_INDEX.first(check_bank)
+    return _SENDER_BANKS[index] if index is not None else None
 
 
 if __name__ == '__main__':
@@ -0,0 +1,225 @@
+"""Queued processing of device messages.
+
+With ``settings.DEVICE_EVENTS_ASYNC`` on, accept-from-device only validates the
+message and appends it to a Redis Stream, and the phone gets its answer right
+away; accept-from-device/batch appends all messages of a batch at once and
+answers 202 for each. Streams are partitioned by api_secret, so all messages of a team land in
+one partition and are handled in the order they came in. The Celery task
+``process_device_events`` takes a lease on each partition it works on, reads it
+through a consumer group and runs every event through
+``external_transaction_update_from_device`` one after another; up to
+``Params.DEVICE_EVENTS_CONCURRENCY`` partitions run at a time.
+
+An event that fails with an HTTP error got its final answer (no candidates,
+repeated, ...) and is acknowledged. Messages without an amount and events that
+keep failing for ``Params.DEVICE_EVENTS_MAX_ATTEMPTS`` deliveries are moved to
+the dead letter stream. Any other failure stops the partition for this run and
+the event is read again from the pending list next time, so the order holds.
+Acknowledged events are deleted, the length of a partition is its backlog, and
+appending is refused with 503 once it reaches ``Params.DEVICE_EVENTS_MAX_BACKLOG``.
+
+The lease holds a random token. It is renewed before every event and released
+only by the worker whose token it holds; a worker that finds its lease gone
+stops at once, since another one may already be reading the same pending
+events.
+"""
+import asyncio
+import hashlib
+import logging
+import time
+import uuid
+
+from fastapi import HTTPException
+from redis.exceptions import ResponseError
+
+import app.exceptions as exceptions
+import app.schemas.ExternalTransactionScheme as ETs
+from app.core.constants import Params
+from app.core.redis import rediss
+from app.functions import external_transaction as e_t_f
+
+logger = logging.getLogger(__name__)
+
+GROUP = "device_events"
+# one consumer per partition, the partition lease makes sure it runs in one place at a time
+CONSUMER = "owner"
+DEAD_LETTER_KEY = "/device_events/dead"
+METRICS_KEY = "/device_events/metrics"
+
+_RENEW_SCRIPT = rediss.register_script(
+    """
+    if redis.call('GET', KEYS[1]) == ARGV[1] then
+        return redis.call('EXPIRE', KEYS[1], ARGV[2])
+    end
+    return 0
+    """
+)
+
+_RELEASE_SCRIPT = rediss.register_script(
+    """
+    if redis.call('GET', KEYS[1]) == ARGV[1] then
+        return redis.call('DEL', KEYS[1])
+    end
+    return 0
+    """
+)
+
+
+def _stream_key(partition: int) -> str:
+    return f"/device_events/stream/{partition}"
+
+
+def _lease_key(partition: int) -> str:
+    return f"/device_events/lease/{partition}"
+
+
+def _partition(api_secret: str) -> int:
+    return int.from_bytes(hashlib.sha256(api_secret.encode()).digest()[:4], "big") % Params.DEVICE_EVENTS_PARTITIONS
+
+
+async def enqueue(request: ETs.RequestUpdateFromDeviceDB) -> str:
+    return (await enqueue_batch([request]))[0]
+
+
+async def enqueue_batch(requests: list[ETs.RequestUpdateFromDeviceDB]) -> list[str]:
+    """Appends the messages of one device in their order, all or none of them."""
+    now = int(time.time())
+    for request in requests:
+        if request.timestamp is None:
+            # matched against the time the phone sent it, not the time a worker gets to it
+            request.timestamp = now
+    key = _stream_key(_partition(requests[0].api_secret))
+    if await rediss.xlen(key) + len(requests) > Params.DEVICE_EVENTS_MAX_BACKLOG:
+        raise exceptions.DeviceEventsBacklogFullException()
+    async with rediss.pipeline(transaction=True) as pipe:
+        for request in requests:
+            pipe.xadd(key, {"request": request.model_dump_json()})
+        event_ids = await pipe.execute()
+    return [event_id.decode() if isinstance(event_id, bytes) else event_id for event_id in event_ids]
+
+
+async def _ensure_group(key: str) -> None:
+    try:
+        await rediss.xgroup_create(key, GROUP, id="0", mkstream=True)
+    except ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+
+async def _dead_letter(key: str, event_id: str, data: str, error: str) -> None:
+    async with rediss.pipeline(transaction=True) as pipe:
+        pipe.xadd(DEAD_LETTER_KEY, {"stream": key, "event_id": event_id, "request": data, "error": error},
+                  maxlen=Params.DEVICE_EVENTS_DEAD_LETTER_MAX_LEN, approximate=True)
+        pipe.xack(key, GROUP, event_id)
+        pipe.xdel(key, event_id)
+        await pipe.execute()
+
+
+async def _ack(key: str, event_id: str) -> None:
+    async with rediss.pipeline(transaction=True) as pipe:
+        pipe.xack(key, GROUP, event_id)
+        pipe.xdel(key, event_id)
+        await pipe.execute()
+
+
+async def _deliveries(key: str, event_id: str) -> int:
+    pending = await rediss.xpending_range(key, GROUP, min=event_id, max=event_id, count=1)
+    return pending[0]["times_delivered"] if pending else 1
+
+
+async def _handle(key: str, event_id: str, data: str, stats: dict) -> bool:
+    """Returns False if the partition has to stop and retry the event later."""
+    stats["max_lag_s"] = max(stats["max_lag_s"], time.time() - int(event_id.split("-")[0]) / 1000)
+    try:
+        await e_t_f.external_transaction_update_from_device(ETs.RequestUpdateFromDeviceDB.model_validate_json(data))
+    except exceptions.ExternalTransactionCannotParseAmount as e:
+        await _dead_letter(key, event_id, data, str(e.detail))
+        stats["dead_lettered"] += 1
+        return True
+    except HTTPException as e:
+        logger.info(f"[DeviceEvents] - event_id = {event_id}, status_code = {e.status_code}, detail = {e.detail}")
+    except Exception as e:
+        logger.error(f"[DeviceEvents] - event_id = {event_id}, error = {e}")
+        if await _deliveries(key, event_id) < Params.DEVICE_EVENTS_MAX_ATTEMPTS:
+            return False
+        await _dead_letter(key, event_id, data, str(e))
+        stats["dead_lettered"] += 1
+        return True
+    await _ack(key, event_id)
+    stats["processed"] += 1
+    return True
+
+
+async def _renew(lease: str, token: str) -> bool:
+    return bool(await _RENEW_SCRIPT(keys=[lease], args=[token, Params.DEVICE_EVENTS_LEASE_S]))
+
+
+async def _drain(partition: int, deadline: float, stats: dict) -> None:
+    key = _stream_key(partition)
+    lease = _lease_key(partition)
+    token = str(uuid.uuid4())
+    if not await rediss.set(lease, token, nx=True, ex=Params.DEVICE_EVENTS_LEASE_S):
+        return
+    try:
+        await _ensure_group(key)
+        # what a worker that died left unacknowledged comes first
+        stream_id = "0"
+        while time.time() < deadline:
+            response = await rediss.xreadgroup(
+                GROUP, CONSUMER, {key: stream_id}, count=Params.DEVICE_EVENTS_BATCH_SIZE
+            )
+            events = response[0][1] if response else []
+            if not events:
+                if stream_id == ">":
+                    break
+                stream_id = ">"
+                continue
+            for event_id, fields in events:
+                if not await _renew(lease, token):
+                    logger.error(f"[DeviceEvents] - lease lost, partition = {partition}")
+                    return
+                event_id = event_id.decode() if isinstance(event_id, bytes) else event_id
+                if not fields:
+                    # deleted while still pending
+                    await _ack(key, event_id)
+                    continue
+                data = fields.get(b"request", fields.get("request"))
+                data = data.decode() if isinstance(data, bytes) else data
+                if not await _handle(key, event_id, data, stats):
+                    return
+    finally:
+        await _RELEASE_SCRIPT(keys=[lease], args=[token])
+
+
+async def process_events() -> int:
+    """Works through every partition until they are empty or the run budget is spent."""
+    started = time.time()
+    deadline = started + Params.DEVICE_EVENTS_RUN_BUDGET_S
+    stats = {"processed": 0, "dead_lettered": 0, "max_lag_s": 0.0}
+    semaphore = asyncio.Semaphore(Params.DEVICE_EVENTS_CONCURRENCY)
+
+    async def drain(partition: int):
+        async with semaphore:
+            try:
+                await _drain(partition, deadline, stats)
+            except Exception as e:
+                logger.error(f"[DeviceEvents] - partition = {partition}, error = {e}")
+
+    await asyncio.gather(*[drain(partition) for partition in range(Params.DEVICE_EVENTS_PARTITIONS)])
+
+    async with rediss.pipeline(transaction=False) as pipe:
+        for partition in range(Params.DEVICE_EVENTS_PARTITIONS):
+            pipe.xlen(_stream_key(partition))
+        backlog = sum(await pipe.execute())
+    await rediss.hset(METRICS_KEY, mapping={
+        "last_run": int(started),
+        "processed": stats["processed"],
+        "dead_lettered": stats["dead_lettered"],
+        "max_lag_s": round(stats["max_lag_s"], 3),
+        "backlog": backlog,
+    })
+    logger.info(
+        f"[DeviceEvents] - processed = {stats['processed']}, dead_lettered = {stats['dead_lettered']}, "
+        f"max_lag_s = {stats['max_lag_s']:.3f}, backlog = {backlog}"
+    )
+    return stats["processed"]
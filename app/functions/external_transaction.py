@@ -3,7 +3,6 @@ import base64
 import hashlib
 from PyPDF2 import PdfReader, PdfWriter
 from PIL import Image
-import random
 import time
 import uuid
 import logging
@@ -11,7 +10,7 @@ import functools
 from uuid import UUID
 import json
 from datetime import datetime, timedelta
-from typing import List, Tuple, Optional
+from typing import Awaitable, Callable, List, Tuple, Optional
 from sqlalchemy.dialects import postgresql
 from fastapi import UploadFile, Request, HTTPException, status as http_status
 from sqlalchemy import (
@@ -33,7 +32,7 @@ from sqlalchemy.sql import exists
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import aliased
 from sqlalchemy.dialects.postgresql import insert as pg_insert
-from sqlalchemy.exc import DBAPIError
+from sqlalchemy.exc import DBAPIError, IntegrityError
 
 import app.api.telegram as tg
 import app.exceptions as exceptions
@@ -47,7 +46,6 @@ from app.core import file_storage, redis
 from app.core.constants import (
     ASSOCIATE_BANK,
     ASSOCIATE_MERCHANT_BANK,
-    AUTO_CLOSE_EXTERNAL_TRANSACTIONS_S,
     BEFORE_CLOSE_OUT_EXTERNAL_TRANSACTIONS_S,
     DECIMALS,
     Direction,
@@ -63,14 +61,25 @@ from app.core.constants import (
     SUPPORT_OUTBOUND_CATEGORIES,
     TRANSACTION_FINAL_STATUS_TITLES,
     USUAL_TYPES_INFO,
-    REPLICATION_LAG_S
+    REPLICATION_LAG_S,
+    Params
 )
 from app.core.session import async_session, ro_async_session
-from app.functions import device
+from app.functions import (
+    balance_writer,
+    device,
+    outbound_routing,
+    reservation,
+    routing_index,
+    routing_trace,
+    team_resolution,
+    transaction_timers,
+)
+from app.functions.analytics import add_450error
 from app.functions.balance import (
     _get_currency,
     add_balance_changes,
-    get_balance_id_by_user_id, get_balances,
+    get_balance_id_by_user_id, get_balance_snapshot, get_balances,
 )
 from app.functions.change_tag_code_inbound import change_tag_code_inbound
 from app.functions.device import preprocess_message
@@ -91,7 +100,6 @@ from app.models import (
     NamespaceModel,
     TelegramVerifierChatIdModel,
     VipPayerModel,
-    UserBalanceChangeNonceModel,
     WhiteListPayerModel,
     TransferAssociationModel,
     AppealModel
@@ -116,51 +124,51 @@ from io import BytesIO
 logger = logging.getLogger(__name__)
 
 
-async def get_bank_detail_for_merchant_(
-        type: str,
+def _inbound_routing_query(
         merchant_id: str,
-        merchant_transaction_id: str,
         payer_id: str,
-        request_id: str,
-        amount: int | None,
-        session: AsyncSession,
-        is_vip: bool = False,
-        is_whitelist: bool = False,
+        amounts: List[int],
+        candidate_ids: List[str],
+        is_vip: bool,
+        is_whitelist: bool,
+        type: str | None = None,
+        types: Optional[List[str]] = None,
         bank: str | None = None,
         banks: Optional[List[str]] = None,
-        types: Optional[List[str]] = None,
         payment_systems: Optional[List[str]] = None,
-        initial_amount: int | None = None,
-        final: bool = False
-) -> ETs.ResponseInboundGetTeamBankDetail | ETs.ResponseOutboundGetTeamBankDetail:
-    #block_query = (
-    #    select(BankDetailModel)
-    #    .where(BankDetailModel.auto_managed == true(),
-    #           BankDetailModel.is_deleted == false(),
-    #           BankDetailModel.is_active == true())
-    #    .with_for_update()
-    #)
-    #block = await session.execute(block_query)
-    is_whitelist = min(is_whitelist, is_vip)
+):
+    """
+    Only the set of optional filters changes the statement text, every value is
+    a bind parameter, so asyncpg can reuse the prepared statement across pay-ins
+    """
+    params = {
+        "merchant_id": merchant_id,
+        "payer_id": payer_id,
+        "amounts": amounts,
+        "candidate_ids": candidate_ids,
+        "limit": Params.INBOUND_RESERVATION_CANDIDATES * len(amounts),
+    }
     if bank:
-        bank_condition = f"AND BD.bank = '{bank}'"
+        bank_condition = "AND BD.bank = ANY(:banks)"
+        params["banks"] = [bank]
     elif banks:
-        banks_list = ', '.join(f"'{b}'" for b in banks)
-        bank_condition = f"AND BD.bank IN ({banks_list})"
+        bank_condition = "AND BD.bank = ANY(:banks)"
+        params["banks"] = banks
     else:
         bank_condition = ""
 
     if type:
-        type_condition = f"AND BD.type = '{type}' AND TWC.type = '{type}'"
+        type_condition = "AND BD.type = ANY(:types) AND TWC.type = ANY(:types)"
+        params["types"] = [type]
     elif types:
-        types_list = ', '.join(f"'{t}'" for t in types)
-        type_condition = f"AND BD.type IN ({types_list}) AND TWC.type IN ({types_list})"
+        type_condition = "AND BD.type = ANY(:types) AND TWC.type = ANY(:types)"
+        params["types"] = types
     else:
         type_condition = ""
 
     if payment_systems:
-        payment_list = ', '.join(f"'{p}'" for p in payment_systems)
-        payment_condition = f"AND BD.payment_system IN ({payment_list})"
+        payment_condition = "AND BD.payment_system = ANY(:payment_systems)"
+        params["payment_systems"] = payment_systems
     else:
         payment_condition = ""
 
@@ -175,7 +183,7 @@ async def get_bank_detail_for_merchant_(
                 CASE WHEN BD.last_transaction_timestamp::date < CURRENT_DATE THEN 0
                      ELSE BD.today_amount_used
                 END
-            ) + {amount // DECIMALS}
+            ) + A.amount / {DECIMALS}
             AND BD.max_today_transactions_count > (
                 CASE WHEN BD.last_transaction_timestamp::date < CURRENT_DATE THEN BD.pending_count
                      ELSE BD.today_transactions_count + BD.pending_count
@@ -223,78 +231,146 @@ async def get_bank_detail_for_merchant_(
     else:
         where_additional = "AND BD.is_vip = FALSE"
 
-    whitelist_condition = f"""
-    LEFT JOIN whitelist_payer_id_model WPM 
-        ON WPM.payer_id = '{payer_id}'
-    """
-    await session.execute(text("SELECT pg_advisory_xact_lock(:lock_key)"), {"lock_key": amount})
-    bank_details_q = await session.execute(
-        text(
-            f"""
-            SELECT
-                BD.id AS bank_detail_id,
-                BD.team_id,
-                BD.is_vip,
-                TWC.inbound_traffic_weight,
-                merchants.currency_id,
-                BD.update_timestamp,
-                -log(RANDOM()) / TWC.inbound_traffic_weight AS sort,
-                teams.priority_inbound,
-                VPM.bank_detail_id AS existing_vip_bank,
-                BD.profile_id
-            FROM bank_detail_model BD
-            LEFT JOIN external_transaction_model T
-                ON T.bank_detail_id = BD.id 
-                AND T.status = '{Status.PENDING}'
-                AND T.amount = {amount}
-            INNER JOIN traffic_weight_contact_model TWC ON TWC.team_id = BD.team_id
-            INNER JOIN teams ON teams.id = BD.team_id
-            INNER JOIN user_model team_user ON team_user.id = BD.team_id
-            INNER JOIN merchants ON merchants.id = '{merchant_id}'
-            INNER JOIN geo_settings gs ON teams.geo_id = gs.id
-            LEFT JOIN user_balance_change_nonce_model nm ON nm.balance_id = team_user.balance_id
-            LEFT JOIN vip_payer_model VPM 
-            ON VPM.payer_id = '{payer_id}'
-               AND VPM.bank_detail_id = BD.profile_id
-            {whitelist_condition}
-            WHERE BD.is_deleted = FALSE
-              AND BD.is_active = TRUE
-              AND teams.is_inbound_enabled = TRUE
-              AND team_user.is_blocked = FALSE
-              AND TWC.is_deleted = FALSE
-              AND TWC.inbound_traffic_weight > 0
-              AND teams.priority_inbound != 0
-              {for_auto_managed}
-              AND BD.fiat_max_inbound * {DECIMALS} >= {amount}
-              AND BD.fiat_min_inbound * {DECIMALS} <= {amount}
-              AND (nm.trust_balance >= teams.credit_factor * {DECIMALS}
-                   OR (nm.trust_balance is null AND teams.credit_factor <= 0))
-              AND teams.fiat_max_inbound * {DECIMALS} >= {amount}
-              AND teams.fiat_min_inbound * {DECIMALS} <= {amount}
-              AND TWC.merchant_id = '{merchant_id}'
-              AND T.bank_detail_id IS NULL
-              AND (
-                  teams.max_inbound_pending_per_token IS NULL OR
-                  teams.count_pending_inbound < teams.max_inbound_pending_per_token
-              )
-              AND (NOT BD.need_check_automation OR (BD.pending_count <= gs.req_after_enable_max_pay_in_count))
-              {type_condition}
-              {bank_condition}
-              {payment_condition}
-              {where_additional}
-            ORDER BY 
-                CASE WHEN VPM.bank_detail_id IS NOT NULL THEN 0 ELSE 1 END,
-                BD.is_vip DESC,
-                teams.priority_inbound DESC,
-                sort,
-                BD.update_timestamp,
-                BD.team_id DESC
-            LIMIT 1
-            """
-        )
+    query = text(
+        f"""
+        SELECT
+            BD.id AS bank_detail_id,
+            BD.team_id,
+            BD.is_vip,
+            TWC.inbound_traffic_weight,
+            merchants.currency_id,
+            BD.update_timestamp,
+            -log(RANDOM()) / TWC.inbound_traffic_weight AS sort,
+            teams.priority_inbound,
+            VPM.bank_detail_id AS existing_vip_bank,
+            BD.profile_id,
+            A.amount
+        FROM bank_detail_model BD
+        CROSS JOIN unnest(CAST(:amounts AS BIGINT[])) AS A(amount)
+        LEFT JOIN pending_amount_reservation PAR
+            ON PAR.bank_detail_id = BD.id
+            AND PAR.amount = A.amount
+        INNER JOIN traffic_weight_contact_model TWC ON TWC.team_id = BD.team_id
+        INNER JOIN teams ON teams.id = BD.team_id
+        INNER JOIN user_model team_user ON team_user.id = BD.team_id
+        INNER JOIN merchants ON merchants.id = :merchant_id
+        INNER JOIN geo_settings gs ON teams.geo_id = gs.id
+        LEFT JOIN user_balance_change_nonce_model nm ON nm.balance_id = team_user.balance_id
+        LEFT JOIN LATERAL (
+            SELECT sum(ubs.trust_balance) AS trust_balance
+            FROM user_balance_stripe_model ubs
+            WHERE ubs.balance_id = team_user.balance_id
+        ) stripes ON TRUE
+        LEFT JOIN vip_payer_model VPM 
+        ON VPM.payer_id = :payer_id
+           AND VPM.bank_detail_id = BD.profile_id
+        LEFT JOIN whitelist_payer_id_model WPM 
+            ON WPM.payer_id = :payer_id
+        WHERE BD.is_deleted = FALSE
+          AND BD.is_active = TRUE
+          AND teams.is_inbound_enabled = TRUE
+          AND team_user.is_blocked = FALSE
+          AND TWC.is_deleted = FALSE
+          AND TWC.inbound_traffic_weight > 0
+          AND teams.priority_inbound != 0
+          {for_auto_managed}
+          AND BD.fiat_max_inbound * {DECIMALS} >= A.amount
+          AND BD.fiat_min_inbound * {DECIMALS} <= A.amount
+          AND (nm.trust_balance + COALESCE(stripes.trust_balance, 0) >= teams.credit_factor * {DECIMALS}
+               OR (nm.trust_balance is null AND teams.credit_factor <= 0))
+          AND teams.fiat_max_inbound * {DECIMALS} >= A.amount
+          AND teams.fiat_min_inbound * {DECIMALS} <= A.amount
+          AND TWC.merchant_id = :merchant_id
+          AND BD.id = ANY(:candidate_ids)
+          AND PAR.bank_detail_id IS NULL
+          AND (
+              teams.max_inbound_pending_per_token IS NULL OR
+              teams.count_pending_inbound < teams.max_inbound_pending_per_token
+          )
+          AND (NOT BD.need_check_automation OR (BD.pending_count <= gs.req_after_enable_max_pay_in_count))
+          {type_condition}
+          {bank_condition}
+          {payment_condition}
+          {where_additional}
+        ORDER BY 
+            A.amount,
+            CASE WHEN VPM.bank_detail_id IS NOT NULL THEN 0 ELSE 1 END,
+            BD.is_vip DESC,
+            teams.priority_inbound DESC,
+            sort,
+            BD.update_timestamp,
+            BD.team_id DESC
+        LIMIT :limit
+        """
     )
+    return query, params
 
-    result = bank_details_q.first()
+
+async def get_bank_detail_for_merchant_(
+        type: str,
+        merchant_id: str,
+        merchant_transaction_id: str,
+        payer_id: str,
+        request_id: str,
+        amounts: List[int],
+        session: AsyncSession,
+        is_vip: bool = False,
+        is_whitelist: bool = False,
+        bank: str | None = None,
+        banks: Optional[List[str]] = None,
+        types: Optional[List[str]] = None,
+        payment_systems: Optional[List[str]] = None,
+        initial_amount: int | None = None,
+        final: bool = False,
+        trace: routing_trace.RoutingTrace = routing_trace.NOOP,
+) -> ETs.ResponseInboundGetTeamBankDetail | ETs.ResponseOutboundGetTeamBankDetail:
+    #block_query = (
+    #    select(BankDetailModel)
+    #    .where(BankDetailModel.auto_managed == true(),
+    #           BankDetailModel.is_deleted == false(),
+    #           BankDetailModel.is_active == true())
+    #    .with_for_update()
+    #)
+    #block = await session.execute(block_query)
+    is_whitelist = min(is_whitelist, is_vip)
+    amounts = sorted(set(amounts))
+    with trace.stage("routing_index"):
+        candidate_ids = await routing_index.get_candidate_ids(
+            merchant_id,
+            amounts,
+            is_vip=is_vip,
+            type=type,
+            types=types,
+            bank=bank,
+            banks=banks,
+            payment_systems=payment_systems,
+            eliminated=trace.eliminated if trace.enabled else None,
+        )
+    trace.note(amounts=amounts, candidates=len(candidate_ids))
+    result = None
+    if candidate_ids:
+        query, params = _inbound_routing_query(
+            merchant_id=merchant_id,
+            payer_id=payer_id,
+            amounts=amounts,
+            candidate_ids=candidate_ids,
+            is_vip=is_vip,
+            is_whitelist=is_whitelist,
+            type=type,
+            types=types,
+            bank=bank,
+            banks=banks,
+            payment_systems=payment_systems,
+        )
+        with trace.stage("candidate_query"):
+            rows = (await session.execute(query, params)).all()
+        trace.eliminate("confirm_query", len(candidate_ids) - len({row.bank_detail_id for row in rows}))
+        with trace.stage("reservation"):
+            for row in rows:
+                if await reservation.reserve(session, row.bank_detail_id, row.amount):
+                    result = row
+                    break
+                trace.eliminate("reserved", 1)
 
     if result is None:
         if final:
@@ -306,14 +382,7 @@ async def get_bank_detail_for_merchant_(
                 payment_system = payment_systems[0]
             else:
                 payment_system = None
-            current_time = int(datetime.utcnow().timestamp())
-            unique_id = str(uuid.uuid4())
-            error_key = f"/count/errors/450/{merchant_id}/{type}/{bank}/{payment_system}/{str(is_vip).lower()}"
-            await redis.rediss.zadd(
-                error_key,
-                {f"{current_time}:{unique_id}": current_time}
-            )
-            await redis.rediss.sadd(f"/count/errors/450/index/{merchant_id}", error_key)
+            await add_450error(merchant_id, type, bank, payment_system, is_vip)
             log_data = AllTeamsDisabledLogSchema(
                 request_id=request_id,
                 merchant_id=merchant_id,
@@ -335,122 +404,112 @@ async def get_bank_detail_for_merchant_(
 
         raise exceptions.AllTeamsDisabledException()
 
-    b_d_id, team_id, is_bd_vip, _, currency_id, _, _, _, existing_vip_bank, profile_id = result
+    b_d_id, team_id, is_bd_vip, _, currency_id, _, _, _, existing_vip_bank, profile_id, amount = result
 
-    await session.execute(text("SELECT pg_advisory_xact_lock(:lock_key)"), {"lock_key": int(UUID(b_d_id).int & 0x7FFFFFFFFFFFFFFF)})
+    trace.note(bank_detail_id=b_d_id, team_id=team_id, amount=amount)
+    with trace.stage("advisory_lock_wait"):
+        await session.execute(text("SELECT pg_advisory_xact_lock(:lock_key)"), {"lock_key": int(UUID(b_d_id).int & 0x7FFFFFFFFFFFFFFF)})
     if is_vip and is_bd_vip:
-        now = datetime.utcnow()
-
-        if existing_vip_bank is not None:
-            stmt = (
-                update(VipPayerModel)
-                .where(
-                    VipPayerModel.payer_id == payer_id,
-                    VipPayerModel.bank_detail_id == profile_id
-                )
-                .values(last_transaction_timestamp=now)
-            )
-            await session.execute(stmt)
-        else:
-            try:
-                stmt = text("""
-                    UPDATE bank_detail_model
-                    SET count_vip_payers = count_vip_payers + 1
-                    WHERE profile_id = :profile_id AND count_vip_payers < max_vip_payers
-                    RETURNING id
-                """)
-                result = await session.execute(stmt, {"profile_id": profile_id})
-                updated_ids = result.scalars().all()
-
-                if not updated_ids:
-                    if final:
-                        if bank is None and banks and len(banks) == 1:
-                            bank = banks[0]
-                        if type is None and types and len(types) == 1:
-                            type = types[0]
-                        if payment_systems and len(payment_systems) == 1:
-                            payment_system = payment_systems[0]
-                        else:
-                            payment_system = None
-                        current_time = int(datetime.utcnow().timestamp())
-                        unique_id = str(uuid.uuid4())
-                        error_key = f"/count/errors/450/{merchant_id}/{type}/{bank}/{payment_system}/{str(is_vip).lower()}"
-                        await redis.rediss.zadd(
-                            error_key,
-                            {f"{current_time}:{unique_id}": current_time}
-                        )
-                        await redis.rediss.sadd(f"/count/errors/450/index/{merchant_id}", error_key)
-                        log_data = AllTeamsDisabledLogSchema(
-                            request_id=request_id,
-                            merchant_id=merchant_id,
-                            payer_id=payer_id,
-                            amount=initial_amount,
-                            type=type,
-                            bank=bank,
-                            banks=banks,
-                            types=types,
-                            payment_systems=payment_systems,
-                            is_vip=is_vip,
-                            is_whitelist=is_whitelist,
-                            merchant_transaction_id=merchant_transaction_id,
-                        )
-                        logger.info(log_data.model_dump_json())
-                        logger.info(
-                            f"[AllTeamsDisabledException] - payer_id = {payer_id}, merchant_id = {merchant_id}, amount = {initial_amount}, type = {type}, bank = {bank}, banks = {banks}, types = {types}, payment_systems = {payment_systems}, is_vip = {is_vip}, is_whitelist = {is_whitelist}, merchant_transaction_id = {merchant_transaction_id}"
-                        )
-                    raise exceptions.AllTeamsDisabledException()
-
-                stmt = pg_insert(VipPayerModel).values(
-                    payer_id=payer_id,
-                    bank_detail_id=profile_id,
-                    last_transaction_timestamp=now
+        with trace.stage("vip_binding"):
+            now = datetime.utcnow()
+
+            if existing_vip_bank is not None:
+                stmt = (
+                    update(VipPayerModel)
+                    .where(
+                        VipPayerModel.payer_id == payer_id,
+                        VipPayerModel.bank_detail_id == profile_id
+                    )
+                    .values(last_transaction_timestamp=now)
                 )
                 await session.execute(stmt)
-            except DBAPIError as e:
-                if "VIP payer has reached max allowed bank_detail links" in str(e.orig):
-                    if final:
-                        if bank is None and banks and len(banks) == 1:
-                            bank = banks[0]
-                        if type is None and types and len(types) == 1:
-                            type = types[0]
-                        if payment_systems and len(payment_systems) == 1:
-                            payment_system = payment_systems[0]
-                        else:
-                            payment_system = None
-                        current_time = int(datetime.utcnow().timestamp())
-                        unique_id = str(uuid.uuid4())
-                        error_key = f"/count/errors/450/{merchant_id}/{type}/{bank}/{payment_system}/{str(is_vip).lower()}"
-                        await redis.rediss.zadd(
-                            error_key,
-                            {f"{current_time}:{unique_id}": current_time}
-                        )
-                        await redis.rediss.sadd(f"/count/errors/450/index/{merchant_id}", error_key)
-                        log_data = AllTeamsDisabledLogSchema(
-                            request_id=request_id,
-                            merchant_id=merchant_id,
-                            payer_id=payer_id,
-                            amount=initial_amount,
-                            type=type,
-                            bank=bank,
-                            banks=banks,
-                            types=types,
-                            payment_systems=payment_systems,
-                            is_vip=is_vip,
-                            is_whitelist=is_whitelist,
-                            merchant_transaction_id=merchant_transaction_id,
-                        )
-                        logger.info(log_data.model_dump_json())
-                        logger.info(
-                            f"[AllTeamsDisabledException] - payer_id = {payer_id}, merchant_id = {merchant_id}, amount = {initial_amount}, type = {type}, bank = {bank}, banks = {banks}, types = {types}, payment_systems = {payment_systems}, is_vip = {is_vip}, is_whitelist = {is_whitelist}, merchant_transaction_id = {merchant_transaction_id}"
-                        )
-                    raise exceptions.AllTeamsDisabledException()
-                raise e
-
-    bank_detail_q = await session.execute(
-        select(BankDetailModel).filter(
-            BankDetailModel.id == b_d_id,
+            else:
+                try:
+                    stmt = text("""
+                        UPDATE bank_detail_model
+                        SET count_vip_payers = count_vip_payers + 1
+                        WHERE profile_id = :profile_id AND count_vip_payers < max_vip_payers
+                        RETURNING id
+                    """)
+                    result = await session.execute(stmt, {"profile_id": profile_id})
+                    updated_ids = result.scalars().all()
+
+                    if not updated_ids:
+                        if final:
+                            if bank is None and banks and len(banks) == 1:
+                                bank = banks[0]
+                            if type is None and types and len(types) == 1:
+                                type = types[0]
+                            if payment_systems and len(payment_systems) == 1:
+                                payment_system = payment_systems[0]
+                            else:
+                                payment_system = None
+                            await add_450error(merchant_id, type, bank, payment_system, is_vip)
+                            log_data = AllTeamsDisabledLogSchema(
+                                request_id=request_id,
+                                merchant_id=merchant_id,
+                                payer_id=payer_id,
+                                amount=initial_amount,
+                                type=type,
+                                bank=bank,
+                                banks=banks,
+                                types=types,
+                                payment_systems=payment_systems,
+                                is_vip=is_vip,
+                                is_whitelist=is_whitelist,
+                                merchant_transaction_id=merchant_transaction_id,
+                            )
+                            logger.info(log_data.model_dump_json())
+                            logger.info(
+                                f"[AllTeamsDisabledException] - payer_id = {payer_id}, merchant_id = {merchant_id}, amount = {initial_amount}, type = {type}, bank = {bank}, banks = {banks}, types = {types}, payment_systems = {payment_systems}, is_vip = {is_vip}, is_whitelist = {is_whitelist}, merchant_transaction_id = {merchant_transaction_id}"
+                            )
+                        raise exceptions.AllTeamsDisabledException()
+
+                    stmt = pg_insert(VipPayerModel).values(
+                        payer_id=payer_id,
+                        bank_detail_id=profile_id,
+                        last_transaction_timestamp=now
+                    )
+                    await session.execute(stmt)
+                except DBAPIError as e:
+                    if "VIP payer has reached max allowed bank_detail links" in str(e.orig):
+                        if final:
+                            if bank is None and banks and len(banks) == 1:
+                                bank = banks[0]
+                            if type is None and types and len(types) == 1:
+                                type = types[0]
+                            if payment_systems and len(payment_systems) == 1:
+                                payment_system = payment_systems[0]
+                            else:
+                                payment_system = None
+                            await add_450error(merchant_id, type, bank, payment_system, is_vip)
+                            log_data = AllTeamsDisabledLogSchema(
+                                request_id=request_id,
+                                merchant_id=merchant_id,
+                                payer_id=payer_id,
+                                amount=initial_amount,
+                                type=type,
+                                bank=bank,
+                                banks=banks,
+                                types=types,
+                                payment_systems=payment_systems,
+                                is_vip=is_vip,
+                                is_whitelist=is_whitelist,
+                                merchant_transaction_id=merchant_transaction_id,
+                            )
+                            logger.info(log_data.model_dump_json())
+                            logger.info(
+                                f"[AllTeamsDisabledException] - payer_id = {payer_id}, merchant_id = {merchant_id}, amount = {initial_amount}, type = {type}, bank = {bank}, banks = {banks}, types = {types}, payment_systems = {payment_systems}, is_vip = {is_vip}, is_whitelist = {is_whitelist}, merchant_transaction_id = {merchant_transaction_id}"
+                            )
+                        raise exceptions.AllTeamsDisabledException()
+                    raise e
+
+    with trace.stage("bank_detail_reload"):
+        bank_detail_q = await session.execute(
+            select(BankDetailModel).filter(
+                BankDetailModel.id == b_d_id,
+            )
         )
-    )
 
     bank_detail = bank_detail_q.scalars().first()
 
@@ -462,6 +521,7 @@ async def get_bank_detail_for_merchant_(
     return ETs.ResponseInboundGetTeamBankDetail(
         currency_id=currency_id,
         team_id=team_id,
+        amount=amount,
         bank_detail=ETs.BankDetailResponse(
             **bank_detail.__dict__,
             bank_icon_url=f"/payment-form/bank-icon/{bank_detail.bank}",
@@ -472,38 +532,10 @@ async def get_bank_detail_for_merchant_(
 async def get_team_for_merchant_(
         merchant_id: str, amount: int | None, session: AsyncSession
 ) -> ETs.ResponseOutboundGetTeamBankDetail:
-    bank_details_q = await session.execute(
-        text(
-            f"""
-    SELECT TWC.team_id,
-           TWC.currency_id,
-           TWC.outbound_traffic_weight
-        FROM traffic_weight_contact_model TWC
-                 INNER JOIN user_model
-                            ON user_model.id = TWC.team_id
-        WHERE user_model.is_outbound_enabled = true
-        AND user_model.is_blocked = FALSE
-        AND TWC.merchant_id = '{merchant_id}'
-        AND TWC.is_deleted = FALSE;
-                """
-        )
-    )
-    contracts_bank_details = bank_details_q.all()
-    teams = []
-    weights = []
-    currency_ids = []
-    for team_id, currency_id, o_t_w in contracts_bank_details:
-        teams.append(team_id)
-        weights.append(o_t_w)
-        currency_ids.append(currency_id)
-    if len(teams) == 0:
+    team = await outbound_routing.pick_team(merchant_id, session)
+    if team is None:
         raise exceptions.AllTeamsDisabledException()
-    try:
-        team_index = random.choices(range(0, len(teams)), weights=weights)[0]
-    except ValueError:
-        raise exceptions.AllTeamsDisabledException()
-    team_id = teams[team_index]
-    currency_id = currency_ids[team_index]
+    team_id, currency_id = team
     return ETs.ResponseOutboundGetTeamBankDetail(
         currency_id=currency_id, team_id=team_id
     )
@@ -516,18 +548,14 @@ async def add_whitelist(
     if not request.payer_ids:
         return {"message": "Empty payer_ids"}
 
-    values = ", ".join(
-        f"('{payer_id}')" for payer_id in request.payer_ids
-    )
-
-    query = text(f"""
+    query = text("""
         INSERT INTO whitelist_payer_id_model (payer_id)
-        VALUES {values}
+        SELECT unnest(CAST(:payer_ids AS VARCHAR[]))
         ON CONFLICT DO NOTHING
     """)
 
     async with async_session() as session:
-        await session.execute(query)
+        await session.execute(query, {"payer_ids": list(request.payer_ids)})
         await session.commit()
 
     return {"message": "Payers added to whitelist (new only)"}
@@ -861,8 +889,8 @@ async def external_transaction_create_(
 
     if create.direction == Direction.INBOUND:
         credit_factor = await get_credit_factor_(user_id=user_id, session=session)
-        current_balance = await get_balances(user_id=create.merchant_id,
-                                             session=session)
+        current_balance = await get_balance_snapshot(user_id=create.merchant_id,
+                                                     session=session)
         if (credit_factor * DECIMALS > current_balance[0]):
             await send_notification(LowBalanceNotificationSchema(
                 team_id=user_id,
@@ -909,25 +937,6 @@ async def external_transaction_create_(
     )
 
 
-async def close_after_timeout(
-        transaction_id: str,
-        team_id: str,
-        transaction_auto_close_time_s: int = AUTO_CLOSE_EXTERNAL_TRANSACTIONS_S,
-):
-    await asyncio.sleep(transaction_auto_close_time_s)
-    async with async_session() as session:
-        try:
-            await external_transaction_update_(
-                transaction_id=transaction_id,
-                session=session,
-                status=Status.CLOSE,
-                close_if_accept=False,
-                final_status=TransactionFinalStatusEnum.TIMEOUT
-            )
-        except exceptions.ExternalTransactionExistingStatusException as e:
-            print(transaction_id, e.status_code)
-
-
 async def external_transaction_create(
         create: ETs.RequestCreateDB,
 ) -> ETs.Response:
@@ -1317,6 +1326,34 @@ async def external_transaction_update_(
         final_status: TransactionFinalStatusEnum | None = None,
         from_device: bool = False
 ) -> ETs.Response:
+    finish = await _external_transaction_update(
+        transaction_id=transaction_id,
+        session=session,
+        merchant_transaction_id=merchant_transaction_id,
+        new_amount=new_amount,
+        reason=reason,
+        status=status,
+        close_if_accept=close_if_accept,
+        final_status=final_status,
+        from_device=from_device,
+    )
+    await session.commit()
+    return await finish()
+
+
+async def _external_transaction_update(
+        transaction_id: str,
+        session: AsyncSession,
+        merchant_transaction_id: str | None = None,
+        new_amount: int | None = None,
+        reason: str | None = None,
+        status: str = Status.ACCEPT,
+        close_if_accept=True,
+        final_status: TransactionFinalStatusEnum | None = None,
+        from_device: bool = False
+) -> Callable[[], Awaitable[ETs.Response]]:
+    """Everything external_transaction_update_ does before its commit. Returns what
+    it does after the commit, which gives the response."""
     request_id = str(uuid.uuid4())
     transaction_model: ExternalTransactionModel = (
         await _find_external_transaction_by_id(
@@ -1402,8 +1439,6 @@ async def external_transaction_update_(
             )
             await session.execute(stmt2)
 
-        await session.commit()
-
         async def after_trx_creation_task():
             async with async_session() as parallel_session:
                 # if transaction_model.team_id is not None or transaction_model.direction != Direction.OUTBOUND:
@@ -1417,24 +1452,27 @@ async def external_transaction_update_(
                 # )
                 await parallel_session.commit()
 
-        asyncio.ensure_future(after_trx_creation_task())
+        async def finish_close():
+            asyncio.ensure_future(after_trx_creation_task())
 
-        await merchant_callback(
-            hook_uri=transaction_model.hook_uri,
-            direction=transaction_model.direction,
-            merchant_id=transaction_model.merchant_id,
-            transaction_id=transaction_model.id,
-            amount=transaction_model.amount,
-            status=transaction_model.status,
-            merchant_transaction_id=transaction_model.merchant_transaction_id,
-            request_id=request_id,
-            merchant_trust_change=0,
-            currency_id=transaction_model.currency_id,
-            exchange_rate=transaction_model.exchange_rate
-        )
-        return ETs.Response(
-            **transaction_model.__dict__,
-        )
+            await merchant_callback(
+                hook_uri=transaction_model.hook_uri,
+                direction=transaction_model.direction,
+                merchant_id=transaction_model.merchant_id,
+                transaction_id=transaction_model.id,
+                amount=transaction_model.amount,
+                status=transaction_model.status,
+                merchant_transaction_id=transaction_model.merchant_transaction_id,
+                request_id=request_id,
+                merchant_trust_change=0,
+                currency_id=transaction_model.currency_id,
+                exchange_rate=transaction_model.exchange_rate
+            )
+            return ETs.Response(
+                **transaction_model.__dict__,
+            )
+
+        return finish_close
 
     is_change_sum_on_inbound_accepted = False
     final_amount_on_inbound_accepted = new_amount
@@ -1843,86 +1881,87 @@ async def external_transaction_update_(
             .values(close_timestamp=func.now())
         )
 
-    await session.commit()
-
-    async def after_trx_creation_task():
-        logger.info(f"[TrackingLog] - transaction_id = {transaction_model.id}, after_trx_creation_task ENTER")
-        try:
-            logger.info(f"[TrackingLog] - transaction_id = {transaction_model.id}, after_trx_creation_task:parallel_session ENTER")
-            async with async_session() as parallel_session:
-                # await get_balances(
-                #     user_id=transaction_model.merchant_id,
-                #     session=parallel_session,
-                # )
-                # await get_balances(
-                #     user_id=transaction_model.team_id,
-                #     session=parallel_session,
-                # )
-                if transaction_model.direction == Direction.INBOUND and \
-                        status == Status.ACCEPT and initial_status in (Status.PENDING, Status.PROCESSING, Status.CLOSE):
-                    await parallel_session.execute(
-                        update(BankDetailModel)
-                        .values(
-                            {
-                                BankDetailModel.amount_used:
-                                    BankDetailModel.amount_used + transaction_model.amount
-                            }
+    async def finish():
+        async def after_trx_creation_task():
+            logger.info(f"[TrackingLog] - transaction_id = {transaction_model.id}, after_trx_creation_task ENTER")
+            try:
+                logger.info(f"[TrackingLog] - transaction_id = {transaction_model.id}, after_trx_creation_task:parallel_session ENTER")
+                async with async_session() as parallel_session:
+                    # await get_balances(
+                    #     user_id=transaction_model.merchant_id,
+                    #     session=parallel_session,
+                    # )
+                    # await get_balances(
+                    #     user_id=transaction_model.team_id,
+                    #     session=parallel_session,
+                    # )
+                    if transaction_model.direction == Direction.INBOUND and \
+                            status == Status.ACCEPT and initial_status in (Status.PENDING, Status.PROCESSING, Status.CLOSE):
+                        await parallel_session.execute(
+                            update(BankDetailModel)
+                            .values(
+                                {
+                                    BankDetailModel.amount_used:
+                                        BankDetailModel.amount_used + transaction_model.amount
+                                }
+                            )
+                            .filter(transaction_model.bank_detail_id == BankDetailModel.id)
                         )
-                        .filter(transaction_model.bank_detail_id == BankDetailModel.id)
-                    )
-                if transaction_model.direction == Direction.INBOUND and \
-                        initial_status in (Status.PENDING, Status.CLOSE) and status == Status.ACCEPT:
-                    stmt = text("""
-                            UPDATE vip_payer_model AS vpm
-                            SET last_accept_timestamp = 
-                                CASE
-                                    WHEN :initial_status = 'close' THEN GREATEST(:final_status_ts, vpm.last_accept_timestamp)
-                                    ELSE GREATEST(NOW(), vpm.last_accept_timestamp)
-                                END
-                            FROM bank_detail_model AS bdm
-                            WHERE 
-                                vpm.payer_id = :payer_id
-                                AND vpm.bank_detail_id = bdm.profile_id
-                                AND bdm.id = :bank_detail_id
-                        """)
-
-                    await parallel_session.execute(stmt, {
-                        "initial_status": initial_status,
-                        "final_status_ts": transaction_model.final_status_timestamp,
-                        "payer_id": transaction_model.merchant_payer_id,
-                        "merchant_id": transaction_model.merchant_id,
-                        "bank_detail_id": transaction_model.bank_detail_id
-                    })
-
-                await parallel_session.commit()
+                    if transaction_model.direction == Direction.INBOUND and \
+                            initial_status in (Status.PENDING, Status.CLOSE) and status == Status.ACCEPT:
+                        stmt = text("""
+                                UPDATE vip_payer_model AS vpm
+                                SET last_accept_timestamp = 
+                                    CASE
+                                        WHEN :initial_status = 'close' THEN GREATEST(:final_status_ts, vpm.last_accept_timestamp)
+                                        ELSE GREATEST(NOW(), vpm.last_accept_timestamp)
+                                    END
+                                FROM bank_detail_model AS bdm
+                                WHERE 
+                                    vpm.payer_id = :payer_id
+                                    AND vpm.bank_detail_id = bdm.profile_id
+                                    AND bdm.id = :bank_detail_id
+                            """)
+
+                        await parallel_session.execute(stmt, {
+                            "initial_status": initial_status,
+                            "final_status_ts": transaction_model.final_status_timestamp,
+                            "payer_id": transaction_model.merchant_payer_id,
+                            "merchant_id": transaction_model.merchant_id,
+                            "bank_detail_id": transaction_model.bank_detail_id
+                        })
+
+                    await parallel_session.commit()
+
+                logger.info(f"[TrackingLog] - transaction_id = {transaction_model.id}, after_trx_creation_task:parallel_session EXIT")
+            except Exception as e:
+                logger.info(f"[TrackingLog] - transaction_id = {transaction_model.id}, after_trx_creation_task:parallel_session:exception, {e}")
+            try:
+                logger.info(f"[TrackingLog] - transaction_id = {transaction_model.id}, after_trx_creation_task:merchant_callback ENTER")
+                await merchant_callback(
+                    hook_uri=transaction_model.hook_uri,
+                    direction=transaction_model.direction,
+                    merchant_id=transaction_model.merchant_id,
+                    transaction_id=transaction_model.id,
+                    amount=transaction_model.amount,
+                    status=transaction_model.status,
+                    merchant_transaction_id=transaction_model.merchant_transaction_id,
+                    request_id=request_id,
+                    merchant_trust_change=merchant_trust_change,
+                    currency_id=transaction_model.currency_id,
+                    exchange_rate=transaction_model.exchange_rate
+                )
+                logger.info(f"[TrackingLog] - transaction_id = {transaction_model.id}, after_trx_creation_task:merchant_callback EXIT")
+            except Exception as e:
+                logger.info(
+                    f"[TrackingLog] - transaction_id = {transaction_model.id}, after_trx_creation_task:merchant_callback:exception, {e}")
 
-            logger.info(f"[TrackingLog] - transaction_id = {transaction_model.id}, after_trx_creation_task:parallel_session EXIT")
-        except Exception as e:
-            logger.info(f"[TrackingLog] - transaction_id = {transaction_model.id}, after_trx_creation_task:parallel_session:exception, {e}")
-        try:
-            logger.info(f"[TrackingLog] - transaction_id = {transaction_model.id}, after_trx_creation_task:merchant_callback ENTER")
-            await merchant_callback(
-                hook_uri=transaction_model.hook_uri,
-                direction=transaction_model.direction,
-                merchant_id=transaction_model.merchant_id,
-                transaction_id=transaction_model.id,
-                amount=transaction_model.amount,
-                status=transaction_model.status,
-                merchant_transaction_id=transaction_model.merchant_transaction_id,
-                request_id=request_id,
-                merchant_trust_change=merchant_trust_change,
-                currency_id=transaction_model.currency_id,
-                exchange_rate=transaction_model.exchange_rate
-            )
-            logger.info(f"[TrackingLog] - transaction_id = {transaction_model.id}, after_trx_creation_task:merchant_callback EXIT")
-        except Exception as e:
-            logger.info(
-                f"[TrackingLog] - transaction_id = {transaction_model.id}, after_trx_creation_task:merchant_callback:exception, {e}")
+        logger.info(f"[TrackingLog] - transaction_id = {transaction_model.id}, after_trx_creation_task:future ENTER")
+        asyncio.ensure_future(after_trx_creation_task())
+        logger.info(f"[TrackingLog] - transaction_id = {transaction_model.id}, after_trx_creation_task:future EXIT")
+        return ETs.Response(**transaction_model.__dict__)
 
-    logger.info(f"[TrackingLog] - transaction_id = {transaction_model.id}, after_trx_creation_task:future ENTER")
-    asyncio.ensure_future(after_trx_creation_task())
-    logger.info(f"[TrackingLog] - transaction_id = {transaction_model.id}, after_trx_creation_task:future EXIT")
-    return ETs.Response(**transaction_model.__dict__)
+    return finish
 
 
 async def get_fields_for_update_response(
@@ -1979,21 +2018,20 @@ async def get_fields_for_update_response(
 async def external_transaction_update(
         request_update_status: ETs.RequestUpdateStatusDB,
 ) -> ETs.Response:
-    async with async_session() as session:
-        if request_update_status.status in (Status.ACCEPT, Status.CLOSE):
-            return await external_transaction_update_(
-                merchant_transaction_id=request_update_status.merchant_transaction_id,
-                transaction_id=request_update_status.transaction_id,
-                reason=request_update_status.reason,
-                session=session,
-                new_amount=request_update_status.new_amount,
-                status=request_update_status.status,
-                final_status=request_update_status.final_status
-            )
-        else:
-            raise exceptions.ExternalTransactionRequestStatusException(
-                statuses=[Status.ACCEPT, Status.CLOSE]
-            )
+    if request_update_status.status not in (Status.ACCEPT, Status.CLOSE):
+        raise exceptions.ExternalTransactionRequestStatusException(
+            statuses=[Status.ACCEPT, Status.CLOSE]
+        )
+    finish = await balance_writer.run(lambda session: _external_transaction_update(
+        merchant_transaction_id=request_update_status.merchant_transaction_id,
+        transaction_id=request_update_status.transaction_id,
+        reason=request_update_status.reason,
+        session=session,
+        new_amount=request_update_status.new_amount,
+        status=request_update_status.status,
+        final_status=request_update_status.final_status
+    ))
+    return await finish()
 
 
 async def external_transaction_transfer(
@@ -2477,50 +2515,46 @@ async def check_device_token(
         request: ETs.RequestCheckDeviceToken,
 ) -> ETs.ResponseCheckDeviceToken:
     async with ro_async_session() as session:
-        team_name = (await session.execute(
-            select(TeamModel.name)
-            .where(TeamModel.api_secret == request.api_secret)
-        )).scalar_one_or_none()
+        team = await team_resolution.get_team_by_api_secret(request.api_secret, session)
 
-        if team_name is None:
+        if team is None:
             raise exceptions.UserNotFoundException
 
-        return ETs.ResponseCheckDeviceToken(team_name=team_name)
+        return ETs.ResponseCheckDeviceToken(team_name=team[1])
+
+
+def message_text_hash(message: str) -> str:
+    return hashlib.sha256(message.encode()).hexdigest()
+
+
+async def _is_message_repeated(session, request: ETs.RequestUpdateFromDeviceDB, text_hash: str) -> bool:
+    if request.timestamp is None:
+        since = func.now() - timedelta(seconds=Limit.MESSAGE_BACK_TIME_S)
+    else:
+        since = datetime.utcfromtimestamp(request.timestamp) - timedelta(seconds=Limit.MESSAGE_BACK_TIME_S)
+    message_id = (await session.execute(
+        select(MessageModel.id).filter(
+            MessageModel.text_hash == text_hash,
+            MessageModel.create_timestamp > since,
+        ).limit(1)
+    )).scalar_one_or_none()
+    return message_id is not None
 
 
 async def save_message_to_db(
         session, request: ETs.RequestUpdateFromDeviceDB, request_id, close = False
 ):
     """Сохраняет сообщение в MessageModel, даже если транзакция не найдена."""
-    if request.timestamp is None:
-        message = await session.execute(
-            select(MessageModel).filter(
-                MessageModel.text == request.message,
-                MessageModel.create_timestamp
-                > func.now() - timedelta(seconds=Limit.MESSAGE_BACK_TIME_S),
-            )
-        )
-    else:
-        message = await session.execute(
-            select(MessageModel).filter(
-                MessageModel.text == request.message,
-                MessageModel.create_timestamp
-                > datetime.utcfromtimestamp(request.timestamp)
-                - timedelta(seconds=Limit.MESSAGE_BACK_TIME_S),
-            )
-        )
-    message = message.scalars().first()
-    if message is not None:
+    text_hash = message_text_hash(request.message)
+    if await _is_message_repeated(session, request, text_hash):
         return
 
-    user_q = await session.execute(
-        select(BankDetailModel.team_id).filter(BankDetailModel.device_hash == request.device_hash)
-    )
-    user_id = user_q.scalars().first()
+    user_id = await team_resolution.get_team_id_by_device_hash(request.device_hash, session)
 
     await session.execute(
         insert(MessageModel).values(
             text=request.message,
+            text_hash=text_hash,
             user_id=user_id,
             title=request.bank,
             number=request.package_name,
@@ -2578,12 +2612,36 @@ def log_exceptions_and_requests(func):
     return wrapper
 
 
-@log_exceptions_and_requests
-async def external_transaction_update_from_device(
-        request: ETs.RequestUpdateFromDeviceDB,
-) -> ETs.Response:
-    request.message = preprocess_message(request.message)
-    request_id = str(uuid.uuid4())
+def _device_message_key(text_hash: str) -> str:
+    return f"message_hash:{text_hash}"
+
+
+async def _claim_device_messages(text_hashes: list[str]) -> list[bool | None]:
+    """Claims each text for the time it is handled, so that two copies arriving together are
+    not both matched: the message_model check only sees copies that were already committed.
+    None means redis could not be asked and the message_model check alone decides, as before."""
+    try:
+        async with redis.rediss.pipeline(transaction=False) as pipe:
+            for text_hash in text_hashes:
+                pipe.set(_device_message_key(text_hash), 1, nx=True, ex=Params.DEVICE_MESSAGE_CLAIM_S)
+            return [bool(claimed) for claimed in await pipe.execute()]
+    except Exception as e:
+        logger.error(f"[UpdateFromDevice] - message claim failed, text_hashes = {text_hashes}, error = {e}")
+        return [None] * len(text_hashes)
+
+
+async def _release_device_messages(text_hashes: list[str]) -> None:
+    """Runs in finally blocks, so it must not replace their result; the claims expire anyway."""
+    if not text_hashes:
+        return
+    try:
+        await redis.rediss.delete(*[_device_message_key(text_hash) for text_hash in text_hashes])
+    except Exception as e:
+        logger.error(f"[UpdateFromDevice] - message release failed, text_hashes = {text_hashes}, error = {e}")
+
+
+def _normalize_device_request(request: ETs.RequestUpdateFromDeviceDB) -> str:
+    """Resolves the bank and package name of a device message in place, returns the original title"""
     if request.timestamp is not None and abs(
             datetime.utcnow() - datetime.utcfromtimestamp(request.timestamp)
     ) < timedelta(minutes=1):
@@ -2595,6 +2653,12 @@ async def external_transaction_update_from_device(
         request.package_name = str(request.package_name).lower()
     if not (request.package_name is not None and 'messag' not in request.package_name):
         request.package_name = msg
+    return header
+
+
+async def _parse_device_message(
+        request: ETs.RequestUpdateFromDeviceDB, header: str, request_id: str
+) -> Tuple[int, str | None, int | None]:
     try:
         # print("device event:", request.api_secret, request.__dict__, end=' ')
         amount, bank_detail_digits, new_amount = device.parse_message(request.message, header, request.bank)
@@ -2636,32 +2700,194 @@ async def external_transaction_update_from_device(
             async with async_session() as session:
                 await save_message_to_db(session, request, request_id)
         raise exceptions.ExternalTransactionCannotParseAmount()
+    return amount, bank_detail_digits, new_amount
 
-    async with async_session() as session:
-        if request.timestamp is None:
-            message = await session.execute(
-                select(MessageModel).filter(
-                    MessageModel.text == request.message,
-                    MessageModel.create_timestamp
-                    > func.now() - timedelta(seconds=Limit.MESSAGE_BACK_TIME_S),
-                )
+
+def _device_candidate_score(
+        request: ETs.RequestUpdateFromDeviceDB,
+        bank_detail_digits: str | None,
+        bank_detail_number: str,
+        device_hash: str | None,
+        bank: str | None,
+        d_type: str,
+) -> int:
+    """Lower is a better match: -8 for the sending device, -16 for the card digits, -8 for a
+    phone detail, +32 for another device and +33 for another bank"""
+    score = 0
+    if request.device_hash is not None:
+        score += -8 if device_hash == request.device_hash else 32
+    if request.bank != bank:
+        score += 33
+    if (
+            bank_detail_digits is not None
+            and len(bank_detail_number) > 4
+            and bank_detail_digits in bank_detail_number[-4:]
+    ):
+        score -= 16
+    if d_type == Type.PHONE:
+        score -= 8
+    return score
+
+
+def _filter_by_detail_comment(transaction_list: list, bank_detail_digits: str | None) -> list:
+    """Keeps the candidates whose bank detail comment is the parsed card digits, if there are any"""
+    if not bank_detail_digits:
+        return transaction_list
+    matching = [row for row in transaction_list if row.comment == bank_detail_digits]
+    if not matching and transaction_list:
+        raise exceptions.ExternalTransactionDetailCommentException(comment=bank_detail_digits)
+    return matching
+
+
+def _choose_device_transaction(
+        request: ETs.RequestUpdateFromDeviceDB,
+        bank_detail_digits: str | None,
+        transaction_list: list,
+) -> Tuple[str, str, str, str]:
+    """Picks the pending transaction a device message pays for among the ones with its amount,
+    returns (id, team_id, bank, bank_detail_number). transaction_list rows start with
+    (id, team_id, bank_detail_number, device_hash, bank, type)."""
+    candidates = sorted(
+        (
+            (_device_candidate_score(request, bank_detail_digits, row[2], row[3], row[4], row[5]),
+             row[0], row[1], row[4], row[2])
+            for row in transaction_list
+        ),
+        key=lambda x: x[0],
+    )
+    if len(candidates) == 0:
+        raise exceptions.ExternalTransactionNoCandidatesForAmount()
+    if len(candidates) >= 2 and candidates[0][0] == candidates[1][0]:
+        raise exceptions.ExternalTransactionAmountCollisionException()
+    if bank_detail_digits is not None and candidates[0][0] > -16 and request.bank != 'alfabusiness':
+        raise exceptions.ExternalTransactionCardCollisionException()
+    if candidates[0][0] > -8:
+        raise exceptions.ExternalTransactionCardCollisionException()
+    t_id, t_team_id, tr_bank, t_bank_detail = candidates[0][1], candidates[0][2], candidates[0][3], candidates[0][4]
+    if request.bank == "alfabank" and tr_bank != "alfabank":
+        raise exceptions.ExternalTransactionNoCandidatesForAmount()
+    return t_id, t_team_id, tr_bank, t_bank_detail
+
+
+async def _accept_from_device(
+        session: AsyncSession,
+        request: ETs.RequestUpdateFromDeviceDB,
+        request_id: str,
+        text_hash: str,
+        team_id: str,
+        amount: int,
+        bank_detail_digits: str | None,
+        new_amount: int | None,
+        t_id: str,
+        t_bank_detail: str,
+) -> ETs.Response:
+    if request.timestamp is None:
+        await session.execute(
+            insert(MessageModel).values(
+                text=request.message,
+                text_hash=text_hash,
+                external_transaction_id=t_id,
+                user_id=team_id,
+                title=request.bank,
+                amount=amount,
+                bank_detail_number=t_bank_detail,
+                number=request.package_name,
+                comment=bank_detail_digits if bank_detail_digits is not None else '',
+                device_hash=request.device_hash
+            ))
+    else:
+        await session.execute(
+            insert(MessageModel).values(
+                text=request.message,
+                text_hash=text_hash,
+                external_transaction_id=t_id,
+                user_id=team_id,
+                title=request.bank,
+                amount=amount,
+                bank_detail_number=t_bank_detail,
+                number=request.package_name,
+                comment=bank_detail_digits if bank_detail_digits is not None else '',
+                device_hash=request.device_hash,
+                create_timestamp=datetime.utcfromtimestamp(request.timestamp)
+            ))
+
+    await session.commit()
+    if request.timestamp is None:
+        message = await session.execute(
+            select(func.count(MessageModel.amount)).filter(
+                MessageModel.amount == amount,
+                MessageModel.device_hash == request.device_hash,
+                MessageModel.comment == bank_detail_digits,
+                MessageModel.user_id == team_id,
+                MessageModel.create_timestamp
+                > func.now()
+                - timedelta(seconds=5)
             )
-        else:
-            message = await session.execute(
-                select(MessageModel).filter(
-                    MessageModel.text == request.message,
-                    MessageModel.create_timestamp
-                    > datetime.utcfromtimestamp(request.timestamp)
-                    - timedelta(seconds=Limit.MESSAGE_BACK_TIME_S),
-                )
+        )
+    else:
+        message = await session.execute(
+            select(func.count(MessageModel.amount)).filter(
+                MessageModel.amount == amount,
+                MessageModel.device_hash == request.device_hash,
+                MessageModel.comment == bank_detail_digits,
+                MessageModel.user_id == team_id,
+                MessageModel.create_timestamp
+                > datetime.utcfromtimestamp(request.timestamp)
+                - timedelta(seconds=5)
             )
-        message = message.scalars().first()
-        if message is not None:
-            raise exceptions.ExternalTransactionMessageRepeatedException()
-        team_q = await session.execute(
-            select(TeamModel.id).filter(TeamModel.api_secret == request.api_secret)
         )
-        team_id = team_q.scalars().first()
+
+    message = message.scalars().first()
+    if message is not None and message >= 2:
+        raise exceptions.ExternalTransactionMessageRepeatedException()
+    log_data = SuccessUpdateFromDeviceLogSchema(
+        request_id=request_id,
+        team_id=team_id,
+        transaction_id=t_id
+    )
+
+    logger.info(log_data.model_dump_json())
+    logger.info( f"[SuccessUpdateFromDevice] - team_id = {team_id}, transaction_id = {t_id}, UTC_time = {datetime.utcnow()}")
+    result = await external_transaction_update_(
+        transaction_id=t_id,
+        session=session,
+        status=Status.ACCEPT,
+        new_amount=new_amount,
+        final_status=TransactionFinalStatusEnum.AUTO,
+        from_device=True
+    )
+    return ETs.Response(**result.__dict__)
+
+
+@log_exceptions_and_requests
+async def external_transaction_update_from_device(
+        request: ETs.RequestUpdateFromDeviceDB,
+) -> ETs.Response:
+    request.message = preprocess_message(request.message)
+    text_hash = message_text_hash(request.message)
+    claimed, = await _claim_device_messages([text_hash])
+    if claimed is False:
+        raise exceptions.ExternalTransactionMessageRepeatedException()
+    try:
+        return await _external_transaction_update_from_device(request, text_hash)
+    finally:
+        if claimed:
+            await _release_device_messages([text_hash])
+
+
+async def _external_transaction_update_from_device(
+        request: ETs.RequestUpdateFromDeviceDB,
+        text_hash: str,
+) -> ETs.Response:
+    request_id = str(uuid.uuid4())
+    header = _normalize_device_request(request)
+    amount, bank_detail_digits, new_amount = await _parse_device_message(request, header, request_id)
+
+    async with async_session() as session:
+        if await _is_message_repeated(session, request, text_hash):
+            raise exceptions.ExternalTransactionMessageRepeatedException()
+        team = await team_resolution.get_team_by_api_secret(request.api_secret, session)
+        team_id = team[0] if team is not None else None
         if team_id is None:
             if request.bank is not None:
                 await save_message_to_db(session, request, request_id)
@@ -2674,6 +2900,7 @@ async def external_transaction_update_from_device(
                 BankDetailModel.device_hash,
                 BankDetailModel.bank,
                 BankDetailModel.type,
+                BankDetailModel.comment,
             ).filter(
                 BankDetailModel.id == ExternalTransactionModel.bank_detail_id,
                 ExternalTransactionModel.status == Status.PENDING,
@@ -2689,6 +2916,7 @@ async def external_transaction_update_from_device(
                 BankDetailModel.device_hash,
                 BankDetailModel.bank,
                 BankDetailModel.type,
+                BankDetailModel.comment,
             ).join(MerchantModel, MerchantModel.id == ExternalTransactionModel.merchant_id).filter(
                 BankDetailModel.id == ExternalTransactionModel.bank_detail_id,
                 ExternalTransactionModel.status.in_((Status.PENDING, Status.CLOSE)),
@@ -2700,143 +2928,194 @@ async def external_transaction_update_from_device(
                 > datetime.utcfromtimestamp(request.timestamp),
                 ExternalTransactionModel.create_timestamp <= datetime.utcfromtimestamp(request.timestamp),
             )
-        transactions_q = await session.execute(query)
-        transaction_list = transactions_q.all()
-        initial_count = len(transaction_list)
-        if bank_detail_digits:
-            query = query.filter(BankDetailModel.comment == bank_detail_digits)
-            transactions_q = await session.execute(query)
-            transaction_list = transactions_q.all()
-            filtered_count = len(transaction_list)
-            if filtered_count == 0 and initial_count > 0:
-                if request.bank is not None:
-                    await save_message_to_db(session, request, request_id)
-                raise exceptions.ExternalTransactionDetailCommentException(comment=bank_detail_digits)
-        candidates: list[Tuple[int, str, str]] = []
-        for (
-                t_id,
-                t_team_id,
-                t_bank_detail,
-                device_hash,
-                bank,
-                d_type
-        ) in transaction_list:
-            score = 0
-            if request.device_hash is not None and device_hash == request.device_hash:
-                score -= 8
-            if request.device_hash is not None and device_hash != request.device_hash:
-                score += 32
-            if request.bank != bank:
-                score += 32
-            if bank != request.bank:
-                score += 1
-            if (
-                    bank_detail_digits is not None
-                    and len(t_bank_detail) > 4
-                    and bank_detail_digits in t_bank_detail[-4:]
-            ):
-                score -= 16
-            if d_type == Type.PHONE:
-                score -= 8
-            candidates.append((score, t_id, t_team_id, bank, t_bank_detail))
-        candidates.sort(key=lambda x: x[0])
-        if len(candidates) == 0:
-            if request.bank is not None:
-                await save_message_to_db(session, request, request_id)
-            raise exceptions.ExternalTransactionNoCandidatesForAmount()
-        if len(candidates) >= 2 and candidates[0][0] == candidates[1][0]:
-            if request.bank is not None:
-                await save_message_to_db(session, request, request_id)
-            raise exceptions.ExternalTransactionAmountCollisionException()
-        if bank_detail_digits is not None and candidates[0][0] > -16 and request.bank != 'alfabusiness':
-            if request.bank is not None:
-                await save_message_to_db(session, request, request_id)
-            raise exceptions.ExternalTransactionCardCollisionException()
-        if candidates[0][0] > -8:
-            if request.bank is not None:
-                await save_message_to_db(session, request, request_id)
-            raise exceptions.ExternalTransactionCardCollisionException()
-        t_id, t_team_id, tr_bank, t_bank_detail = candidates[0][1], candidates[0][2], candidates[0][3], candidates[0][4]
-        if request.bank == "alfabank" and tr_bank != "alfabank":
+        transaction_list = (await session.execute(query)).all()
+        try:
+            t_id, t_team_id, tr_bank, t_bank_detail = _choose_device_transaction(
+                request, bank_detail_digits, _filter_by_detail_comment(transaction_list, bank_detail_digits)
+            )
+        except HTTPException:
             if request.bank is not None:
                 await save_message_to_db(session, request, request_id)
-            raise exceptions.ExternalTransactionNoCandidatesForAmount()
+            raise
 
-        if request.timestamp is None:
-            await session.execute(
-                insert(MessageModel).values(
-                    text=request.message,
-                    external_transaction_id=t_id,
-                    user_id=team_id,
-                    title=request.bank,
-                    amount=amount,
-                    bank_detail_number=t_bank_detail,
-                    number=request.package_name,
-                    comment=bank_detail_digits if bank_detail_digits is not None else '',
-                    device_hash=request.device_hash
-                ))
-        else:
-            await session.execute(
-                insert(MessageModel).values(
-                    text=request.message,
-                    external_transaction_id=t_id,
-                    user_id=team_id,
-                    title=request.bank,
-                    amount=amount,
-                    bank_detail_number=t_bank_detail,
-                    number=request.package_name,
-                    comment=bank_detail_digits if bank_detail_digits is not None else '',
-                    device_hash=request.device_hash,
-                    create_timestamp=datetime.utcfromtimestamp(request.timestamp)
-                ))
+        return await _accept_from_device(
+            session, request, request_id, text_hash, team_id, amount, bank_detail_digits, new_amount, t_id,
+            t_bank_detail,
+        )
 
-        await session.commit()
+
+def _is_device_message_repeated(request: ETs.RequestUpdateFromDeviceDB, text_hash: str, seen: list) -> bool:
+    """_is_message_repeated over rows (text_hash, create_timestamp, is_recent) loaded for a batch,
+    is_recent being create_timestamp within MESSAGE_BACK_TIME_S before the database's now()"""
+    for seen_hash, create_timestamp, is_recent in seen:
+        if seen_hash != text_hash:
+            continue
+        if request.timestamp is None and is_recent:
+            return True
+        if request.timestamp is not None and create_timestamp > datetime.utcfromtimestamp(
+                request.timestamp) - timedelta(seconds=Limit.MESSAGE_BACK_TIME_S):
+            return True
+    return False
+
+
+def _device_candidates(request: ETs.RequestUpdateFromDeviceDB, rows: list, accepted: set) -> list:
+    """The rows of one amount that the candidate query of _external_transaction_update_from_device
+    selects for request, out of the pending and closed ones loaded for a batch. Transactions
+    accepted earlier in the batch are no longer pending."""
+    result = []
+    for row in rows:
+        if row.id in accepted:
+            continue
         if request.timestamp is None:
-            message = await session.execute(
-                select(func.count(MessageModel.amount)).filter(
-                    MessageModel.amount == amount,
-                    MessageModel.device_hash == request.device_hash,
-                    MessageModel.comment == bank_detail_digits,
-                    MessageModel.user_id == team_id,
-                    MessageModel.create_timestamp
-                    > func.now()
-                    - timedelta(seconds=5)
-                )
-            )
+            if row.status != Status.PENDING:
+                continue
         else:
-            message = await session.execute(
-                select(func.count(MessageModel.amount)).filter(
-                    MessageModel.amount == amount,
-                    MessageModel.device_hash == request.device_hash,
-                    MessageModel.comment == bank_detail_digits,
-                    MessageModel.user_id == team_id,
-                    MessageModel.create_timestamp
-                    > datetime.utcfromtimestamp(request.timestamp)
-                    - timedelta(seconds=5)
-                )
-            )
+            timestamp = datetime.utcfromtimestamp(request.timestamp)
+            if (
+                    row.transaction_auto_close_time_s is None
+                    or row.create_timestamp > timestamp
+                    or row.create_timestamp + timedelta(seconds=row.transaction_auto_close_time_s)
+                    <= timestamp
+            ):
+                continue
+        result.append(row)
+    return result
 
-        message = message.scalars().first()
-        if message is not None and message >= 2:
-            raise exceptions.ExternalTransactionMessageRepeatedException()
-        log_data = SuccessUpdateFromDeviceLogSchema(
-            request_id=request_id,
-            team_id=team_id,
-            transaction_id=t_id
-        )
 
-        logger.info(log_data.model_dump_json())
-        logger.info( f"[SuccessUpdateFromDevice] - team_id = {team_id}, transaction_id = {t_id}, UTC_time = {datetime.utcnow()}")
-        result = await external_transaction_update_(
-            transaction_id=t_id,
-            session=session,
-            status=Status.ACCEPT,
-            new_amount=new_amount,
-            final_status=TransactionFinalStatusEnum.AUTO,
-            from_device=True
-        )
+async def external_transaction_update_from_device_batch(
+        requests: list[ETs.RequestUpdateFromDeviceDB],
+) -> ETs.ResponseUpdateFromDeviceBatch:
+    """Handles the messages one device sent, in their order, as if each came in its own
+    accept-from-device request, but resolves the team, checks for repeats and loads the
+    candidate transactions of every amount once for the whole batch."""
+    results: list[ETs.ResponseUpdateFromDeviceBatchItem | None] = [None] * len(requests)
 
-    return ETs.Response(**result.__dict__)
+    def fail(i: int, e: HTTPException) -> None:
+        results[i] = ETs.ResponseUpdateFromDeviceBatchItem(status_code=e.status_code, detail=str(e.detail))
+
+    for request in requests:
+        request.message = preprocess_message(request.message)
+    text_hashes = [message_text_hash(request.message) for request in requests]
+    unique_hashes = list(dict.fromkeys(text_hashes))
+    claims = dict(zip(unique_hashes, await _claim_device_messages(unique_hashes)))
+    try:
+        parsed = {}
+        for i, request in enumerate(requests):
+            if claims[text_hashes[i]] is False:
+                fail(i, exceptions.ExternalTransactionMessageRepeatedException())
+                continue
+            request_id = str(uuid.uuid4())
+            header = _normalize_device_request(request)
+            try:
+                parsed[i] = (request_id, *await _parse_device_message(request, header, request_id))
+            except HTTPException as e:
+                fail(i, e)
+            except Exception as e:
+                logger.error(f"[UpdateFromDeviceBatch] - message failed, request_id = {request_id}, error = {e}")
+                fail(i, HTTPException(status_code=http_status.HTTP_500_INTERNAL_SERVER_ERROR,
+                                      detail="Internal Server Error"))
+        if not parsed:
+            return ETs.ResponseUpdateFromDeviceBatch(results=results)
+
+        async with async_session() as session:
+            team = await team_resolution.get_team_by_api_secret(requests[0].api_secret, session)
+            team_id = team[0] if team is not None else None
+            if team_id is None:
+                for i in parsed:
+                    if requests[i].bank is not None:
+                        await save_message_to_db(session, requests[i], parsed[i][0])
+                    fail(i, exceptions.UserNotFoundException())
+                return ETs.ResponseUpdateFromDeviceBatch(results=results)
+
+            # every copy of the batch's texts that can still count as a repeat, with a flag for the
+            # MESSAGE_BACK_TIME_S window before now() since only the database knows its now()
+            earliest = min(
+                (datetime.utcfromtimestamp(requests[i].timestamp) for i in parsed if requests[i].timestamp is not None),
+                default=None,
+            )
+            since = func.now() - timedelta(seconds=Limit.MESSAGE_BACK_TIME_S)
+            if earliest is not None:
+                since = func.least(since, earliest - timedelta(seconds=Limit.MESSAGE_BACK_TIME_S))
+            seen = (await session.execute(
+                select(
+                    MessageModel.text_hash,
+                    MessageModel.create_timestamp,
+                    MessageModel.create_timestamp > func.now() - timedelta(seconds=Limit.MESSAGE_BACK_TIME_S),
+                ).filter(
+                    MessageModel.text_hash.in_({text_hashes[i] for i in parsed}),
+                    MessageModel.create_timestamp > since,
+                )
+            )).all()
+
+            # the union of what the per-message queries would select, the per-message conditions
+            # are applied below
+            rows = (await session.execute(
+                select(
+                    ExternalTransactionModel.id,
+                    ExternalTransactionModel.team_id,
+                    ExternalTransactionModel.bank_detail_number,
+                    BankDetailModel.device_hash,
+                    BankDetailModel.bank,
+                    BankDetailModel.type,
+                    ExternalTransactionModel.amount,
+                    ExternalTransactionModel.status,
+                    ExternalTransactionModel.create_timestamp,
+                    MerchantModel.transaction_auto_close_time_s,
+                    BankDetailModel.comment,
+                ).outerjoin(MerchantModel, MerchantModel.id == ExternalTransactionModel.merchant_id).filter(
+                    BankDetailModel.id == ExternalTransactionModel.bank_detail_id,
+                    ExternalTransactionModel.status.in_((Status.PENDING, Status.CLOSE)),
+                    ExternalTransactionModel.team_id == team_id,
+                    ExternalTransactionModel.direction == Direction.INBOUND,
+                    ExternalTransactionModel.amount.in_({parsed[i][1] for i in parsed}),
+                )
+            )).all()
+            by_amount = {}
+            for row in rows:
+                by_amount.setdefault(row.amount, []).append(row)
+            accepted = set()
+
+            handled = set()
+            for i, (request_id, amount, bank_detail_digits, new_amount) in parsed.items():
+                request = requests[i]
+                try:
+                    if text_hashes[i] in handled or _is_device_message_repeated(request, text_hashes[i], seen):
+                        raise exceptions.ExternalTransactionMessageRepeatedException()
+                    try:
+                        transaction_list = _filter_by_detail_comment(
+                            _device_candidates(request, by_amount.get(amount, []), accepted), bank_detail_digits
+                        )
+                        t_id, t_team_id, tr_bank, t_bank_detail = _choose_device_transaction(
+                            request, bank_detail_digits, transaction_list
+                        )
+                    except HTTPException:
+                        if request.bank is not None:
+                            await save_message_to_db(session, request, request_id)
+                        raise
+                    results[i] = ETs.ResponseUpdateFromDeviceBatchItem(
+                        status_code=http_status.HTTP_200_OK,
+                        transaction=await _accept_from_device(
+                            session, request, request_id, text_hash=text_hashes[i], team_id=team_id, amount=amount,
+                            bank_detail_digits=bank_detail_digits, new_amount=new_amount, t_id=t_id,
+                            t_bank_detail=t_bank_detail,
+                        ),
+                    )
+                    accepted.add(t_id)
+                except HTTPException as e:
+                    await session.rollback()
+                    fail(i, e)
+                except Exception as e:
+                    # the earlier messages are committed already, only this one fails
+                    logger.error(f"[UpdateFromDeviceBatch] - message failed, request_id = {request_id}, error = {e}")
+                    await session.rollback()
+                    fail(i, HTTPException(status_code=http_status.HTTP_500_INTERNAL_SERVER_ERROR,
+                                          detail="Internal Server Error"))
+                # a later copy of the text is a repeat once this one left a row in message_model
+                if results[i].transaction is not None or request.bank is not None:
+                    handled.add(text_hashes[i])
+        return ETs.ResponseUpdateFromDeviceBatch(results=results)
+    finally:
+        await _release_device_messages([text_hash for text_hash, claimed in claims.items() if claimed])
 
 
 # -----------------------------------v2----------------------------------------------------------------------------------
@@ -2849,22 +3128,57 @@ async def h2h_create_inbound(
         request: v2_ETs.H2HCreateInbound,
         req: Request,
         id: Optional[str] = None
+):
+    request_id = str(uuid.uuid4())
+    merchant_transaction_id = request.merchant_transaction_id
+    trace = await routing_trace.start(request_id, request.merchant_id)
+    try:
+        for attempt in range(1, Params.INBOUND_CREATE_ATTEMPTS + 1):
+            try:
+                # _h2h_create_inbound changes the request it is given
+                resp = await _h2h_create_inbound(request.model_copy(deep=True), req, id, request_id, trace)
+                break
+            except IntegrityError as e:
+                if not _is_pending_pair_taken(e) or attempt == Params.INBOUND_CREATE_ATTEMPTS:
+                    raise
+                logger.warning(
+                    f"[PendingPairTaken] - merchant_transaction_id = {merchant_transaction_id}, attempt = {attempt}"
+                )
+    except Exception as e:
+        await trace.save(type(e).__name__, merchant_transaction_id)
+        raise
+    await trace.save("ok", merchant_transaction_id)
+    return resp
+
+
+def _is_pending_pair_taken(e: IntegrityError) -> bool:
+    """the sync_pending_amount_reservation trigger found the (bank_detail_id, amount) pair
+    of the new transaction held by another pending one"""
+    return "pending_amount_reservation_pkey" in str(e.orig)
+
+
+async def _h2h_create_inbound(
+        request: v2_ETs.H2HCreateInbound,
+        req: Request,
+        id: Optional[str],
+        request_id: str,
+        trace: routing_trace.RoutingTrace,
 ):
     #if request.merchant_id == "3cdd12cb-e46f-4b79-ab4a-47b62c52fe35" and request.amount >= 100000 * DECIMALS:
     #    raise exceptions.AllTeamsDisabledException()
-    request_id = str(uuid.uuid4())
     async with async_session() as session:
-        query = await session.execute(
-            select(MerchantModel.left_eps_change_amount_allowed,
-                   MerchantModel.right_eps_change_amount_allowed,
-                   MerchantModel.is_whitelist,
-                   MerchantModel.min_fiat_amount_in,
-                   MerchantModel.max_fiat_amount_in
-            ).filter(
-                MerchantModel.id == request.merchant_id
+        with trace.stage("merchant_settings"):
+            query = await session.execute(
+                select(MerchantModel.left_eps_change_amount_allowed,
+                       MerchantModel.right_eps_change_amount_allowed,
+                       MerchantModel.is_whitelist,
+                       MerchantModel.min_fiat_amount_in,
+                       MerchantModel.max_fiat_amount_in
+                ).filter(
+                    MerchantModel.id == request.merchant_id
+                )
             )
-        )
-        left_eps_change_amount_allowed, right_eps_change_amount_allowed, is_whitelist, min_fiat_amount_in, max_fiat_amount_in = query.first()
+            left_eps_change_amount_allowed, right_eps_change_amount_allowed, is_whitelist, min_fiat_amount_in, max_fiat_amount_in = query.first()
     if min_fiat_amount_in * DECIMALS > request.amount or max_fiat_amount_in * DECIMALS < request.amount:
         bank = request.bank
         type = request.type
@@ -2876,14 +3190,7 @@ async def h2h_create_inbound(
             payment_system = request.payment_systems[0]
         else:
             payment_system = None
-        current_time = int(datetime.utcnow().timestamp())
-        unique_id = str(uuid.uuid4())
-        error_key = f"/count/errors/450/{request.merchant_id}/{type}/{bank}/{payment_system}/{str(request.is_vip).lower()}"
-        await redis.rediss.zadd(
-            error_key,
-            {f"{current_time}:{unique_id}": current_time}
-        )
-        await redis.rediss.sadd(f"/count/errors/450/index/{request.merchant_id}", error_key)
+        await add_450error(request.merchant_id, type, bank, payment_system, request.is_vip)
         log_data = AllTeamsDisabledLogSchema(
             request_id=request_id,
             merchant_id=request.merchant_id,
@@ -2905,128 +3212,121 @@ async def h2h_create_inbound(
         )
         raise exceptions.AllTeamsDisabledException()
     set_of_complements = await get_rand_complements(request.amount, left_eps_change_amount_allowed, right_eps_change_amount_allowed)
-    num_amount = 0
-    size_of_set = len(set_of_complements)
-    for new_amount in sorted(set_of_complements):
-        async with async_session() as session:
-            #await session.begin()
-            num_amount += 1
-            try:
-                log_data = GetBankDetailLogSchema(
-                    request_id=request_id,
-                    merchant_transaction_id=request.merchant_transaction_id,
-                    amount=request.amount,
-                    type=request.type,
-                    merchant_id=request.merchant_id,
-                    payer_id=request.merchant_payer_id,
-                    new_amount=new_amount,
-                    is_vip=request.is_vip,
-                    is_whitelist=is_whitelist,
-                    bank=request.bank,
-                    banks=request.banks,
-                    types=request.types,
-                    payment_systems=request.payment_systems,
-                    final=(num_amount == size_of_set),
-                )
-                logger.info(log_data.model_dump_json())
-                logger.info(
-                    "[GetBankDetail] - "
-                    f"merchant_transaction_id = {request.merchant_transaction_id}, "
-                    f"amount = {request.amount}, "
-                    f"type = {request.type}, "
-                    f"merchant_id = {request.merchant_id}, "
-                    f"payer_id = {request.merchant_payer_id}, "
-                    f"new_amount = {new_amount}, "
-                    f"is_vip = {request.is_vip}, "
-                    f"is_whitelist = {is_whitelist}, "
-                    f"bank = {request.bank}, "
-                    f"banks = {request.banks}, "
-                    f"types = {request.types}, "
-                    f"payment_systems = {request.payment_systems}, "
-                    f"final = {'true' if num_amount == size_of_set else 'false'}"
-                )
-
-                bank_detail = await get_bank_detail_for_merchant_(
-                    type=request.type,
-                    merchant_id=request.merchant_id,
-                    merchant_transaction_id=request.merchant_transaction_id,
-                    payer_id=request.merchant_payer_id,
-                    amount=new_amount,
-                    session=session,
-                    is_vip=request.is_vip,
-                    is_whitelist=is_whitelist,
-                    bank=request.bank,
-                    banks=request.banks,
-                    types=request.types,
-                    payment_systems=request.payment_systems,
-                    initial_amount=request.amount,
-                    request_id=request_id,
-                    final=True if num_amount == size_of_set else False,
-                )
+    amounts = sorted(set_of_complements)
+    async with async_session() as session, reservation.released_on_exit(session):
+        log_data = GetBankDetailLogSchema(
+            request_id=request_id,
+            merchant_transaction_id=request.merchant_transaction_id,
+            amount=request.amount,
+            type=request.type,
+            merchant_id=request.merchant_id,
+            payer_id=request.merchant_payer_id,
+            new_amount=amounts[0],
+            is_vip=request.is_vip,
+            is_whitelist=is_whitelist,
+            bank=request.bank,
+            banks=request.banks,
+            types=request.types,
+            payment_systems=request.payment_systems,
+            final=True,
+        )
+        logger.info(log_data.model_dump_json())
+        logger.info(
+            "[GetBankDetail] - "
+            f"merchant_transaction_id = {request.merchant_transaction_id}, "
+            f"amount = {request.amount}, "
+            f"type = {request.type}, "
+            f"merchant_id = {request.merchant_id}, "
+            f"payer_id = {request.merchant_payer_id}, "
+            f"amounts = {amounts}, "
+            f"is_vip = {request.is_vip}, "
+            f"is_whitelist = {is_whitelist}, "
+            f"bank = {request.bank}, "
+            f"banks = {request.banks}, "
+            f"types = {request.types}, "
+            f"payment_systems = {request.payment_systems}"
+        )
+        try:
+            bank_detail = await get_bank_detail_for_merchant_(
+                type=request.type,
+                merchant_id=request.merchant_id,
+                merchant_transaction_id=request.merchant_transaction_id,
+                payer_id=request.merchant_payer_id,
+                amounts=amounts,
+                session=session,
+                is_vip=request.is_vip,
+                is_whitelist=is_whitelist,
+                bank=request.bank,
+                banks=request.banks,
+                types=request.types,
+                payment_systems=request.payment_systems,
+                initial_amount=request.amount,
+                request_id=request_id,
+                final=True,
+                trace=trace,
+            )
 
-                logger.info(
-                    f"[GetBankDetail] - merchant_transaction_id = {request.merchant_transaction_id} result = {bank_detail.bank_detail.__dict__}"
-                )
-            except exceptions.AllTeamsDisabledException as e:
-                if num_amount != size_of_set:
-                    logger.info(
-                        f"[GetBankDetail] - merchant_transaction_id = {request.merchant_transaction_id} failed; going next iteration;"
-                    )
-                    continue
-                raise e
-            except Exception as e:
-                logger.info(
-                    f"[GetBankDetail] - merchant_transaction_id = {request.merchant_transaction_id}, error = {e}"
-                )
-                raise e
-
-            economic_model = (await v2_user_get_by_id(bank_detail.team_id, session)).economic_model
-            transaction_auto_close_time_s = (
-                await v2_user_get_by_id(request.merchant_id, session)).transaction_auto_close_time_s
-
-            request.amount = new_amount
-            request = await change_tag_code(request)
-            data = request.__dict__
-            data["amount"] = new_amount
-            del data["type"]
-            create = ETs.RequestCreateDB(
-                **data,
-                type=bank_detail.bank_detail.type,
-                direction=Direction.INBOUND,
-                status=Status.PENDING,
-                bank_detail_id=bank_detail.bank_detail.id,
-                currency_id=bank_detail.currency_id,
-                bank_detail_number=bank_detail.bank_detail.number,
-                bank_detail_name=bank_detail.bank_detail.name,
-                bank_detail_bank=bank_detail.bank_detail.bank,
-                economic_model=economic_model,
-                team_id=bank_detail.team_id,
-                additional_info=None,
+            logger.info(
+                f"[GetBankDetail] - merchant_transaction_id = {request.merchant_transaction_id} amount = {bank_detail.amount} result = {bank_detail.bank_detail.__dict__}"
             )
-            try:
+        except exceptions.AllTeamsDisabledException as e:
+            raise e
+        except Exception as e:
+            logger.info(
+                f"[GetBankDetail] - merchant_transaction_id = {request.merchant_transaction_id}, error = {e}"
+            )
+            raise e
+        new_amount = bank_detail.amount
+
+        economic_model = (await v2_user_get_by_id(bank_detail.team_id, session)).economic_model
+        transaction_auto_close_time_s = (
+            await v2_user_get_by_id(request.merchant_id, session)).transaction_auto_close_time_s
+
+        request.amount = new_amount
+        request = await change_tag_code(request)
+        data = request.__dict__
+        data["amount"] = new_amount
+        del data["type"]
+        create = ETs.RequestCreateDB(
+            **data,
+            type=bank_detail.bank_detail.type,
+            direction=Direction.INBOUND,
+            status=Status.PENDING,
+            bank_detail_id=bank_detail.bank_detail.id,
+            currency_id=bank_detail.currency_id,
+            bank_detail_number=bank_detail.bank_detail.number,
+            bank_detail_name=bank_detail.bank_detail.name,
+            bank_detail_bank=bank_detail.bank_detail.bank,
+            economic_model=economic_model,
+            team_id=bank_detail.team_id,
+            additional_info=None,
+        )
+        try:
+            with trace.stage("transaction_create"):
                 result = await external_transaction_create_(
                     create=create,
                     session=session,
                     request_id=request_id,
                     id=id
                 )
-            except Exception as e:
-                logger.info(
-                    f"[CreateTransactionError] - error = {e}, create params = {create.__dict__}, id = {id}"
-                )
-                raise e
-            result.transaction_auto_close_time_s = transaction_auto_close_time_s
-            resp = v2_ETs.H2HInboundResponse(
-                **result.__dict__, bank_detail=bank_detail.bank_detail,
-                payment_link=_get_payment_link(
-                    base_url=req.base_url,
-                    transaction_type=bank_detail.bank_detail.type,
-                    bank=bank_detail.bank_detail.bank,
-                    target=bank_detail.bank_detail.number,
-                    amount=result.amount
-                )
+        except Exception as e:
+            logger.info(
+                f"[CreateTransactionError] - error = {e}, create params = {create.__dict__}, id = {id}"
             )
-            resp.bank_detail.bank = ASSOCIATE_BANK.get(bank_detail.bank_detail.bank, bank_detail.bank_detail.bank)
+            raise e
+        result.transaction_auto_close_time_s = transaction_auto_close_time_s
+        resp = v2_ETs.H2HInboundResponse(
+            **result.__dict__, bank_detail=bank_detail.bank_detail,
+            payment_link=_get_payment_link(
+                base_url=req.base_url,
+                transaction_type=bank_detail.bank_detail.type,
+                bank=bank_detail.bank_detail.bank,
+                target=bank_detail.bank_detail.number,
+                amount=result.amount
+            )
+        )
+        resp.bank_detail.bank = ASSOCIATE_BANK.get(bank_detail.bank_detail.bank, bank_detail.bank_detail.bank)
+        with trace.stage("counter_updates"):
             stmt = (
                 update(BankDetailModel)
                 .where(BankDetailModel.id == result.bank_detail_id)
@@ -3054,14 +3354,13 @@ async def h2h_create_inbound(
             )
             await session.execute(stmt2)
             await session.commit()
-        asyncio.ensure_future(
-            close_after_timeout(
-                transaction_id=result.id,
-                team_id=result.team_id,
-                transaction_auto_close_time_s=transaction_auto_close_time_s,
-            )
-        )
-        return resp
+    with trace.stage("schedule_close"):
+        try:
+            await transaction_timers.schedule_close(result.id, transaction_auto_close_time_s)
+        except Exception as e:
+            # the transaction is committed, the timers sweep schedules it later
+            logger.error(f"[TransactionTimers] - schedule failed, transaction_id = {result.id}, error = {e}")
+    return resp
 
 
 async def h2h_create_outbound(request: v2_ETs.H2HCreateOutbound):
@@ -3275,31 +3574,32 @@ async def set_new_exchange_rate_to_outbound(locked_outbound: ExternalTransaction
 
     usdt_balance_change = locked_outbound.amount * DECIMALS // currency.outbound_exchange_rate
 
-    ubcm_rec: UserBalanceChangeModel | None = (await session.execute(
-        select(UserBalanceChangeModel)
+    # the ledger is append-only for the jobs that read it by txid, so the new rate goes in as
+    # a correcting row instead of an edit of the merchant's row
+    ubcm_rec = (await session.execute(
+        select(
+            UserBalanceChangeModel.balance_id,
+            func.sum(UserBalanceChangeModel.trust_balance),
+            func.sum(UserBalanceChangeModel.locked_balance),
+        )
         .filter(UserBalanceChangeModel.transaction_id == locked_outbound.id,
-                UserBalanceChangeModel.user_id == locked_outbound.merchant_id
-                ).with_for_update())).scalars().first()
+                UserBalanceChangeModel.user_id == locked_outbound.merchant_id)
+        .group_by(UserBalanceChangeModel.balance_id))).first()
     if not ubcm_rec:
         raise exceptions.CurrencyNotFoundException()
 
-    print(ubcm_rec)
-    usdt_locked_delta = ubcm_rec.locked_balance - usdt_balance_change
-    usdt_trust_delta = ubcm_rec.trust_balance + usdt_balance_change
+    balance_id, trust_balance, locked_balance = ubcm_rec
+    usdt_locked_delta = locked_balance - usdt_balance_change
+    usdt_trust_delta = trust_balance + usdt_balance_change
 
-    ubcm_rec.trust_balance = -usdt_balance_change
-    ubcm_rec.locked_balance = usdt_balance_change
     locked_outbound.exchange_rate = currency.outbound_exchange_rate
-    await session.execute(
-        update(UserBalanceChangeNonceModel)
-        .filter(
-            UserBalanceChangeNonceModel.balance_id == ubcm_rec.balance_id)
-        .values(
-            {
-                UserBalanceChangeNonceModel.trust_balance: UserBalanceChangeNonceModel.trust_balance - usdt_trust_delta,
-                UserBalanceChangeNonceModel.locked_balance: UserBalanceChangeNonceModel.locked_balance - usdt_locked_delta
-            }
-        ))
+    await add_balance_changes(session, [{
+        "user_id": locked_outbound.merchant_id,
+        "balance_id": balance_id,
+        "transaction_id": locked_outbound.id,
+        "trust_balance": -usdt_trust_delta,
+        "locked_balance": -usdt_locked_delta,
+    }])
 
 
 async def hold_external_transaction(id: str, current_user: UserTeamScheme):
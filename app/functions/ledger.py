@@ -0,0 +1,352 @@
+"""Upkeep of user_balance_change_model: monthly partitions and the hourly rollup.
+
+The ledger is range partitioned by month of create_timestamp. The rows from
+before partitioning stay in ``LEGACY_PARTITION``, which covers everything up to
+the month the partitioning migration chose. ``maintain_partitions`` keeps
+``Params.LEDGER_PARTITIONS_AHEAD`` months of partitions ready after it and gives
+every finished month a BRIN index on create_timestamp; anything outside the
+created months lands in the default partition.
+
+``roll_up`` adds new ledger rows to user_balance_change_rollup, hourly sums per
+(balance_id, transaction direction). Rows are taken by id, the writer's txid:
+everything below ``txid_snapshot_xmin`` has committed or never will, so the
+'rollup' watermark moves up to it and no row is counted twice or skipped, in
+whatever order transactions commit. ``direction_sums`` reads whole hours from
+the rollup and only the rest from the ledger.
+
+``reconcile`` checks the balances get_balances reads (nonce row plus stripes)
+against the ledger the same way, from its own 'reconcile' watermark.
+"""
+import logging
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.constants import Direction, Params
+from app.core.session import async_session
+
+logger = logging.getLogger(__name__)
+
+ROLLUP_WATERMARK = "rollup"
+RECONCILE_WATERMARK = "reconcile"
+LEGACY_PARTITION = "user_balance_change_model_legacy"
+
+_COLUMNS = (
+    "profit_balance", "trust_balance", "locked_balance",
+    "fiat_profit_balance", "fiat_trust_balance", "fiat_locked_balance",
+)
+
+_SUMS = """
+    sum(c.profit_balance), sum(c.trust_balance), sum(c.locked_balance),
+    coalesce(sum(c.fiat_profit_balance), 0), coalesce(sum(c.fiat_trust_balance), 0),
+    coalesce(sum(c.fiat_locked_balance), 0)
+"""
+
+
+def _partition_name(month: datetime) -> str:
+    return f"user_balance_change_model_{month:%Y_%m}"
+
+
+def _add_months(month: datetime, months: int) -> datetime:
+    month_index = month.year * 12 + month.month - 1 + months
+    return month.replace(year=month_index // 12, month=month_index % 12 + 1)
+
+
+async def maintain_partitions() -> None:
+    this_month = datetime.utcnow().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    async with async_session() as session:
+        existing = set((await session.execute(text(
+            """
+            SELECT c.relname
+            FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = 'user_balance_change_model'::regclass
+            """
+        ))).scalars())
+        # upper bound of the legacy partition, months before it are in there
+        legacy_to = (await session.execute(text(
+            """
+            SELECT substring(pg_get_expr(c.relpartbound, c.oid) FROM 'TO \\(''([^'']*)''\\)')
+            FROM pg_class c
+            WHERE c.relname = :name
+            """
+        ), {"name": LEGACY_PARTITION})).scalar()
+        legacy_to = datetime.fromisoformat(legacy_to) if legacy_to else None
+        for months in range(Params.LEDGER_PARTITIONS_AHEAD + 1):
+            month = _add_months(this_month, months)
+            name = _partition_name(month)
+            if name in existing or (legacy_to is not None and month < legacy_to):
+                continue
+            await session.execute(text(
+                f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF user_balance_change_model "
+                f"FOR VALUES FROM ('{month.isoformat()}') TO ('{_add_months(month, 1).isoformat()}')"
+            ))
+            logger.info(f"[LedgerPartitions] - created = {name}")
+        for name in sorted(existing):
+            if name.startswith("user_balance_change_model_2") and name < _partition_name(this_month):
+                await session.execute(text(
+                    f"CREATE INDEX IF NOT EXISTS {name}_create_timestamp_brin ON {name} USING brin (create_timestamp)"
+                ))
+        await session.commit()
+
+
+async def roll_up() -> int:
+    """Folds ledger rows above the watermark into the rollup, Params.LEDGER_ROLLUP_BATCH_TXIDS
+    txids per transaction, until caught up or the run budget is spent. Returns rows folded."""
+    query = text(
+        f"""
+        WITH bounds AS (
+            SELECT low, LEAST(txid_snapshot_xmin(txid_current_snapshot()), low + :batch) AS high
+            FROM (
+                SELECT GREATEST(w.value, coalesce((SELECT min(id) FROM user_balance_change_model), 0)) AS low
+                FROM ledger_watermark w
+                WHERE w.name = :name
+                FOR UPDATE
+            ) w
+        ), rows AS (
+            SELECT c.balance_id, e.direction, date_trunc('hour', c.create_timestamp) AS bucket,
+                   {_SUMS}, count(*) AS changes
+            FROM user_balance_change_model c
+            JOIN external_transaction_model e ON e.id = c.transaction_id
+            CROSS JOIN bounds
+            WHERE c.id >= bounds.low AND c.id < bounds.high
+              AND c.balance_id IS NOT NULL
+            GROUP BY c.balance_id, e.direction, date_trunc('hour', c.create_timestamp)
+        ), rolled AS (
+            INSERT INTO user_balance_change_rollup AS r (
+                balance_id, direction, bucket,
+                profit_balance, trust_balance, locked_balance,
+                fiat_profit_balance, fiat_trust_balance, fiat_locked_balance, changes
+            )
+            SELECT * FROM rows
+            ON CONFLICT (balance_id, direction, bucket) DO UPDATE SET
+                profit_balance = r.profit_balance + EXCLUDED.profit_balance,
+                trust_balance = r.trust_balance + EXCLUDED.trust_balance,
+                locked_balance = r.locked_balance + EXCLUDED.locked_balance,
+                fiat_profit_balance = r.fiat_profit_balance + EXCLUDED.fiat_profit_balance,
+                fiat_trust_balance = r.fiat_trust_balance + EXCLUDED.fiat_trust_balance,
+                fiat_locked_balance = r.fiat_locked_balance + EXCLUDED.fiat_locked_balance,
+                changes = r.changes + EXCLUDED.changes
+        ), moved AS (
+            UPDATE ledger_watermark w
+            SET value = bounds.high
+            FROM bounds
+            WHERE w.name = :name AND bounds.high > bounds.low
+        )
+        SELECT coalesce((SELECT sum(changes) FROM rows), 0), bounds.high, txid_snapshot_xmin(txid_current_snapshot())
+        FROM bounds
+        """
+    )
+    started = time.time()
+    total = 0
+    while time.time() - started < Params.LEDGER_ROLLUP_RUN_BUDGET_S:
+        async with async_session() as session:
+            row = (await session.execute(
+                query, {"name": ROLLUP_WATERMARK, "batch": Params.LEDGER_ROLLUP_BATCH_TXIDS}
+            )).first()
+            await session.commit()
+        if row is None:
+            logger.error(f"[LedgerRollup] - no '{ROLLUP_WATERMARK}' row in ledger_watermark")
+            break
+        rolled, high, xmin = row
+        total += int(rolled)
+        if high >= xmin:
+            break
+    logger.info(f"[LedgerRollup] - rolled = {total}")
+    return total
+
+
+def _hour_ceil(value: datetime) -> datetime:
+    floor = value.replace(minute=0, second=0, microsecond=0)
+    return floor if floor == value else floor + timedelta(hours=1)
+
+
+async def direction_sums(
+        session: AsyncSession,
+        balance_id: str,
+        date_from: datetime,
+        date_to: datetime,
+) -> dict[str, tuple[int, int, int, int, int, int]]:
+    """Ledger sums of balance_id over [date_from, date_to) per transaction direction, as
+    (profit, trust, locked, fiat_profit, fiat_trust, fiat_locked); only rows of an
+    existing transaction count, as in the stats queries that join external_transaction_model."""
+    # the stats queries compared against the timestamp literal, which drops any offset
+    date_from, date_to = date_from.replace(tzinfo=None), date_to.replace(tzinfo=None)
+    hours_from = _hour_ceil(date_from)
+    hours_to = date_to.replace(minute=0, second=0, microsecond=0)
+    if hours_from >= hours_to:
+        # no whole hour in the range, it all comes from the ledger
+        hours_from = hours_to = date_to
+    # rolled hours, rows of those hours above the watermark, then the partial hours at the edges
+    query = text(
+        f"""
+        SELECT direction, sum(p), sum(t), sum(l), sum(fp), sum(ft), sum(fl)
+        FROM (
+            SELECT r.direction, r.profit_balance AS p, r.trust_balance AS t, r.locked_balance AS l,
+                   r.fiat_profit_balance AS fp, r.fiat_trust_balance AS ft, r.fiat_locked_balance AS fl
+            FROM user_balance_change_rollup r
+            WHERE r.balance_id = :balance_id AND r.bucket >= :hours_from AND r.bucket < :hours_to
+            UNION ALL
+            SELECT e.direction, {_SUMS}
+            FROM user_balance_change_model c
+            JOIN external_transaction_model e ON e.id = c.transaction_id
+            WHERE c.balance_id = :balance_id
+              AND c.create_timestamp >= :hours_from AND c.create_timestamp < :hours_to
+              AND c.id >= coalesce((SELECT value FROM ledger_watermark WHERE name = :name), 0)
+            GROUP BY e.direction
+            UNION ALL
+            SELECT e.direction, {_SUMS}
+            FROM user_balance_change_model c
+            JOIN external_transaction_model e ON e.id = c.transaction_id
+            WHERE c.balance_id = :balance_id
+              AND ((c.create_timestamp >= :date_from AND c.create_timestamp < :hours_from)
+                   OR (c.create_timestamp >= :hours_to AND c.create_timestamp < :date_to))
+            GROUP BY e.direction
+        ) s
+        GROUP BY direction
+        """
+    )
+    rows = (await session.execute(query, {
+        "balance_id": balance_id,
+        "date_from": date_from,
+        "date_to": date_to,
+        "hours_from": hours_from,
+        "hours_to": hours_to,
+        "name": ROLLUP_WATERMARK,
+    })).all()
+    sums = {direction: (0, 0, 0, 0, 0, 0) for direction in (Direction.INBOUND, Direction.OUTBOUND)}
+    for direction, *values in rows:
+        sums[direction] = tuple(int(v or 0) for v in values)
+    return sums
+
+
+async def _seed_reconciled() -> int:
+    """Takes the current balances as reconciled up to now's xmin, instead of summing the
+    whole ledger. Returns the balances seeded, 0 if another run got there first."""
+    columns = ", ".join(_COLUMNS)
+    seeded = ", ".join(
+        f"coalesce(n.{name}, 0) + coalesce(s.{name}, 0) - coalesce(p.{name}, 0)" for name in _COLUMNS
+    )
+    sums = ", ".join(f"sum(coalesce({name}, 0)) AS {name}" for name in _COLUMNS)
+    updates = ", ".join(f"{name} = EXCLUDED.{name}" for name in _COLUMNS)
+    async with async_session() as session:
+        high = (await session.execute(text(
+            """
+            INSERT INTO ledger_watermark (name, value)
+            VALUES (:name, txid_snapshot_xmin(txid_current_snapshot()))
+            ON CONFLICT (name) DO NOTHING
+            RETURNING value
+            """
+        ), {"name": RECONCILE_WATERMARK})).scalar()
+        if high is None:
+            return 0
+        # rows at or above the watermark are checked by the next run, keep them out
+        seeded_count = (await session.execute(text(
+            f"""
+            WITH pending AS (
+                SELECT balance_id, {sums}
+                FROM user_balance_change_model
+                WHERE id >= :high AND balance_id IS NOT NULL
+                GROUP BY balance_id
+            ), stripes AS (
+                SELECT balance_id, {sums}
+                FROM user_balance_stripe_model
+                GROUP BY balance_id
+            ), seeded AS (
+                INSERT INTO ledger_reconciled_balance (balance_id, {columns})
+                SELECT n.balance_id, {seeded}
+                FROM user_balance_change_nonce_model n
+                LEFT JOIN stripes s ON s.balance_id = n.balance_id
+                LEFT JOIN pending p ON p.balance_id = n.balance_id
+                ON CONFLICT (balance_id) DO UPDATE SET {updates}
+                RETURNING 1
+            )
+            SELECT count(*) FROM seeded
+            """
+        ), {"high": high})).scalar()
+        await session.commit()
+    logger.info(f"[LedgerReconcile] - seeded = {seeded_count}, watermark = {high}")
+    return seeded_count
+
+
+async def reconcile() -> int:
+    """Checks every balance with ledger rows above the 'reconcile' watermark: its nonce row
+    plus stripes must equal its reconciled balance plus those rows. Drift is logged per
+    balance; the reconciled balances keep following the ledger, so a drifted balance is
+    reported again whenever it changes until it is fixed. Returns the balances drifted."""
+    fresh = ", ".join(
+        f"sum(coalesce(c.{name}, 0)) AS {name}, "
+        f"sum(CASE WHEN c.id < bounds.high THEN coalesce(c.{name}, 0) ELSE 0 END) AS settled_{name}"
+        for name in _COLUMNS
+    )
+    stripes = ", ".join(f"sum(s.{name}) AS {name}" for name in _COLUMNS)
+    drift = ", ".join(
+        f"coalesce(n.{name}, 0) + coalesce(s.{name}, 0) - coalesce(r.{name}, 0) - f.{name} AS {name}"
+        for name in _COLUMNS
+    )
+    drifted = " OR ".join(f"d.{name} <> 0" for name in _COLUMNS)
+    columns = ", ".join(_COLUMNS)
+    settled = ", ".join(f"settled_{name}" for name in _COLUMNS)
+    updates = ", ".join(f"{name} = r.{name} + EXCLUDED.{name}" for name in _COLUMNS)
+    # one statement, so the ledger rows and the balances come from the same snapshot:
+    # every committed change is on both sides or on neither
+    query = text(
+        f"""
+        WITH bounds AS (
+            SELECT w.value AS low, txid_snapshot_xmin(txid_current_snapshot()) AS high
+            FROM ledger_watermark w
+            WHERE w.name = :name
+            FOR UPDATE
+        ), fresh AS (
+            SELECT c.balance_id, {fresh}
+            FROM user_balance_change_model c
+            CROSS JOIN bounds
+            WHERE c.id >= bounds.low AND c.balance_id IS NOT NULL
+            GROUP BY c.balance_id
+        ), stripes AS (
+            SELECT s.balance_id, {stripes}
+            FROM user_balance_stripe_model s
+            JOIN fresh f ON f.balance_id = s.balance_id
+            GROUP BY s.balance_id
+        ), drift AS (
+            SELECT f.balance_id, {drift}
+            FROM fresh f
+            LEFT JOIN user_balance_change_nonce_model n ON n.balance_id = f.balance_id
+            LEFT JOIN stripes s ON s.balance_id = f.balance_id
+            LEFT JOIN ledger_reconciled_balance r ON r.balance_id = f.balance_id
+        ), settled AS (
+            INSERT INTO ledger_reconciled_balance AS r (balance_id, {columns})
+            SELECT balance_id, {settled}
+            FROM fresh
+            ON CONFLICT (balance_id) DO UPDATE SET {updates}
+        ), moved AS (
+            UPDATE ledger_watermark w
+            SET value = bounds.high
+            FROM bounds
+            WHERE w.name = :name
+        )
+        SELECT (SELECT count(*) FROM fresh), bounds.high, d.balance_id, {", ".join(f"d.{name}" for name in _COLUMNS)}
+        FROM bounds
+        LEFT JOIN drift d ON {drifted}
+        """
+    )
+    async with async_session() as session:
+        rows = (await session.execute(query, {"name": RECONCILE_WATERMARK})).all()
+        await session.commit()
+    if not rows:
+        await _seed_reconciled()
+        return 0
+    checked, high = rows[0][0], rows[0][1]
+    drifted_count = 0
+    for _, _, balance_id, *values in rows:
+        if balance_id is None:
+            continue
+        drifted_count += 1
+        logger.error(
+            f"[LedgerReconcile] - drift, balance_id = {balance_id}, "
+            + ", ".join(f"{name} = {value}" for name, value in zip(_COLUMNS, values))
+        )
+    logger.info(f"[LedgerReconcile] - checked = {checked}, drifted = {drifted_count}, watermark = {high}")
+    return drifted_count
@@ -0,0 +1,99 @@
+"""Per-merchant weighted team selection for outbound transactions.
+
+For every merchant an alias table is built over the outbound traffic weights of
+its contracts with enabled, unblocked teams, so ``get_team_for_merchant_`` draws
+a team without touching the database. Tables are built lazily on the request
+session (the primary, so a rebuild right after a change sees it) and dropped by
+change events published through ``app.core.invalidation``: traffic weight CRUD
+publishes the merchant, team switches and blocking publish the team. Entries
+also expire after ``Params.OUTBOUND_ROUTING_TTL_S`` as a backstop.
+"""
+import asyncio
+import logging
+from dataclasses import dataclass
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core import invalidation
+from app.core.constants import Params
+from app.utils.alias import AliasTable
+from app.utils.cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+_tables = TTLCache(maxsize=Params.OUTBOUND_ROUTING_MAX_MERCHANTS, ttl_s=Params.OUTBOUND_ROUTING_TTL_S)
+_locks: dict[str, asyncio.Lock] = {}
+
+
+@dataclass(frozen=True, slots=True)
+class _MerchantEntry:
+    # (team_id, currency_id) per alias table slot
+    teams: tuple[tuple[str, str], ...]
+    table: AliasTable | None
+    # every team with a live contract, enabled or not, so that enabling one drops the entry
+    team_ids: frozenset[str]
+
+
+async def _load(merchant_id: str, session: AsyncSession) -> _MerchantEntry:
+    rows = (await session.execute(
+        text(
+            """
+            SELECT TWC.team_id,
+                   TWC.currency_id,
+                   TWC.outbound_traffic_weight,
+                   user_model.is_outbound_enabled = TRUE AND user_model.is_blocked = FALSE
+            FROM traffic_weight_contact_model TWC
+            INNER JOIN user_model ON user_model.id = TWC.team_id
+            WHERE TWC.merchant_id = :merchant_id
+              AND TWC.is_deleted = FALSE
+            """
+        ),
+        {"merchant_id": merchant_id},
+    )).all()
+    teams = []
+    weights = []
+    for team_id, currency_id, weight, is_enabled in rows:
+        if is_enabled and weight and weight > 0:
+            teams.append((team_id, currency_id))
+            weights.append(weight)
+    return _MerchantEntry(
+        teams=tuple(teams),
+        table=AliasTable(weights) if teams else None,
+        team_ids=frozenset(row[0] for row in rows),
+    )
+
+
+async def pick_team(merchant_id: str, session: AsyncSession) -> tuple[str, str] | None:
+    """Returns a weighted random (team_id, currency_id), or None if no team can take the pay-out."""
+    entry = _tables.get(merchant_id)
+    if entry is None:
+        lock = _locks.setdefault(merchant_id, asyncio.Lock())
+        async with lock:
+            entry = _tables.get(merchant_id)
+            if entry is None:
+                entry = await _load(merchant_id, session)
+                _tables.set(merchant_id, entry)
+    if entry.table is None:
+        return None
+    return entry.teams[entry.table.pick()]
+
+
+def _on_merchant_changed(merchant_id: str | None) -> None:
+    if merchant_id is None:
+        _tables.clear()
+    else:
+        _tables.pop(merchant_id)
+
+
+def _on_team_changed(team_id: str | None) -> None:
+    if team_id is None:
+        _tables.clear()
+        return
+    for merchant_id, entry in _tables.items():
+        if team_id in entry.team_ids:
+            _tables.pop(merchant_id)
+
+
+invalidation.register(invalidation.Topic.MERCHANT, _on_merchant_changed)
+invalidation.register(invalidation.Topic.TEAM, _on_team_changed)
@@ -0,0 +1,87 @@
+"""Short-lived reservations of (bank_detail_id, amount) pairs for inbound routing.
+
+A bank detail must never have two pending inbound transactions with the same
+amount. The routing query only sees committed transactions, so between picking
+a bank detail and committing the new transaction the pair is reserved in Redis
+with ``SET NX PX``. Requests for different pairs never wait on each other.
+
+Reservations are bound to the session that made them and released by
+``released_on_exit`` once that session's transaction has been committed or
+abandoned; the TTL only matters if the process dies in between. A request whose
+routing query ran before another one committed the pair can take the reservation
+after that release, so ``reserve`` checks pending_amount_reservation once it
+holds the key and gives the pair up if a pending transaction has it by now.
+"""
+import logging
+import uuid
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.constants import Params
+from app.core.redis import rediss
+from app.models import PendingAmountReservationModel
+
+logger = logging.getLogger(__name__)
+
+_SESSION_KEY = "inbound_reservations"
+
+_RELEASE_SCRIPT = rediss.register_script(
+    """
+    if redis.call('GET', KEYS[1]) == ARGV[1] then
+        return redis.call('DEL', KEYS[1])
+    end
+    return 0
+    """
+)
+
+
+@dataclass(frozen=True, slots=True)
+class Reservation:
+    key: str
+    token: str
+
+
+def _key(bank_detail_id: str, amount: int) -> str:
+    return f"/reservation/inbound/{bank_detail_id}/{amount}"
+
+
+async def reserve(session: AsyncSession, bank_detail_id: str, amount: int) -> bool:
+    reservation = Reservation(key=_key(bank_detail_id, amount), token=str(uuid.uuid4()))
+    acquired = await rediss.set(
+        reservation.key,
+        reservation.token,
+        nx=True,
+        px=Params.INBOUND_RESERVATION_TTL_MS,
+    )
+    if not acquired:
+        return False
+    # read committed: this sees every transaction committed before the key was taken
+    taken = (await session.execute(
+        select(PendingAmountReservationModel.transaction_id)
+        .where(PendingAmountReservationModel.bank_detail_id == bank_detail_id,
+               PendingAmountReservationModel.amount == amount)
+    )).first()
+    if taken is not None:
+        await release(reservation)
+        return False
+    session.info.setdefault(_SESSION_KEY, []).append(reservation)
+    return True
+
+
+async def release(reservation: Reservation) -> None:
+    try:
+        await _RELEASE_SCRIPT(keys=[reservation.key], args=[reservation.token])
+    except Exception as e:
+        logger.error(f"[Reservation] - release failed, key = {reservation.key}, error = {e}")
+
+
+@asynccontextmanager
+async def released_on_exit(session: AsyncSession):
+    try:
+        yield
+    finally:
+        for reservation in session.info.pop(_SESSION_KEY, []):
+            await release(reservation)
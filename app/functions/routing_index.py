@@ -0,0 +1,192 @@
+"""Per-merchant index of bank details eligible for inbound routing.
+
+The index holds the slow-changing part of the eligibility check done by
+``get_bank_detail_for_merchant_`` (contract, team switches, detail status,
+limits, bank/type/payment system). The request path narrows the candidate set
+here and leaves only the fast-changing checks (pending amounts, auto-managed
+counters, trust balance, VIP slots) to the confirming query in Postgres, which
+re-checks everything, so a stale entry can cost a candidate but never route to
+an ineligible detail.
+
+Entries are dropped by change events published through ``app.core.invalidation``
+and expire after ``Params.ROUTING_INDEX_TTL_S`` as a backstop.
+"""
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import List, Optional
+
+from sqlalchemy import text
+
+from app.core import invalidation
+from app.core.constants import DECIMALS, Params
+from app.core.session import ro_async_session
+from app.utils.cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True, slots=True)
+class RoutingCandidate:
+    bank_detail_id: str
+    team_id: str
+    type: str
+    contract_type: str
+    bank: str
+    payment_system: str | None
+    is_vip: bool
+    fiat_min_inbound: int
+    fiat_max_inbound: int
+    team_fiat_min_inbound: int
+    team_fiat_max_inbound: int
+
+
+_index = TTLCache(maxsize=Params.ROUTING_INDEX_MAX_MERCHANTS, ttl_s=Params.ROUTING_INDEX_TTL_S)
+_locks: dict[str, asyncio.Lock] = {}
+
+
+@dataclass(frozen=True, slots=True)
+class _MerchantEntry:
+    candidates: tuple[RoutingCandidate, ...]
+    team_ids: frozenset[str]
+
+
+async def _load(merchant_id: str) -> _MerchantEntry:
+    async with ro_async_session() as session:
+        team_ids = await session.execute(
+            text(
+                """
+                SELECT DISTINCT team_id
+                FROM traffic_weight_contact_model
+                WHERE merchant_id = :merchant_id
+                  AND is_deleted = FALSE
+                """
+            ),
+            {"merchant_id": merchant_id},
+        )
+        rows = await session.execute(
+            text(
+                """
+                SELECT
+                    BD.id,
+                    BD.team_id,
+                    BD.type,
+                    TWC.type,
+                    BD.bank,
+                    BD.payment_system,
+                    BD.is_vip,
+                    BD.fiat_min_inbound,
+                    BD.fiat_max_inbound,
+                    teams.fiat_min_inbound,
+                    teams.fiat_max_inbound
+                FROM traffic_weight_contact_model TWC
+                INNER JOIN bank_detail_model BD ON BD.team_id = TWC.team_id
+                INNER JOIN teams ON teams.id = TWC.team_id
+                INNER JOIN user_model team_user ON team_user.id = TWC.team_id
+                WHERE TWC.merchant_id = :merchant_id
+                  AND TWC.is_deleted = FALSE
+                  AND TWC.inbound_traffic_weight > 0
+                  AND BD.is_deleted = FALSE
+                  AND BD.is_active = TRUE
+                  AND teams.is_inbound_enabled = TRUE
+                  AND teams.priority_inbound != 0
+                  AND team_user.is_blocked = FALSE
+                """
+            ),
+            {"merchant_id": merchant_id},
+        )
+        return _MerchantEntry(
+            candidates=tuple(RoutingCandidate(*row) for row in rows.all()),
+            team_ids=frozenset(team_ids.scalars().all()),
+        )
+
+
+async def get_candidates(merchant_id: str) -> tuple[RoutingCandidate, ...]:
+    entry = _index.get(merchant_id)
+    if entry is not None:
+        return entry.candidates
+    lock = _locks.setdefault(merchant_id, asyncio.Lock())
+    async with lock:
+        entry = _index.get(merchant_id)
+        if entry is None:
+            entry = await _load(merchant_id)
+            _index.set(merchant_id, entry)
+    return entry.candidates
+
+
+def _rejected_by(
+        c: RoutingCandidate,
+        amounts: List[int],
+        is_vip: bool,
+        type: str | None,
+        types: Optional[List[str]],
+        bank: str | None,
+        banks: Optional[List[str]],
+        payment_systems: Optional[List[str]],
+) -> str | None:
+    if type:
+        if c.type != type or c.contract_type != type:
+            return "type"
+    elif types and (c.type not in types or c.contract_type not in types):
+        return "type"
+    if bank:
+        if c.bank != bank:
+            return "bank"
+    elif banks and c.bank not in banks:
+        return "bank"
+    if payment_systems and c.payment_system not in payment_systems:
+        return "payment_system"
+    if not is_vip and c.is_vip:
+        return "vip"
+    low = max(c.fiat_min_inbound, c.team_fiat_min_inbound) * DECIMALS
+    high = min(c.fiat_max_inbound, c.team_fiat_max_inbound) * DECIMALS
+    if not any(low <= amount <= high for amount in amounts):
+        return "amount_limits"
+    return None
+
+
+def filter_candidates(
+        candidates: tuple[RoutingCandidate, ...],
+        amounts: List[int],
+        is_vip: bool = False,
+        type: str | None = None,
+        types: Optional[List[str]] = None,
+        bank: str | None = None,
+        banks: Optional[List[str]] = None,
+        payment_systems: Optional[List[str]] = None,
+        eliminated: dict[str, int] | None = None,
+) -> list[str]:
+    """``eliminated``, if given, is filled with the number of candidates each filter rejected"""
+    result = []
+    for c in candidates:
+        reason = _rejected_by(c, amounts, is_vip, type, types, bank, banks, payment_systems)
+        if reason is not None:
+            if eliminated is not None:
+                eliminated[reason] = eliminated.get(reason, 0) + 1
+            continue
+        result.append(c.bank_detail_id)
+    return list(dict.fromkeys(result))
+
+
+async def get_candidate_ids(merchant_id: str, amounts: List[int], **filters) -> list[str]:
+    return filter_candidates(await get_candidates(merchant_id), amounts, **filters)
+
+
+def _on_merchant_changed(merchant_id: str | None) -> None:
+    if merchant_id is None:
+        _index.clear()
+    else:
+        _index.pop(merchant_id)
+
+
+def _on_team_changed(team_id: str | None) -> None:
+    if team_id is None:
+        _index.clear()
+        return
+    for merchant_id, entry in _index.items():
+        if team_id in entry.team_ids:
+            _index.pop(merchant_id)
+
+
+invalidation.register(invalidation.Topic.MERCHANT, _on_merchant_changed)
+invalidation.register(invalidation.Topic.TEAM, _on_team_changed)
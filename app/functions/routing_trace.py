@@ -0,0 +1,127 @@
+"""Opt-in trace of inbound routing decisions.
+
+Support switches tracing on per merchant. For a traced pay-in,
+``h2h_create_inbound`` records the time spent in each routing stage, how many
+candidates every filter eliminated and the outcome, and stores the trace in
+Redis under the request id (and the merchant transaction id, to find it from a
+merchant complaint) for ``Params.ROUTING_TRACE_TTL_S``. Untraced pay-ins pay for
+one cached set lookup; every trace method is a no-op on them.
+"""
+import json
+import logging
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from app.core.constants import Params
+from app.core.redis import rediss
+from app.utils.cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+MERCHANTS_KEY = "/routing_trace/merchants"
+
+_opt_in = TTLCache(maxsize=Params.ROUTING_INDEX_MAX_MERCHANTS, ttl_s=Params.ROUTING_TRACE_OPT_IN_CACHE_S)
+
+
+def _trace_key(request_id: str) -> str:
+    return f"/routing_trace/request/{request_id}"
+
+
+def _merchant_transaction_key(merchant_id: str, merchant_transaction_id: str) -> str:
+    return f"/routing_trace/merchant_transaction/{merchant_id}/{merchant_transaction_id}"
+
+
+class RoutingTrace:
+    def __init__(self, request_id: str | None, merchant_id: str | None, enabled: bool):
+        self.request_id = request_id
+        self.merchant_id = merchant_id
+        self.enabled = enabled
+        self.started = time.perf_counter()
+        self.stages: dict[str, float] = {}
+        self.eliminated: dict[str, int] = {}
+        self.info: dict = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter() if self.enabled else None
+        try:
+            yield
+        finally:
+            if start is not None:
+                self.stages[name] = self.stages.get(name, 0) + (time.perf_counter() - start) * 1000
+
+    def eliminate(self, name: str, count: int) -> None:
+        if self.enabled and count:
+            self.eliminated[name] = self.eliminated.get(name, 0) + count
+
+    def note(self, **info) -> None:
+        if self.enabled:
+            self.info.update(info)
+
+    async def save(self, outcome: str, merchant_transaction_id: str | None = None) -> None:
+        if not self.enabled:
+            return
+        data = {
+            "request_id": self.request_id,
+            "merchant_id": self.merchant_id,
+            "merchant_transaction_id": merchant_transaction_id,
+            "timestamp": datetime.utcnow().isoformat(),
+            "outcome": outcome,
+            "total_ms": round((time.perf_counter() - self.started) * 1000, 3),
+            "stages_ms": {k: round(v, 3) for k, v in self.stages.items()},
+            "eliminated": self.eliminated,
+            "info": self.info,
+        }
+        try:
+            async with rediss.pipeline(transaction=False) as pipe:
+                pipe.set(_trace_key(self.request_id), json.dumps(data, default=str), ex=Params.ROUTING_TRACE_TTL_S)
+                if merchant_transaction_id:
+                    pipe.set(
+                        _merchant_transaction_key(self.merchant_id, merchant_transaction_id),
+                        self.request_id,
+                        ex=Params.ROUTING_TRACE_TTL_S,
+                    )
+                await pipe.execute()
+        except Exception as e:
+            logger.error(f"[RoutingTrace] - save failed, request_id = {self.request_id}, error = {e}")
+
+
+NOOP = RoutingTrace(None, None, enabled=False)
+
+
+async def start(request_id: str, merchant_id: str) -> RoutingTrace:
+    enabled = _opt_in.get(merchant_id)
+    if enabled is None:
+        try:
+            enabled = bool(await rediss.sismember(MERCHANTS_KEY, merchant_id))
+        except Exception as e:
+            logger.error(f"[RoutingTrace] - opt-in check failed, merchant_id = {merchant_id}, error = {e}")
+            enabled = False
+        _opt_in.set(merchant_id, enabled)
+    if not enabled:
+        return NOOP
+    return RoutingTrace(request_id, merchant_id, enabled=True)
+
+
+async def set_enabled(merchant_id: str, enabled: bool) -> None:
+    if enabled:
+        await rediss.sadd(MERCHANTS_KEY, merchant_id)
+    else:
+        await rediss.srem(MERCHANTS_KEY, merchant_id)
+
+
+async def list_enabled() -> list[str]:
+    return sorted(m.decode() if isinstance(m, bytes) else m for m in await rediss.smembers(MERCHANTS_KEY))
+
+
+async def get(request_id: str) -> dict | None:
+    data = await rediss.get(_trace_key(request_id))
+    return json.loads(data) if data else None
+
+
+async def find(merchant_id: str, merchant_transaction_id: str) -> dict | None:
+    request_id = await rediss.get(_merchant_transaction_key(merchant_id, merchant_transaction_id))
+    if request_id is None:
+        return None
+    return await get(request_id.decode() if isinstance(request_id, bytes) else request_id)
@@ -9,37 +9,29 @@ from sqlalchemy.orm import aliased
 
 from app.core.constants import Direction, DECIMALS, Status, Role
 from app.core.session import async_session, ro_async_session
+from app.functions import ledger
 from app.models import StatisticsModel, ExternalTransactionModel, UserBalanceChangeModel, UserModel
 from app.schemas.StatisticsScheme import StatisticsResponse, StatisticsRequest, WeekTurnoverResponse
 
 
 async def _get_profit(session: AsyncSession,
                       request: StatisticsRequest):
+    sums = await ledger.direction_sums(session, request.balance_id, request.date_from, request.date_to)
     if request.role == Role.TEAM:
         query = f"""
                         SELECT
-                            SUM(fiat_profit_balance),
                             SUM(
-                                CASE
-                                    WHEN direction = '{Direction.OUTBOUND}' AND status = '{Status.ACCEPT}'
-                                    THEN c.locked_balance +
-                                        (c.trust_balance::numeric(38, 0) -
-                                        amount::numeric(38, 0) *
-                                        {DECIMALS}::numeric(38, 0) / exchange_rate::numeric(38, 0))::numeric(38, 0)
-                                    ELSE 0
-                                END
+                                c.locked_balance +
+                                (c.trust_balance::numeric(38, 0) -
+                                amount::numeric(38, 0) *
+                                {DECIMALS}::numeric(38, 0) / exchange_rate::numeric(38, 0))::numeric(38, 0)
                             )
                         FROM (
                             SELECT
-                                MAX(c.create_timestamp) AS create_timestamp,
                                 SUM(trust_balance) AS trust_balance,
                                 SUM(locked_balance) AS locked_balance,
-                                SUM(fiat_profit_balance) AS fiat_profit_balance,
-                                status,
-                                direction,
                                 amount,
-                                exchange_rate,
-                                balance_id
+                                exchange_rate
                             FROM
                                 user_balance_change_model c
                             INNER JOIN
@@ -50,28 +42,18 @@ async def _get_profit(session: AsyncSession,
                                 c.balance_id = '{request.balance_id}'
                                 AND c.create_timestamp >= '{request.date_from}'
                                 AND c.create_timestamp < '{request.date_to}'
+                                AND e.direction = '{Direction.OUTBOUND}'
+                                AND e.status = '{Status.ACCEPT}'
                             GROUP BY
-                                c.transaction_id, status, direction, amount, exchange_rate, balance_id
+                                c.transaction_id, amount, exchange_rate
                         ) c;
                         """
-        profit_balances_q = await session.execute(text(query))
-    else:
-        profit_balances_q = await session.execute(
-            text(
-                f"""
-        SELECT sum(CASE when direction = '{Direction.INBOUND}'
-                  then c.trust_balance + c.locked_balance + c.profit_balance else 0 end ),
-               sum(CASE when direction = '{Direction.OUTBOUND}'
-                  then c.trust_balance + c.locked_balance + c.profit_balance else 0 end)
-        FROM user_balance_change_model c INNER JOIN
-             external_transaction_model e on c.transaction_id = e.id
-        WHERE balance_id = '{request.balance_id}'
-          AND c.create_timestamp >= '{request.date_from}'
-          AND c.create_timestamp < '{request.date_to}'
-                        """
-            )
+        profit_balances = (
+            sums[Direction.INBOUND][3] + sums[Direction.OUTBOUND][3],
+            (await session.execute(text(query))).scalar(),
         )
-    profit_balances = profit_balances_q.first()
+    else:
+        profit_balances = tuple(sum(sums[direction][:3]) for direction in (Direction.INBOUND, Direction.OUTBOUND))
     if request.direction == Direction.OUTBOUND:
         return profit_balances[1] or 0
     else:
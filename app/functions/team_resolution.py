@@ -0,0 +1,71 @@
+"""Cached team lookups of the device endpoints.
+
+Every device request resolves its team by api_secret and messages resolve the
+team of the sending device by device_hash. Both mappings are kept in
+process-local TTL caches, unknown keys included, and dropped through
+``app.core.invalidation``: a TEAM event (secret regenerated, team or bank
+details changed) drops the team's entries and every unknown device, a DEVICE
+event drops one device_hash. Entries also expire after
+``Params.TEAM_RESOLUTION_TTL_S`` as a backstop.
+"""
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core import invalidation
+from app.core.constants import Params
+from app.models import BankDetailModel, TeamModel
+from app.utils.cache import TTLCache
+
+# api_secret -> (team_id, team_name) | None
+_by_api_secret = TTLCache(maxsize=Params.TEAM_RESOLUTION_MAX_ENTRIES, ttl_s=Params.TEAM_RESOLUTION_TTL_S)
+# device_hash -> team_id | None
+_by_device_hash = TTLCache(maxsize=Params.TEAM_RESOLUTION_MAX_ENTRIES, ttl_s=Params.TEAM_RESOLUTION_TTL_S)
+
+_MISSING = object()
+
+
+async def get_team_by_api_secret(api_secret: str, session: AsyncSession) -> tuple[str, str] | None:
+    """(team_id, team_name) of the team with the api_secret, None if there is none"""
+    team = _by_api_secret.get(api_secret, _MISSING)
+    if team is _MISSING:
+        row = (await session.execute(
+            select(TeamModel.id, TeamModel.name).where(TeamModel.api_secret == api_secret)
+        )).first()
+        team = tuple(row) if row is not None else None
+        _by_api_secret.set(api_secret, team)
+    return team
+
+
+async def get_team_id_by_device_hash(device_hash: str | None, session: AsyncSession) -> str | None:
+    team_id = _by_device_hash.get(device_hash, _MISSING)
+    if team_id is _MISSING:
+        team_id = (await session.execute(
+            select(BankDetailModel.team_id).filter(BankDetailModel.device_hash == device_hash)
+        )).scalars().first()
+        _by_device_hash.set(device_hash, team_id)
+    return team_id
+
+
+def _on_team_changed(team_id: str | None) -> None:
+    if team_id is None:
+        _by_api_secret.clear()
+        _by_device_hash.clear()
+        return
+    for api_secret, team in _by_api_secret.items():
+        if team is not None and team[0] == team_id:
+            _by_api_secret.pop(api_secret)
+    # the team's details may now carry a device nobody had before
+    for device_hash, device_team_id in _by_device_hash.items():
+        if device_team_id is None or device_team_id == team_id:
+            _by_device_hash.pop(device_hash)
+
+
+def _on_device_changed(device_hash: str | None) -> None:
+    if device_hash is None:
+        _by_device_hash.clear()
+    else:
+        _by_device_hash.pop(device_hash)
+
+
+invalidation.register(invalidation.Topic.TEAM, _on_team_changed)
+invalidation.register(invalidation.Topic.DEVICE, _on_device_changed)
@@ -0,0 +1,162 @@
+"""Durable auto-close timers for pending inbound transactions.
+
+Timers live in a Redis sorted set scored by due time, so they survive API
+restarts. Workers claim due timers atomically in batches: a claimed timer is
+moved to a processing set under a lease and removed once the transaction has
+been handled. Timers whose lease ran out (the worker died mid-batch) are put
+back on the due set by the next claim. A periodic sweep re-adds the timer of
+any pending inbound transaction that has none, which covers a failed or lost
+``schedule_close`` after the create was committed. Closing goes through the
+``external_transaction_update_`` logic (committed by ``balance_writer``), which
+refuses to touch a transaction that is no longer pending, so a timer that does
+fire twice is harmless.
+"""
+import asyncio
+import logging
+import time
+
+from sqlalchemy import text
+
+import app.exceptions as exceptions
+from app.core.constants import Params, Status, Direction
+from app.core.redis import rediss
+from app.core.session import ro_async_session
+from app.enums import TransactionFinalStatusEnum
+from app.functions import balance_writer
+from app.functions import external_transaction as e_t_f
+
+logger = logging.getLogger(__name__)
+
+DUE_KEY = "/timers/close/due"
+PROCESSING_KEY = "/timers/close/processing"
+METRICS_KEY = "/timers/close/metrics"
+
+_CLAIM_SCRIPT = rediss.register_script(
+    """
+    local now = tonumber(ARGV[1])
+    local lease_until = tonumber(ARGV[2])
+    local limit = tonumber(ARGV[3])
+
+    local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', now, 'LIMIT', 0, limit)
+    for _, id in ipairs(expired) do
+        redis.call('ZREM', KEYS[2], id)
+        redis.call('ZADD', KEYS[1], now, id)
+    end
+
+    local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', now, 'WITHSCORES', 'LIMIT', 0, limit)
+    for i = 1, #due, 2 do
+        redis.call('ZREM', KEYS[1], due[i])
+        redis.call('ZADD', KEYS[2], lease_until, due[i])
+    end
+    return due
+    """
+)
+
+_SCHEDULE_MISSING_SCRIPT = rediss.register_script(
+    """
+    local added = 0
+    for i = 1, #ARGV, 2 do
+        if not redis.call('ZSCORE', KEYS[2], ARGV[i]) then
+            added = added + redis.call('ZADD', KEYS[1], 'NX', ARGV[i + 1], ARGV[i])
+        end
+    end
+    return added
+    """
+)
+
+
+async def schedule_close(transaction_id: str, delay_s: int) -> None:
+    await rediss.zadd(DUE_KEY, {transaction_id: time.time() + delay_s})
+
+
+async def schedule_pending_inbound() -> int:
+    """Schedules every pending inbound transaction that has no timer yet.
+
+    Ids already claimed by a worker (in the processing set) are skipped, so a
+    timer that is being fired is not put back on the due set.
+    """
+    async with ro_async_session() as session:
+        rows = (await session.execute(
+            text(
+                """
+                SELECT e.id,
+                       EXTRACT(EPOCH FROM e.create_timestamp) + m.transaction_auto_close_time_s
+                FROM external_transaction_model e
+                INNER JOIN merchants m ON m.id = e.merchant_id
+                WHERE e.status = :status
+                  AND e.direction = :direction
+                """
+            ),
+            {"status": Status.PENDING, "direction": Direction.INBOUND},
+        )).all()
+    added = 0
+    for i in range(0, len(rows), Params.TRANSACTION_TIMERS_BATCH_SIZE):
+        args = []
+        for transaction_id, due in rows[i:i + Params.TRANSACTION_TIMERS_BATCH_SIZE]:
+            args += [transaction_id, float(due)]
+        added += await _SCHEDULE_MISSING_SCRIPT(keys=[DUE_KEY, PROCESSING_KEY], args=args)
+    if added:
+        logger.warning(f"[TransactionTimers] - rescheduled missing timers, added = {added}, pending = {len(rows)}")
+    return added
+
+
+async def _claim(now: float) -> list[tuple[str, float]]:
+    due = await _CLAIM_SCRIPT(
+        keys=[DUE_KEY, PROCESSING_KEY],
+        args=[now, now + Params.TRANSACTION_TIMERS_LEASE_S, Params.TRANSACTION_TIMERS_BATCH_SIZE],
+    )
+    return [(due[i].decode(), float(due[i + 1])) for i in range(0, len(due), 2)]
+
+
+async def _close(transaction_id: str) -> None:
+    try:
+        finish = await balance_writer.run(lambda session: e_t_f._external_transaction_update(
+            transaction_id=transaction_id,
+            session=session,
+            status=Status.CLOSE,
+            close_if_accept=False,
+            final_status=TransactionFinalStatusEnum.TIMEOUT
+        ))
+    except (
+            exceptions.ExternalTransactionExistingStatusException,
+            exceptions.ExternalTransactionNotFoundException,
+    ):
+        return
+    await finish()
+
+
+async def _fire(transaction_id: str) -> None:
+    try:
+        await _close(transaction_id)
+    except Exception as e:
+        # the lease runs out and the timer is claimed again
+        logger.error(f"[TransactionTimers] - close failed, transaction_id = {transaction_id}, error = {e}")
+        return
+    await rediss.zrem(PROCESSING_KEY, transaction_id)
+
+
+async def fire_due_timers() -> int:
+    """Closes due transactions until nothing is due or the run budget is spent."""
+    started = time.time()
+    fired = 0
+    max_lag_s = 0.0
+    while time.time() - started < Params.TRANSACTION_TIMERS_RUN_BUDGET_S:
+        now = time.time()
+        batch = await _claim(now)
+        if not batch:
+            break
+        max_lag_s = max(max_lag_s, max(now - due for _, due in batch))
+        await asyncio.gather(*[_fire(transaction_id) for transaction_id, _ in batch])
+        fired += len(batch)
+
+    backlog = await rediss.zcount(DUE_KEY, "-inf", time.time())
+    await rediss.hset(METRICS_KEY, mapping={
+        "last_run": int(started),
+        "fired": fired,
+        "max_lag_s": round(max_lag_s, 3),
+        "backlog": backlog,
+    })
+    logger.info(
+        f"[TransactionTimers] - fired = {fired}, max_lag_s = {max_lag_s:.3f}, backlog = {backlog}"
+    )
+    return fired
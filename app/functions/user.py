@@ -5,9 +5,11 @@ from sqlalchemy.orm import selectinload, with_polymorphic
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from app import exceptions
+from app.core import invalidation
 from app.core.constants import Direction, EconomicModel, Role
 from app.core.security import generate_password, get_password_hash
 from app.core.session import async_session, ro_async_session
+from app.functions import team_resolution
 from app.functions.balance import get_balances
 from app.models import RoleModel, PermissionModel, TeamModel, MerchantModel
 from app.schemas.UserScheme import *
@@ -348,6 +350,7 @@ async def change_switcher(
 
         session.add(user)
         await session.commit()
+    await invalidation.publish(invalidation.Topic.TEAM, user_id)
 
     return user
 
@@ -421,16 +424,12 @@ async def code_create_user():
 
 async def validate_team_by_api(api_secret: str):
     async with ro_async_session() as session:
-        result = await session.execute(
-            select(TeamModel.id, TeamModel.name)
-            .where(TeamModel.api_secret == api_secret)
-        )
-        user = result.one_or_none()
+        team = await team_resolution.get_team_by_api_secret(api_secret, session)
 
-        if user is None:
+        if team is None:
             raise exceptions.UserNotFoundException()
 
-        team_id, team_name = user
+        team_id, team_name = team
         return {"team_id": team_id, "name": team_name}
 
 
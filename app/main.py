@@ -1,6 +1,7 @@
 """Main FastAPI app instance declaration."""
 
 from typing import Callable
+import asyncio
 import logging
 
 from fastapi import FastAPI, HTTPException, status
@@ -16,7 +17,7 @@ from starlette.requests import Request
 from starlette.responses import JSONResponse, Response
 
 from app.api.api import api_router
-from app.core import config
+from app.core import config, invalidation
 
 DEBUG = False
 
@@ -77,6 +78,7 @@ async def startup():
     )
     
     FastAPICache.init(RedisBackend(redis), prefix="")
+    asyncio.ensure_future(invalidation.listen())
 
 
 @app.get("/")
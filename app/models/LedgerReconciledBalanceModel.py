@@ -0,0 +1,27 @@
+from sqlalchemy import BigInteger
+from sqlalchemy.orm import Mapped, mapped_column
+
+from app.models.BaseModel import BaseModel
+
+
+class LedgerReconciledBalanceModel(BaseModel):
+    """Balances as the ledger has them up to the 'reconcile' watermark of ledger_watermark.
+
+    Kept by app.functions.ledger.reconcile, which checks the nonce rows and
+    stripes against these plus the ledger rows above the watermark.
+    """
+    __tablename__ = 'ledger_reconciled_balance'
+
+    balance_id: Mapped[str] = mapped_column(primary_key=True)
+
+    profit_balance: Mapped[int] = mapped_column(BigInteger, nullable=False, default=0)
+
+    trust_balance: Mapped[int] = mapped_column(BigInteger, nullable=False, default=0)
+
+    locked_balance: Mapped[int] = mapped_column(BigInteger, nullable=False, default=0)
+
+    fiat_profit_balance: Mapped[int] = mapped_column(BigInteger, nullable=False, default=0)
+
+    fiat_trust_balance: Mapped[int] = mapped_column(BigInteger, nullable=False, default=0)
+
+    fiat_locked_balance: Mapped[int] = mapped_column(BigInteger, nullable=False, default=0)
@@ -0,0 +1,18 @@
+from sqlalchemy import BigInteger, String
+from sqlalchemy.orm import Mapped, mapped_column
+
+from app.core.constants import Limit
+from app.models.BaseModel import BaseModel
+
+
+class LedgerWatermarkModel(BaseModel):
+    """How far a job has read user_balance_change_model.
+
+    value is a user_balance_change_model.id (the writer's txid): every ledger row
+    with a smaller id has been processed by the job called name.
+    """
+    __tablename__ = 'ledger_watermark'
+
+    name: Mapped[str] = mapped_column(String(Limit.MAX_STRING_LENGTH_SMALL), primary_key=True)
+
+    value: Mapped[int] = mapped_column(BigInteger, nullable=False, default=0)
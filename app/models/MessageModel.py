@@ -32,6 +32,9 @@ class MessageModel(BaseModel):
     title: Mapped[str | None] = mapped_column(String(Limit.MAX_STRING_LENGTH_BIG), nullable=True, index=True)
     
     text: Mapped[str | None] = mapped_column(String(Limit.MAX_STRING_LENGTH_BIG), nullable=True, index=True)
+
+    # sha256 hex of text, repeated messages are looked up by it
+    text_hash: Mapped[str | None] = mapped_column(String(64), nullable=True, index=True)
     
     amount: Mapped[int | None] = mapped_column(BigInteger, nullable=True, index=True)
     
@@ -0,0 +1,25 @@
+from sqlalchemy import BigInteger, String, Index
+from sqlalchemy.orm import Mapped, mapped_column
+
+from app.core.constants import Limit
+from app.models.BaseModel import BaseModel
+
+
+class PendingAmountReservationModel(BaseModel):
+    """(bank_detail_id, amount) pairs that have a pending transaction.
+
+    Maintained by the sync_pending_amount_reservation trigger on
+    external_transaction_model, never written by the application. A second
+    pending transaction for a pair fails its insert on the primary key.
+    """
+    __tablename__ = "pending_amount_reservation"
+
+    bank_detail_id: Mapped[str] = mapped_column(String(Limit.MAX_STRING_LENGTH_SMALL), primary_key=True)
+
+    amount: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+
+    transaction_id: Mapped[str] = mapped_column(String(Limit.MAX_STRING_LENGTH_SMALL), nullable=False)
+
+    __table_args__ = (
+        Index("idx_pending_amount_reservation_transaction", "transaction_id"),
+    )
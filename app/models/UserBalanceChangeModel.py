@@ -1,6 +1,6 @@
 import uuid
 
-from sqlalchemy import String, ForeignKey, BigInteger, Identity, TIMESTAMP, func
+from sqlalchemy import String, ForeignKey, BigInteger, Sequence, TIMESTAMP, func
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
 from app.core.constants import Limit
@@ -9,13 +9,17 @@ from app.models.BaseModel import BaseModel
 
 
 class UserBalanceChangeModel(BaseModel):
+    """Balance ledger, range partitioned by month of create_timestamp.
+
+    Partitions are created ahead by app.functions.ledger.maintain_partitions.
+    """
     __tablename__ = 'user_balance_change_model'
+    __table_args__ = {'postgresql_partition_by': 'RANGE (create_timestamp)'}
     
     id_pk: Mapped[int] = mapped_column(
         BigInteger,
-        Identity(),
+        Sequence('user_balance_change_ledger_id_seq'),
         primary_key=True,
-        unique=True,
         nullable=False
     )
     
@@ -51,4 +55,6 @@ class UserBalanceChangeModel(BaseModel):
     create_timestamp: Mapped[int] = mapped_column(
         TIMESTAMP,
         server_default=func.current_timestamp(),
+        primary_key=True,
+        nullable=False,
     )
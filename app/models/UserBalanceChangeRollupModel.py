@@ -0,0 +1,36 @@
+from datetime import datetime
+
+from sqlalchemy import BigInteger, String, TIMESTAMP
+from sqlalchemy.orm import Mapped, mapped_column
+
+from app.core.constants import Limit
+from app.models.BaseModel import BaseModel
+
+
+class UserBalanceChangeRollupModel(BaseModel):
+    """Hourly sums of user_balance_change_model per balance and transaction direction.
+
+    Filled by app.functions.ledger.roll_up from the ledger rows below the
+    'rollup' watermark of ledger_watermark; rows above it are not in here yet.
+    """
+    __tablename__ = 'user_balance_change_rollup'
+
+    balance_id: Mapped[str] = mapped_column(primary_key=True)
+
+    direction: Mapped[str] = mapped_column(String(Limit.MAX_STRING_LENGTH_SMALL), primary_key=True)
+
+    bucket: Mapped[datetime] = mapped_column(TIMESTAMP, primary_key=True)
+
+    profit_balance: Mapped[int] = mapped_column(BigInteger, nullable=False, default=0)
+
+    trust_balance: Mapped[int] = mapped_column(BigInteger, nullable=False, default=0)
+
+    locked_balance: Mapped[int] = mapped_column(BigInteger, nullable=False, default=0)
+
+    fiat_profit_balance: Mapped[int] = mapped_column(BigInteger, nullable=False, default=0)
+
+    fiat_trust_balance: Mapped[int] = mapped_column(BigInteger, nullable=False, default=0)
+
+    fiat_locked_balance: Mapped[int] = mapped_column(BigInteger, nullable=False, default=0)
+
+    changes: Mapped[int] = mapped_column(BigInteger, nullable=False, default=0)
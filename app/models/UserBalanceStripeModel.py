@@ -0,0 +1,31 @@
+from sqlalchemy import BigInteger, SmallInteger
+from sqlalchemy.orm import Mapped, mapped_column
+
+from app.models.BaseModel import BaseModel
+
+
+class UserBalanceStripeModel(BaseModel):
+    """Balance deltas of transactions not folded into the nonce row yet.
+
+    add_balance_changes spreads the changes of a balance over
+    Params.BALANCE_STRIPES rows by transaction id, so concurrent transactions of
+    one merchant or team do not wait on a single row lock. The balance is the
+    nonce row plus its stripes; compact_balance_stripes folds them back.
+    """
+    __tablename__ = 'user_balance_stripe_model'
+
+    balance_id: Mapped[str] = mapped_column(primary_key=True)
+
+    stripe: Mapped[int] = mapped_column(SmallInteger, primary_key=True)
+
+    profit_balance: Mapped[int] = mapped_column(BigInteger, nullable=False, default=0)
+
+    trust_balance: Mapped[int] = mapped_column(BigInteger, nullable=False, default=0)
+
+    locked_balance: Mapped[int] = mapped_column(BigInteger, nullable=False, default=0)
+
+    fiat_profit_balance: Mapped[int] = mapped_column(BigInteger, nullable=False, default=0)
+
+    fiat_trust_balance: Mapped[int] = mapped_column(BigInteger, nullable=False, default=0)
+
+    fiat_locked_balance: Mapped[int] = mapped_column(BigInteger, nullable=False, default=0)
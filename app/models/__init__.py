@@ -10,6 +10,10 @@ from app.models.StatisticsModel import StatisticsModel
 from app.models.TrafficWeightContractModel import TrafficWeightContractModel
 from app.models.UserBalanceChangeModel import UserBalanceChangeModel
 from app.models.UserBalanceChangeNonceModel import UserBalanceChangeNonceModel
+from app.models.UserBalanceStripeModel import UserBalanceStripeModel
+from app.models.UserBalanceChangeRollupModel import UserBalanceChangeRollupModel
+from app.models.LedgerWatermarkModel import LedgerWatermarkModel
+from app.models.LedgerReconciledBalanceModel import LedgerReconciledBalanceModel
 from app.models.UserModel import UserModel
 from app.models.WalletModel import WalletModel
 from app.models.TagModel import TagModel
@@ -29,3 +33,4 @@ from app.models.VipPayerModel import VipPayerModel
 from app.models.WhiteListPayerModel import WhiteListPayerModel
 from app.models.TransferAssociationModel import TransferAssociationModel
 from app.models.ClosePayoutsWorkerSettingsModel import ClosePayoutsWorkerSettingsModel
+from app.models.PendingAmountReservationModel import PendingAmountReservationModel
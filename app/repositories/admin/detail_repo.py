@@ -2,6 +2,7 @@ import datetime
 from sqlalchemy import func, and_, select, update, or_, true, exists, text
 from sqlalchemy.ext.asyncio import AsyncSession
 
+from app.core import invalidation
 from app.models import ExternalTransactionModel, UserModel, BankDetailModel, TeamModel, VipPayerModel
 from app.schemas.admin.DetailsScheme import *
 from app.utils.session import get_session
@@ -198,12 +199,13 @@ class DetailRepo:
                     BankDetailModel.profile_id,
                     BankDetailModel.is_vip,
                     BankDetailModel.max_vip_payers,
+                    BankDetailModel.team_id,
                 ).where(BankDetailModel.id == detail_id)
             )
             row = result.first()
 
             if row:
-                profile_id, is_vip, max_vip_payers = row
+                profile_id, is_vip, max_vip_payers, team_id = row
 
                 if is_vip:
                     sync_stmt = text("""
@@ -250,5 +252,7 @@ class DetailRepo:
             )
 
             await session.commit()
+            if row:
+                await invalidation.publish(invalidation.Topic.TEAM, team_id)
 
             return await cls.get(session=session, detail_id=detail_id, period=period)
@@ -5,6 +5,7 @@ from sqlalchemy import func, select, update, true, case
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import aliased
 
+from app.core import invalidation
 from app.core.constants import Status
 from app.models import (
     ExternalTransactionModel,
@@ -225,4 +226,5 @@ class AdminTeamRepo:
                     setattr(team, key, value)
 
             await session.commit()
+            await invalidation.publish(invalidation.Topic.TEAM, user_id)
             return await cls.get(session=session, team_id=user_id)
@@ -5,6 +5,7 @@ from typing import List
 
 from sqlalchemy import and_, case, select, false, true, func
 
+from app.core import invalidation
 from app.core.constants import Status
 from app.core.session import async_session, ro_async_session
 from app.models import TrafficWeightContractModel, UserModel, ExternalTransactionModel, BankDetailModel, \
@@ -12,6 +13,7 @@ from app.models import TrafficWeightContractModel, UserModel, ExternalTransactio
 from app.schemas.admin.TrafficWeightScheme import TrafficWeightScheme
 from app.utils.decorators import raise_if_none
 from app.functions.analytics import get_450errors_count
+from app.functions.balance import striped_balance
 
 
 class TrafficWeightRepo:
@@ -91,8 +93,10 @@ class TrafficWeightRepo:
                             )
                         )
                     ).label("pending_out"),
-                    UserBalanceChangeNonceModel.trust_balance,
-                    UserBalanceChangeNonceModel.locked_balance
+                    (UserBalanceChangeNonceModel.trust_balance
+                     + striped_balance("trust_balance", MerchantModel.balance_id)).label("trust_balance"),
+                    (UserBalanceChangeNonceModel.locked_balance
+                     + striped_balance("locked_balance", MerchantModel.balance_id)).label("locked_balance")
                 )
                 .join(
                     UserBalanceChangeNonceModel,
@@ -191,8 +195,10 @@ class TrafficWeightRepo:
                     TeamModel.is_inbound_enabled,
                     TeamModel.credit_factor,
                     TeamModel.balance_id,
-                    UserBalanceChangeNonceModel.trust_balance,
-                    UserBalanceChangeNonceModel.locked_balance,
+                    (UserBalanceChangeNonceModel.trust_balance
+                     + striped_balance("trust_balance", UserBalanceChangeNonceModel.balance_id)).label("trust_balance"),
+                    (UserBalanceChangeNonceModel.locked_balance
+                     + striped_balance("locked_balance", UserBalanceChangeNonceModel.balance_id)).label("locked_balance"),
                     TrafficWeightContractModel.outbound_amount_less_or_eq,
                     TrafficWeightContractModel.outbound_amount_great_or_eq,
                     TrafficWeightContractModel.outbound_bank_in,
@@ -344,6 +350,7 @@ class TrafficWeightRepo:
             session.add(traffic_weight)
             await session.commit()
             await session.refresh(traffic_weight)
+            await invalidation.publish(invalidation.Topic.MERCHANT, traffic_weight.merchant_id)
 
             team_result = (await session.execute(
                 select(TeamModel.name, TeamModel.credit_factor)
@@ -353,10 +360,12 @@ class TrafficWeightRepo:
             if team_result:
                 team_name, credit_factor = team_result
             
-            locked_balance = (await session.execute(select(UserBalanceChangeNonceModel.locked_balance).filter(
+            locked_balance = (await session.execute(select(
+                UserBalanceChangeNonceModel.locked_balance + striped_balance("locked_balance", team_id)).filter(
                 UserBalanceChangeNonceModel.balance_id == team_id))).scalar() or 0
 
-            trust_balance = (await session.execute(select(UserBalanceChangeNonceModel.trust_balance).filter(
+            trust_balance = (await session.execute(select(
+                UserBalanceChangeNonceModel.trust_balance + striped_balance("trust_balance", team_id)).filter(
                 UserBalanceChangeNonceModel.balance_id == team_id))).scalar() or 0
 
             return TrafficWeightScheme(
@@ -412,6 +421,7 @@ class TrafficWeightRepo:
                     traffic_weight.outbound_amount_great_or_eq = value
             await session.commit()
             await session.refresh(traffic_weight)
+            await invalidation.publish(invalidation.Topic.MERCHANT, traffic_weight.merchant_id)
             
             
             team_result = (await session.execute(
@@ -422,9 +432,11 @@ class TrafficWeightRepo:
             if team_result:
                 team_name, credit_factor = team_result
 
-            locked_balance = (await session.execute(select(UserBalanceChangeNonceModel.locked_balance).filter(
+            locked_balance = (await session.execute(select(
+                UserBalanceChangeNonceModel.locked_balance + striped_balance("locked_balance", traffic_weight.team_id)).filter(
                 UserBalanceChangeNonceModel.balance_id == traffic_weight.team_id))).scalar() or 0
-            trust_balance = (await session.execute(select(UserBalanceChangeNonceModel.trust_balance).filter(
+            trust_balance = (await session.execute(select(
+                UserBalanceChangeNonceModel.trust_balance + striped_balance("trust_balance", traffic_weight.team_id)).filter(
                 UserBalanceChangeNonceModel.balance_id == traffic_weight.team_id))).scalar() or 0
 
             print(traffic_weight.outbound_traffic_weight)
@@ -481,6 +493,7 @@ class TrafficWeightRepo:
 
             await session.delete(traffic_weight)
             await session.commit()
+            await invalidation.publish(invalidation.Topic.MERCHANT, traffic_weight.merchant_id)
             
             team_result = (await session.execute(
                 select(TeamModel.name, TeamModel.credit_factor)
@@ -490,10 +503,12 @@ class TrafficWeightRepo:
             if team_result:
                 team_name, credit_factor = team_result
 
-            locked_balance = (await session.execute(select(UserBalanceChangeNonceModel.locked_balance).filter(
+            locked_balance = (await session.execute(select(
+                UserBalanceChangeNonceModel.locked_balance + striped_balance("locked_balance", traffic_weight.team_id)).filter(
                 UserBalanceChangeNonceModel.balance_id == traffic_weight.team_id))).scalar() or 0
 
-            trust_balance = (await session.execute(select(UserBalanceChangeNonceModel.trust_balance).filter(
+            trust_balance = (await session.execute(select(
+                UserBalanceChangeNonceModel.trust_balance + striped_balance("trust_balance", traffic_weight.team_id)).filter(
                 UserBalanceChangeNonceModel.balance_id == traffic_weight.team_id))).scalar() or 0
                 
             return TrafficWeightScheme(
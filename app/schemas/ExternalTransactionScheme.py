@@ -1,6 +1,8 @@
 from datetime import datetime
 from typing import List, Optional
 
+from pydantic import Field
+
 from app.core.constants import Limit, ReasonName
 from app.schemas.BaseScheme import (
     BaseScheme,
@@ -26,6 +28,7 @@ class ResponseInboundGetTeamBankDetail(BaseScheme):
     team_id: str = str_small_factory()
     bank_detail: BankDetailResponse
     currency_id: str = str_small_factory()
+    amount: int | None = None
 
 
 class ResponseOutboundGetTeamBankDetail(BaseScheme):
@@ -192,6 +195,25 @@ class RequestUpdateFromDevice(BaseScheme):
     device_hash: str | None = str_small_factory()
 
 
+class RequestUpdateFromDeviceBatch(BaseScheme):
+    api_secret: str = str_small_factory()
+    messages: List[Message] = Field(min_length=1, max_length=Limit.MAX_DEVICE_BATCH_MESSAGES)
+    device_hash: str | None = str_small_factory()
+
+
+class ResponseUpdateFromDeviceBatchItem(BaseScheme):
+    status_code: int
+    detail: str | None = None
+    transaction: Response | None = None
+    # id of the queued device event when DEVICE_EVENTS_ASYNC is on
+    event_id: str | None = None
+
+
+class ResponseUpdateFromDeviceBatch(BaseScheme):
+    # one item per request message, in the same order
+    results: List[ResponseUpdateFromDeviceBatchItem]
+
+
 class RequestCheckDeviceToken(BaseScheme):
     api_secret: str = str_small_factory()
 
@@ -85,3 +85,19 @@ class V2SupportResponseScheme(UserSupportScheme):
     view_appeals: bool | None = None
     view_analytics: bool | None = None
     password: Optional[str] = None
+
+
+class RoutingTraceSwitchRequestScheme(BaseScheme):
+    enabled: bool
+
+
+class RoutingTraceResponseScheme(BaseScheme):
+    request_id: str
+    merchant_id: str
+    merchant_transaction_id: Optional[str] = None
+    timestamp: str
+    outcome: str
+    total_ms: float
+    stages_ms: dict[str, float]
+    eliminated: dict[str, int]
+    info: dict
@@ -2,11 +2,41 @@ from datetime import datetime
 
 from app.core.redis import redis_client_ping
 
+# device_hash -> unix time of its last ping
+HEARTBEATS_KEY = "/devices/heartbeats"
+# set once the per-device keys of the old layout have been moved into HEARTBEATS_KEY
+LEGACY_MIGRATED_KEY = "/devices/heartbeats/legacy_migrated"
+
 
 class DevicesService:
     def __init__(self):
         pass
 
     async def ping(self, device_hash: str):
-        await redis_client_ping.set(device_hash, int(datetime.now().timestamp()))
+        await redis_client_ping.zadd(HEARTBEATS_KEY, {device_hash: int(datetime.now().timestamp())})
         return "ok"
+
+    async def get_stale(self, last_allowed_time: datetime) -> list[str]:
+        """Devices whose last ping is older than last_allowed_time"""
+        await self._migrate_legacy_keys()
+        hashes = await redis_client_ping.zrangebyscore(
+            HEARTBEATS_KEY, "-inf", f"({int(last_allowed_time.timestamp())}"
+        )
+        return [h.decode('utf-8') for h in hashes]
+
+    async def forget_stale(self, last_allowed_time: datetime):
+        """Drops the devices get_stale returned, except the ones that pinged again since"""
+        await redis_client_ping.zremrangebyscore(HEARTBEATS_KEY, "-inf", f"({int(last_allowed_time.timestamp())}")
+
+    async def _migrate_legacy_keys(self):
+        # devices used to ping into one string key each
+        if await redis_client_ping.exists(LEGACY_MIGRATED_KEY):
+            return
+        async for key in redis_client_ping.scan_iter(match='*', _type='STRING'):
+            if key.decode('utf-8') == LEGACY_MIGRATED_KEY:
+                continue
+            timestamp = await redis_client_ping.get(key)
+            if timestamp is not None:
+                await redis_client_ping.zadd(HEARTBEATS_KEY, {key: int(timestamp)}, gt=True)
+            await redis_client_ping.delete(key)
+        await redis_client_ping.set(LEGACY_MIGRATED_KEY, 1)
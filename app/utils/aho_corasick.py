@@ -0,0 +1,69 @@
+from typing import Sequence
+
+
+class AhoCorasick:
+    """Finds which of a fixed set of substrings occur in a text in one pass over it.
+
+    Building is O(total pattern length); a search is O(len(text)) whatever the number
+    of patterns. ``first`` returns the lowest index of a pattern found in the text,
+    i.e. the same answer as ``next(i for i, p in enumerate(patterns) if p in text)``.
+    """
+
+    __slots__ = ("_goto", "_fail", "_first")
+
+    def __init__(self, patterns: Sequence[str]):
+        self._goto: list[dict[str, int]] = [{}]
+        # lowest pattern index ending at the node, through fail links included
+        self._first: list[int | None] = [None]
+        for index, pattern in enumerate(patterns):
+            node = 0
+            for ch in pattern:
+                nxt = self._goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[node][ch] = nxt
+                    self._goto.append({})
+                    self._first.append(None)
+                node = nxt
+            if self._first[node] is None:
+                self._first[node] = index
+
+        self._fail = [0] * len(self._goto)
+        queue = list(self._goto[0].values())
+        for node in queue:
+            for ch, child in self._goto[node].items():
+                fail = self._fail[node]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                fail = self._goto[fail].get(ch, 0)
+                self._fail[child] = fail if fail != child else 0
+                self._first[child] = self._min(self._first[child], self._first[self._fail[child]])
+                queue.append(child)
+        # an empty pattern is in every text
+        for node in range(1, len(self._goto)):
+            self._first[node] = self._min(self._first[node], self._first[0])
+
+    @staticmethod
+    def _min(a: int | None, b: int | None) -> int | None:
+        if a is None:
+            return b
+        if b is None:
+            return a
+        return a if a < b else b
+
+    def first(self, text: str) -> int | None:
+        goto = self._goto
+        fail = self._fail
+        found = self._first
+        best = found[0]
+        node = 0
+        for ch in text:
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            index = found[node]
+            if index is not None and (best is None or index < best):
+                best = index
+                if best == 0:
+                    break
+        return best
@@ -0,0 +1,40 @@
+import random
+from typing import Sequence
+
+
+class AliasTable:
+    """Weighted sampling in O(1) per draw (Vose's alias method).
+
+    Building the table is O(n). Items with a non-positive weight are never drawn.
+    """
+
+    __slots__ = ("_items", "_prob", "_alias")
+
+    def __init__(self, weights: Sequence[float]):
+        self._items = [i for i, w in enumerate(weights) if w > 0]
+        if not self._items:
+            raise ValueError("AliasTable needs at least one positive weight")
+        n = len(self._items)
+        total = sum(weights[i] for i in self._items)
+        scaled = [weights[i] * n / total for i in self._items]
+        self._prob = [1.0] * n
+        self._alias = list(range(n))
+
+        small = [i for i, p in enumerate(scaled) if p < 1]
+        large = [i for i, p in enumerate(scaled) if p >= 1]
+        while small and large:
+            s = small.pop()
+            g = large.pop()
+            self._prob[s] = scaled[s]
+            self._alias[s] = g
+            scaled[g] = scaled[g] + scaled[s] - 1
+            (small if scaled[g] < 1 else large).append(g)
+        # whatever is left over is 1 up to float rounding
+
+    def __len__(self) -> int:
+        return len(self._prob)
+
+    def pick(self, rng: random.Random | None = None) -> int:
+        rng = rng or random
+        i = rng.randrange(len(self._prob))
+        return self._items[i if rng.random() < self._prob[i] else self._alias[i]]
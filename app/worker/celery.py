@@ -6,10 +6,10 @@ from datetime import datetime, time, timedelta
 import random
 import uuid
 from celery.utils.log import get_task_logger
-from app.core import config, redis
+from app.core import config
 from app.core.session import async_session, ro_async_session
 from app.core import constants
-from app.core.redis import redis_client_ping
+from app.services import DevicesService
 from app.enums import TransactionFinalStatusEnum
 from app.services.notification_service import send_notification
 from app.schemas.NotificationsSchema import (
@@ -21,6 +21,8 @@ from app.schemas.NotificationsSchema import (
 from app.schemas.LogsSchema import *
 from app.functions.external_transaction import external_transaction_update_
 from app.functions.appeal import accept_appeal_by_system
+from app.functions import device_events, ledger, transaction_timers
+from app.functions.balance import compact_balance_stripes
 from app.utils.time import time_without_pause
 import base64
 
@@ -151,12 +153,6 @@ def setup_periodic_tasks(sender, **kwargs):
         name='remove transfer association from team'
     )
 
-    sender.add_periodic_task(
-        timedelta(seconds=30*60),
-        remove_old_450.s(),
-        name='remove old 450 exceptions'
-    )
-
     sender.add_periodic_task(
         timedelta(seconds=constants.Params.REMOVE_TRANSFER_ASSOCIATION_INTERVAL_S),
         remove_transfer_association.s(),
@@ -187,6 +183,48 @@ def setup_periodic_tasks(sender, **kwargs):
         name='disable details with many close transactions'
     )
 
+    sender.add_periodic_task(
+        timedelta(seconds=constants.Params.TRANSACTION_TIMERS_INTERVAL_S),
+        fire_due_transaction_timers.s(),
+        name='fire due transaction timers'
+    )
+
+    sender.add_periodic_task(
+        timedelta(seconds=constants.Params.TRANSACTION_TIMERS_SWEEP_INTERVAL_S),
+        schedule_missing_transaction_timers.s(),
+        name='schedule missing transaction timers'
+    )
+
+    sender.add_periodic_task(
+        timedelta(seconds=constants.Params.DEVICE_EVENTS_INTERVAL_S),
+        process_device_events.s(),
+        name='process device events'
+    )
+
+    sender.add_periodic_task(
+        timedelta(seconds=constants.Params.BALANCE_COMPACTION_INTERVAL_S),
+        compact_balance_stripes_task.s(),
+        name='compact balance stripes'
+    )
+
+    sender.add_periodic_task(
+        timedelta(seconds=constants.Params.LEDGER_ROLLUP_INTERVAL_S),
+        roll_up_ledger_task.s(),
+        name='roll up balance ledger'
+    )
+
+    sender.add_periodic_task(
+        timedelta(seconds=constants.Params.LEDGER_PARTITIONS_INTERVAL_S),
+        maintain_ledger_partitions_task.s(),
+        name='maintain balance ledger partitions'
+    )
+
+    sender.add_periodic_task(
+        timedelta(seconds=constants.Params.LEDGER_RECONCILE_INTERVAL_S),
+        reconcile_ledger_task.s(),
+        name='reconcile balances with ledger'
+    )
+
 
 @celery_app.task
 def disable_disconnected_devices():
@@ -220,13 +258,6 @@ def remove_transfer_association_from_team():
     result = loop.run_until_complete(_remove_transfer_association_from_team())
     return result
 
-@celery_app.task
-def remove_old_450():
-    loop = asyncio.get_event_loop()
-    result = loop.run_until_complete(_remove_old_450())
-    return result
-
-
 @celery_app.task
 def remove_transfer_association():
     loop = asyncio.get_event_loop()
@@ -262,26 +293,53 @@ def disable_many_close_in_trans_details():
     return result
 
 
-async def _remove_old_450():
-    current_time = int(datetime.utcnow().timestamp())
-    threshold_time = current_time - 86400
-    pattern = "/count/errors/450/*/*/*/*/*"
-    cursor = 0
-    total_deleted = 0
-    total_keys_scanned = 0
-    while True:
-        cursor, keys = await redis.rediss.scan(cursor=cursor, match=pattern, count=500)
-        if keys:
-            pipeline = redis.rediss.pipeline()
-            for key in keys:
-                pipeline.zremrangebyscore(key, 0, threshold_time)
-            results = await pipeline.execute()
-            total_deleted += sum(result or 0 for result in results)
-            total_keys_scanned += len(keys)
-        if cursor == 0:
-            break
-
-    logger.info(f"Redis cleanup finished: {total_deleted} elements removed from {total_keys_scanned} keys.")
+@celery_app.task
+def fire_due_transaction_timers():
+    loop = asyncio.get_event_loop()
+    result = loop.run_until_complete(transaction_timers.fire_due_timers())
+    return result
+
+
+@celery_app.task
+def schedule_missing_transaction_timers():
+    loop = asyncio.get_event_loop()
+    result = loop.run_until_complete(transaction_timers.schedule_pending_inbound())
+    return result
+
+
+@celery_app.task
+def process_device_events():
+    loop = asyncio.get_event_loop()
+    result = loop.run_until_complete(device_events.process_events())
+    return result
+
+
+@celery_app.task
+def compact_balance_stripes_task():
+    loop = asyncio.get_event_loop()
+    result = loop.run_until_complete(compact_balance_stripes())
+    return result
+
+
+@celery_app.task
+def roll_up_ledger_task():
+    loop = asyncio.get_event_loop()
+    result = loop.run_until_complete(ledger.roll_up())
+    return result
+
+
+@celery_app.task
+def maintain_ledger_partitions_task():
+    loop = asyncio.get_event_loop()
+    result = loop.run_until_complete(ledger.maintain_partitions())
+    return result
+
+
+@celery_app.task
+def reconcile_ledger_task():
+    loop = asyncio.get_event_loop()
+    result = loop.run_until_complete(ledger.reconcile())
+    return result
 
 
 def decode_bank_detail_hash(encoded: str) -> str:
@@ -439,20 +497,22 @@ async def _remove_team_from_old_pending_transactions():
             logger.info(f"Unbind {len(ids_to_update_transactions)} external transactions from teams.")
 
         if team_amounts_to_subtract:
-            values_clauses = [f"('{team_id}', {total_amount})" for team_id, total_amount in team_amounts_to_subtract.items() if total_amount > 0]
-            if values_clauses:
-                values_string = ", ".join(values_clauses)
-                update_teams_query_sql = f"""
+            to_subtract = [(team_id, total_amount) for team_id, total_amount in team_amounts_to_subtract.items() if total_amount > 0]
+            if to_subtract:
+                update_teams_query = text("""
                     UPDATE teams t
                     SET today_outbound_amount_used = 
                         CASE
                             WHEN DATE(t.last_transaction_timestamp) < CURRENT_DATE THEN 0
                             ELSE GREATEST(0, t.today_outbound_amount_used - v.amount_to_subtract)
                         END
-                    FROM (VALUES {values_string}) AS v(id, amount_to_subtract)
+                    FROM unnest(CAST(:team_ids AS VARCHAR[]), CAST(:amounts AS BIGINT[])) AS v(id, amount_to_subtract)
                     WHERE t.id = v.id;
-                """
-                await session.execute(text(update_teams_query_sql))
+                """)
+                await session.execute(update_teams_query, {
+                    "team_ids": [team_id for team_id, _ in to_subtract],
+                    "amounts": [total_amount for _, total_amount in to_subtract],
+                })
 
         await session.commit()
 
@@ -498,14 +558,8 @@ async def _disable_disconnected_devices():
     now = datetime.now()
     last_allowed_time = now - timedelta(seconds=constants.Params.DISABLED_DEVICE_PING_DELAY_S)
 
-    devices_hashes_to_disable = []
-
-    async for key in redis_client_ping.scan_iter(match='*'):
-        timestamp = await redis_client_ping.get(key)
-        datetime_obj = datetime.fromtimestamp(int(timestamp))
-
-        if datetime_obj < last_allowed_time:
-            devices_hashes_to_disable.append(key.decode('utf-8'))
+    devices_service = DevicesService()
+    devices_hashes_to_disable = await devices_service.get_stale(last_allowed_time)
 
     async with async_session() as session:
         query = text("""
@@ -529,7 +583,7 @@ async def _disable_disconnected_devices():
         await session.commit()
 
     if len(devices_hashes_to_disable) > 0:
-        await redis_client_ping.delete(*devices_hashes_to_disable)
+        await devices_service.forget_stale(last_allowed_time)
 
     logger.info(f"Disabled {devices_hashes_to_disable} devices")
     logger.info(f"[UpdateDetail] - Disabled ids by reason of bad ping = {ids_to_disable}")
@@ -600,15 +654,15 @@ async def _auto_accept_appeals():
                 or not setting.auto_accept_appeals_pause_time_to
                 or not _is_in_time_interval(utc_time_now.time(), setting.auto_accept_appeals_pause_time_from, setting.auto_accept_appeals_pause_time_to)
             ):
-                appeals_query = text(f"""
+                appeals_query = text("""
                     SELECT appeals.id, appeals.team_processing_start_time
                     FROM appeals
                     JOIN external_transaction_model etm ON etm.id = appeals.transaction_id
                     JOIN merchants ON etm.merchant_id = merchants.id
-                    WHERE appeals.team_processing_start_time IS NOT NULL AND merchants.geo_id = {setting.id}
+                    WHERE appeals.team_processing_start_time IS NOT NULL AND merchants.geo_id = :geo_id
                 """)
 
-                appeals_to_accept = (await session.execute(appeals_query)).all()
+                appeals_to_accept = (await session.execute(appeals_query, {"geo_id": setting.id})).all()
                 logger.info(f"[_auto_accept_appeals]: starting for geo_id = {setting.id}, will check {len(appeals_to_accept)} appeals")
 
                 for appeal in appeals_to_accept:
@@ -675,10 +729,13 @@ async def _auto_close_payouts_worker():
                 conditions.append("(NOW() - t.create_timestamp) >= (:last_seconds || ' seconds')::interval")
                 params['last_seconds'] = str(setting.last_seconds)
             
-            conditions.append(f"merchants.geo_id = {setting.geo_id}")
+            conditions.append("merchants.geo_id = :geo_id")
+            params['geo_id'] = setting.geo_id
             conditions.append("t.team_id IS NULL")
-            conditions.append(f"t.direction = '{constants.Direction.OUTBOUND}'")
-            conditions.append(f"t.status = '{constants.Status.PENDING}'")
+            conditions.append("t.direction = :direction")
+            params['direction'] = constants.Direction.OUTBOUND
+            conditions.append("t.status = :status")
+            params['status'] = constants.Status.PENDING
 
             conditions_string = "\nAND ".join(conditions)
 
@@ -718,7 +775,7 @@ async def _disable_reqs_if_auto_confirmation_not_working():
                 JOIN external_transaction_model t ON bd.id = t.bank_detail_id
                 JOIN teams ON teams.id = bd.team_id
                 JOIN geo_settings gs ON teams.geo_id = gs.id
-                WHERE t.status = '{constants.Status.PENDING}' AND bd.need_check_automation
+                WHERE t.status = :status AND bd.need_check_automation
                 GROUP BY bd.team_id, bd.id, gs.req_after_enable_max_pay_in_count, gs.req_after_enable_max_pay_in_automation_time
                 HAVING COUNT(t.id) >= gs.req_after_enable_max_pay_in_count
                     AND MAX(EXTRACT(EPOCH FROM (CURRENT_TIMESTAMP - t.create_timestamp))) >= gs.req_after_enable_max_pay_in_automation_time
@@ -740,7 +797,7 @@ async def _disable_reqs_if_auto_confirmation_not_working():
             FROM bank_details_to_disable;
         """)
 
-        result = await session.execute(query)
+        result = await session.execute(query, {"status": constants.Status.PENDING})
 
         await session.commit()
 
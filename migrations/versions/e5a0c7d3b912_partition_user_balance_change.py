@@ -0,0 +1,180 @@
+"""partition user_balance_change_model, hourly rollup
+
+Revision ID: e5a0c7d3b912
+Revises: d81e4b6a9f30
+Create Date: 2026-10-18 18:02:33.561904
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e5a0c7d3b912'
+down_revision: Union[str, None] = 'd81e4b6a9f30'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+COLUMNS = """
+    user_id, balance_id, transaction_id,
+    profit_balance, trust_balance, locked_balance,
+    fiat_profit_balance, fiat_trust_balance, fiat_locked_balance
+"""
+
+
+LEGACY = 'user_balance_change_model_legacy'
+INDEXED_COLUMNS = ('id', 'user_id', 'balance_id', 'transaction_id')
+
+
+def upgrade() -> None:
+    # The existing table is attached as the partition of everything before `cutoff`
+    # instead of being copied. `cutoff` is two months ahead so rows written while this
+    # runs still fit; later months get partitions of their own. Everything that reads
+    # the whole table (the constraint, the indexes) runs without blocking ledger writes,
+    # only the swap at the end takes an exclusive lock and it touches no rows.
+    connection = op.get_bind()
+    cutoff = connection.execute(sa.text(
+        "SELECT date_trunc('month', LOCALTIMESTAMP) + interval '2 months'"
+    )).scalar()
+
+    with op.get_context().autocommit_block():
+        # a partition key can not be null, these rows stay out of every stats range
+        op.execute("""
+            UPDATE user_balance_change_model
+            SET create_timestamp = '1970-01-01'
+            WHERE create_timestamp IS NULL
+        """)
+        op.execute(f"""
+            ALTER TABLE user_balance_change_model
+            ADD CONSTRAINT {LEGACY}_bound
+            CHECK (create_timestamp IS NOT NULL AND create_timestamp < '{cutoff}') NOT VALID
+        """)
+        op.execute(f"ALTER TABLE user_balance_change_model VALIDATE CONSTRAINT {LEGACY}_bound")
+        op.execute(f"""
+            CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS {LEGACY}_pkey
+            ON user_balance_change_model (id_pk, create_timestamp)
+        """)
+        op.execute(f"""
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS {LEGACY}_create_timestamp_brin
+            ON user_balance_change_model USING brin (create_timestamp)
+        """)
+
+    op.execute("LOCK TABLE user_balance_change_model IN ACCESS EXCLUSIVE MODE")
+    op.execute("CREATE SEQUENCE user_balance_change_ledger_id_seq AS BIGINT")
+    op.execute("""
+        SELECT setval('user_balance_change_ledger_id_seq',
+                      coalesce((SELECT max(id_pk) FROM user_balance_change_model), 0) + 1, false)
+    """)
+    # the bound constraint proves NOT NULL, no scan; partitions can not have identity columns
+    op.execute("ALTER TABLE user_balance_change_model ALTER COLUMN create_timestamp SET NOT NULL")
+    op.execute("ALTER TABLE user_balance_change_model ALTER COLUMN id_pk DROP IDENTITY IF EXISTS")
+    op.execute("ALTER TABLE user_balance_change_model DROP CONSTRAINT IF EXISTS user_balance_change_model_id_pk_key")
+    op.execute("ALTER TABLE user_balance_change_model DROP CONSTRAINT user_balance_change_model_pkey")
+    op.execute(f"ALTER TABLE user_balance_change_model ADD CONSTRAINT {LEGACY}_pkey PRIMARY KEY USING INDEX {LEGACY}_pkey")
+    op.execute(f"ALTER TABLE user_balance_change_model RENAME TO {LEGACY}")
+    for column in INDEXED_COLUMNS:
+        op.execute(f"ALTER INDEX IF EXISTS ix_user_balance_change_model_{column} RENAME TO {LEGACY}_{column}_idx")
+
+    op.execute("""
+        CREATE TABLE user_balance_change_model (
+            id_pk BIGINT NOT NULL DEFAULT nextval('user_balance_change_ledger_id_seq'),
+            id BIGINT NOT NULL DEFAULT txid_current(),
+            user_id VARCHAR NOT NULL,
+            balance_id VARCHAR,
+            transaction_id VARCHAR,
+            profit_balance BIGINT NOT NULL,
+            trust_balance BIGINT NOT NULL,
+            locked_balance BIGINT NOT NULL,
+            fiat_profit_balance BIGINT,
+            fiat_trust_balance BIGINT,
+            fiat_locked_balance BIGINT,
+            create_timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (id_pk, create_timestamp)
+        ) PARTITION BY RANGE (create_timestamp)
+    """)
+    op.execute("ALTER SEQUENCE user_balance_change_ledger_id_seq OWNED BY user_balance_change_model.id_pk")
+    # created while the table has no partitions; attaching reuses the legacy indexes
+    for column in INDEXED_COLUMNS:
+        op.create_index(op.f(f'ix_user_balance_change_model_{column}'), 'user_balance_change_model', [column], unique=False)
+    op.execute(f"ALTER TABLE user_balance_change_model ATTACH PARTITION {LEGACY} FOR VALUES FROM (MINVALUE) TO ('{cutoff}')")
+    # monthly partitions from the cutoff on, same naming as app.functions.ledger.maintain_partitions
+    op.execute(f"""
+        DO $$
+        DECLARE
+            month timestamp := '{cutoff}';
+        BEGIN
+            WHILE month < date_trunc('month', LOCALTIMESTAMP) + interval '4 months' LOOP
+                EXECUTE format(
+                    'CREATE TABLE %I PARTITION OF user_balance_change_model FOR VALUES FROM (%L) TO (%L)',
+                    'user_balance_change_model_' || to_char(month, 'YYYY_MM'), month, month + interval '1 month'
+                );
+                month := month + interval '1 month';
+            END LOOP;
+        END $$;
+    """)
+    op.execute("CREATE TABLE user_balance_change_model_default PARTITION OF user_balance_change_model DEFAULT")
+
+    op.create_table('user_balance_change_rollup',
+    sa.Column('balance_id', sa.String(), nullable=False),
+    sa.Column('direction', sa.String(length=64), nullable=False),
+    sa.Column('bucket', sa.TIMESTAMP(), nullable=False),
+    sa.Column('profit_balance', sa.BigInteger(), nullable=False),
+    sa.Column('trust_balance', sa.BigInteger(), nullable=False),
+    sa.Column('locked_balance', sa.BigInteger(), nullable=False),
+    sa.Column('fiat_profit_balance', sa.BigInteger(), nullable=False),
+    sa.Column('fiat_trust_balance', sa.BigInteger(), nullable=False),
+    sa.Column('fiat_locked_balance', sa.BigInteger(), nullable=False),
+    sa.Column('changes', sa.BigInteger(), nullable=False),
+    sa.PrimaryKeyConstraint('balance_id', 'direction', 'bucket')
+    )
+    op.create_table('ledger_watermark',
+    sa.Column('name', sa.String(length=64), nullable=False),
+    sa.Column('value', sa.BigInteger(), nullable=False),
+    sa.PrimaryKeyConstraint('name')
+    )
+    # starts from zero, the first app.functions.ledger.roll_up run folds in the history
+    op.execute("INSERT INTO ledger_watermark (name, value) VALUES ('rollup', 0)")
+
+
+def downgrade() -> None:
+    # copies the ledger back into one table: ledger writes wait for the whole copy
+    op.drop_table('ledger_watermark')
+    op.drop_table('user_balance_change_rollup')
+
+    op.execute("ALTER TABLE user_balance_change_model RENAME TO user_balance_change_model_partitioned")
+    op.execute("ALTER INDEX IF EXISTS user_balance_change_model_pkey RENAME TO user_balance_change_model_partitioned_pkey")
+    for column in ('id', 'user_id', 'balance_id', 'transaction_id'):
+        op.execute(f"ALTER INDEX IF EXISTS ix_user_balance_change_model_{column} "
+                   f"RENAME TO ix_user_balance_change_model_partitioned_{column}")
+    op.execute("""
+        CREATE TABLE user_balance_change_model (
+            id_pk BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+            id BIGINT NOT NULL DEFAULT txid_current(),
+            user_id VARCHAR NOT NULL,
+            balance_id VARCHAR,
+            transaction_id VARCHAR,
+            profit_balance BIGINT NOT NULL,
+            trust_balance BIGINT NOT NULL,
+            locked_balance BIGINT NOT NULL,
+            fiat_profit_balance BIGINT,
+            fiat_trust_balance BIGINT,
+            fiat_locked_balance BIGINT,
+            create_timestamp TIMESTAMP WITHOUT TIME ZONE DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    op.execute(f"""
+        INSERT INTO user_balance_change_model (id_pk, id, {COLUMNS}, create_timestamp)
+        SELECT id_pk, id, {COLUMNS}, create_timestamp
+        FROM user_balance_change_model_partitioned
+    """)
+    op.execute("""
+        SELECT setval(pg_get_serial_sequence('user_balance_change_model', 'id_pk'),
+                      coalesce((SELECT max(id_pk) FROM user_balance_change_model), 0) + 1, false)
+    """)
+    op.execute("DROP TABLE user_balance_change_model_partitioned")
+    op.create_index(op.f('ix_user_balance_change_model_id'), 'user_balance_change_model', ['id'], unique=False)
+    op.create_index(op.f('ix_user_balance_change_model_user_id'), 'user_balance_change_model', ['user_id'], unique=False)
+    op.create_index(op.f('ix_user_balance_change_model_balance_id'), 'user_balance_change_model', ['balance_id'], unique=False)
+    op.create_index(op.f('ix_user_balance_change_model_transaction_id'), 'user_balance_change_model', ['transaction_id'], unique=False)
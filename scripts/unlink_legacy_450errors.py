@@ -0,0 +1,12 @@
+import asyncio
+import os
+import sys
+
+here = os.path.dirname(__file__)
+sys.path.append(os.path.join(here, '..'))
+
+from app.functions.analytics import unlink_legacy_450errors
+
+# run once after deploying the bucketed 450 counters: nothing reads or trims
+# the old /count/errors/450/ keys any more
+print(asyncio.run(unlink_legacy_450errors()))
@@ -0,0 +1,94 @@
+"""Contention benchmark: one nonce row per balance vs striped balance accumulators.
+
+Simulates concurrent transactions of a single merchant: each one writes its
+balance change through add_balance_changes, holds the database transaction for
+HOLD_MS like the rest of a pay-in would and commits. Prints the throughput at
+each concurrency level with BALANCE_STRIPES = 1 (the old hot row) and with the
+configured number of stripes, then checks that get_balances still adds up.
+Writes to a fresh balance_id and deletes its rows afterwards. Needs the same
+env as the API (Postgres), run from the repo root:
+
+    python -m tests.bench_balance_contention
+"""
+import asyncio
+import statistics
+import time
+import uuid
+
+from sqlalchemy import delete
+
+from app.core.constants import Params
+from app.core.session import async_session
+from app.functions.balance import add_balance_changes, compact_balance_stripes, get_balances
+from app.models import UserBalanceChangeModel, UserBalanceChangeNonceModel, UserBalanceStripeModel
+
+REQUESTS = 1000
+CONCURRENCY = [1, 2, 4, 8, 16, 32, 64]
+HOLD_MS = 5
+
+
+async def _one(balance_id: str):
+    async with async_session() as session:
+        await add_balance_changes(session, [{
+            "user_id": balance_id,
+            "balance_id": balance_id,
+            "transaction_id": str(uuid.uuid4()),
+            "trust_balance": 1,
+        }])
+        await asyncio.sleep(HOLD_MS / 1000)
+        await session.commit()
+
+
+async def run(stripes: int, concurrency: int, balance_id: str) -> float:
+    Params.BALANCE_STRIPES = stripes
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one():
+        async with semaphore:
+            start = time.perf_counter()
+            await _one(balance_id)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[one() for _ in range(REQUESTS)])
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    print(
+        f"stripes = {stripes:<3} concurrency = {concurrency:<4} rps = {REQUESTS / elapsed:8.1f}, "
+        f"p50 = {statistics.median(latencies) * 1000:7.1f} ms, "
+        f"p99 = {latencies[int(len(latencies) * 0.99) - 1] * 1000:7.1f} ms"
+    )
+    return REQUESTS / elapsed
+
+
+async def _cleanup(balance_id: str):
+    async with async_session() as session:
+        for model in (UserBalanceChangeModel, UserBalanceChangeNonceModel, UserBalanceStripeModel):
+            await session.execute(delete(model).where(model.balance_id == balance_id))
+        await session.commit()
+
+
+async def main():
+    striped = Params.BALANCE_STRIPES
+    balance_id = f"bench-{uuid.uuid4()}"
+    try:
+        for stripes in (1, striped):
+            for concurrency in CONCURRENCY:
+                await run(stripes, concurrency, balance_id)
+            print()
+        async with async_session() as session:
+            before = (await get_balances(balance_id, session, balance_id=balance_id))[0]
+        await compact_balance_stripes()
+        async with async_session() as session:
+            after = (await get_balances(balance_id, session, balance_id=balance_id))[0]
+        expected = 2 * REQUESTS * len(CONCURRENCY)
+        print(f"trust_balance = {before} before compaction, {after} after, expected {expected}")
+        assert before == after == expected
+    finally:
+        Params.BALANCE_STRIPES = striped
+        await _cleanup(balance_id)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
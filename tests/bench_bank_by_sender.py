@@ -0,0 +1,82 @@
+"""Per-message cost of get_bank_by_sender against the number of banks.
+
+Compares the sender index (one Aho-Corasick pass over the sender) with the
+previous loop that lowercased and tested every package name of every bank, on
+the real bank list and on lists padded with synthetic banks. The index time
+should stay flat as the bank count grows. Needs no database, run from the repo
+root:
+
+    python -m tests.bench_bank_by_sender
+"""
+import random
+import time
+
+from app.core.constants import Bank, Banks
+from app.functions import device
+from app.utils.aho_corasick import AhoCorasick
+
+MESSAGES = 20000
+BANK_COUNTS = [0, 100, 1000]
+SENDERS = [
+    "com.google.android.apps.messaging",
+    "ru.sberbankmobile",
+    "900",
+    "ru.vtb24.mobilebanking.android",
+    "ru.alfabank.oavdo.amc",
+    "com.idamob.tinkoff.android",
+    "ru.yoo.money",
+    "ru.ozon.fintech.finance",
+    "unknown.sender.app",
+]
+
+
+def _banks(extra: int) -> list[Bank]:
+    banks = [bank for bank in vars(Banks).values() if isinstance(bank, Bank)]
+    return banks + [
+        Bank(name=f"synthetic-{i}", currency="RUB", package_names=[f"com.synthetic{i}.bank", f"synth{i}"])
+        for i in range(extra)
+    ]
+
+
+def _loop(banks: list[Bank], check_bank: str) -> str | None:
+    for bank in banks:
+        if any(package in check_bank for package in [p.lower() for p in bank.package_names]):
+            return bank.name
+    return None
+
+
+def _index(banks: list[Bank]):
+    packages = [(package.lower(), bank.name) for bank in banks for package in bank.package_names]
+    index = AhoCorasick([package for package, _ in packages])
+    names = [name for _, name in packages]
+
+    def lookup(check_bank: str) -> str | None:
+        i = index.first(check_bank)
+        return names[i] if i is not None else None
+
+    return lookup
+
+
+def _us_per_message(lookup, senders: list[str]) -> float:
+    start = time.perf_counter()
+    for sender in senders:
+        lookup(sender)
+    return (time.perf_counter() - start) / len(senders) * 1e6
+
+
+def main():
+    senders = [random.choice(SENDERS) for _ in range(MESSAGES)]
+    for extra in BANK_COUNTS:
+        banks = _banks(extra)
+        lookup = _index(banks)
+        assert all(lookup(s) == _loop(banks, s) for s in SENDERS)
+        print(
+            f"banks = {len(banks):5}, "
+            f"loop = {_us_per_message(lambda s: _loop(banks, s), senders):8.2f} us, "
+            f"index = {_us_per_message(lookup, senders):6.2f} us"
+        )
+    print(f"get_bank_by_sender = {_us_per_message(lambda s: device.get_bank_by_sender(s, '', s), senders):6.2f} us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""Throughput benchmark for parse_message over the golden SMS corpus.
+
+Parses every message of tests/data/device_messages.jsonl ROUNDS times and
+prints messages/second overall plus mean and p99 latency per bank and per
+currency. Each message is also checked against its recorded output, so a
+faster parser that changes a result fails here before it is timed. With
+``--json`` the report is printed as one JSON object, to diff two runs. Needs no
+database, run from the repo root:
+
+    python -m tests.bench_device_parser [--rounds 20] [--json]
+"""
+import argparse
+import json
+import statistics
+import time
+from collections import defaultdict
+
+from app import exceptions
+from app.functions.device import parse_message
+from tests.test_device_parser import load_corpus, parse
+
+
+def _time_one(entry) -> float:
+    start = time.perf_counter()
+    try:
+        parse_message(entry["sms"], entry["header"], entry["bank"])
+    except exceptions.BlockedCardException:
+        pass
+    return time.perf_counter() - start
+
+
+def _stats(latencies: list[float]) -> dict:
+    latencies = sorted(latencies)
+    return {
+        "messages": len(latencies),
+        "mean_us": round(statistics.mean(latencies) * 1e6, 2),
+        "p99_us": round(latencies[max(int(len(latencies) * 0.99) - 1, 0)] * 1e6, 2),
+    }
+
+
+def run(rounds: int) -> dict:
+    corpus = load_corpus()
+    mismatches = [entry for entry in corpus if parse(entry) != entry["expected"]]
+    if mismatches:
+        raise AssertionError(f"{len(mismatches)} messages differ from the corpus, first: {mismatches[0]}")
+
+    by_bank = defaultdict(list)
+    by_currency = defaultdict(list)
+    total = 0.0
+    for _ in range(rounds):
+        for entry in corpus:
+            elapsed = _time_one(entry)
+            total += elapsed
+            by_bank[entry["bank"] or "-"].append(elapsed)
+            by_currency[entry["currency"]].append(elapsed)
+
+    return {
+        "messages": len(corpus) * rounds,
+        "messages_per_s": round(len(corpus) * rounds / total, 1),
+        "currencies": {currency: _stats(v) for currency, v in sorted(by_currency.items())},
+        "banks": {bank: _stats(v) for bank, v in sorted(by_bank.items())},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+
+    report = run(args.rounds)
+    if args.json:
+        print(json.dumps(report))
+        return
+    print(f"messages = {report['messages']}, messages/s = {report['messages_per_s']}")
+    for title, key in (("currency", "currencies"), ("bank", "banks")):
+        print(f"\n{title:<16} {'messages':>9} {'mean us':>9} {'p99 us':>9}")
+        for name, s in report[key].items():
+            print(f"{name:<16} {s['messages']:>9} {s['mean_us']:>9} {s['p99_us']:>9}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""Contention benchmark: global per-amount advisory lock vs (bank_detail_id, amount) reservations.
+
+Simulates concurrent pay-ins where most requests share a handful of round amounts
+and hold the routing transaction for HOLD_MS. Needs the same env as the API
+(Postgres and Redis), run from the repo root:
+
+    python -m tests.bench_inbound_reservations
+"""
+import asyncio
+import random
+import statistics
+import time
+import uuid
+
+from sqlalchemy import text
+
+from app.core.redis import rediss
+from app.core.session import async_session
+from app.functions import reservation
+
+REQUESTS = 2000
+CONCURRENCY = 100
+BANK_DETAILS = 200
+AMOUNTS = [1000, 2000, 3000, 5000, 10000]
+HOLD_MS = 5
+
+
+async def _advisory_lock(amount: int, bank_details: list[str]):
+    async with async_session() as session:
+        await session.execute(text("SELECT pg_advisory_xact_lock(:lock_key)"), {"lock_key": amount})
+        await session.execute(text("SELECT pg_sleep(:s)"), {"s": HOLD_MS / 1000})
+        await session.commit()
+    return True
+
+
+async def _reservation(amount: int, bank_details: list[str]):
+    async with async_session() as session, reservation.released_on_exit(session):
+        for bank_detail_id in random.sample(bank_details, 5):
+            if await reservation.reserve(session, bank_detail_id, amount):
+                await session.execute(text("SELECT pg_sleep(:s)"), {"s": HOLD_MS / 1000})
+                await session.commit()
+                return True
+    return False
+
+
+async def run(name, func):
+    bank_details = [str(uuid.uuid4()) for _ in range(BANK_DETAILS)]
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+    latencies = []
+    misses = 0
+
+    async def one():
+        nonlocal misses
+        async with semaphore:
+            start = time.perf_counter()
+            if not await func(random.choice(AMOUNTS), bank_details):
+                misses += 1
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[one() for _ in range(REQUESTS)])
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    print(
+        f"{name:<14} rps = {REQUESTS / elapsed:8.1f}, "
+        f"p50 = {statistics.median(latencies) * 1000:7.1f} ms, "
+        f"p99 = {latencies[int(len(latencies) * 0.99) - 1] * 1000:7.1f} ms, "
+        f"misses = {misses}"
+    )
+
+
+async def main():
+    await run("advisory_lock", _advisory_lock)
+    await run("reservation", _reservation)
+    await rediss.aclose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,288 @@
+"""Replay benchmark for the pay-in routing path.
+
+Every scenario seeds its own synthetic topology (a merchant, teams, bank details,
+contracts and VIP payers) into the local database and replays a stream of
+H2HCreateInbound requests through ``h2h_create_inbound`` at a fixed
+concurrency. For each scenario it prints throughput, p50/p99 latency, the 450
+(AllTeamsDisabled) rate, other errors and lock waits sampled from
+pg_stat_activity, so a routing change can be compared against a baseline run.
+
+The stream is generated from the scenario unless ``--stream`` points at a JSONL
+file of recorded H2HCreateInbound bodies (merchant_id is replaced by the seeded
+merchant). Seeded rows are left in place, each run gets fresh names.
+
+Needs a migrated local database with at least one geo (with geo_settings),
+namespace and currency, plus Redis, using the same env as the API. Run from the
+repo root:
+
+    python -m tests.bench_routing_replay [scenario ...] [--stream requests.jsonl]
+"""
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import time
+import uuid
+from dataclasses import dataclass, field
+
+from sqlalchemy import text
+from starlette.requests import Request
+
+import app.exceptions as exceptions
+from app.core.constants import DECIMALS, Role, Type
+from app.core.redis import rediss
+from app.core.security import generate_password, get_password_hash
+from app.core.session import async_session
+from app.functions.balance import add_balance_changes
+from app.functions.external_transaction import h2h_create_inbound
+from app.models import (
+    BankDetailModel,
+    MerchantModel,
+    TeamModel,
+    TrafficWeightContractModel,
+    VipPayerModel,
+)
+from app.schemas.v2.ExternalTransactionScheme import H2HCreateInbound
+
+LOCK_SAMPLE_INTERVAL_S = 0.05
+
+
+@dataclass
+class Scenario:
+    name: str
+    teams: int = 20
+    details_per_team: int = 5
+    vip_detail_share: float = 0.0
+    vip_payers: int = 0
+    vip_request_share: float = 0.0
+    banks: list[str] = field(default_factory=lambda: ["sber", "tinkoff", "alfabank"])
+    amounts: list[int] = field(default_factory=lambda: [1000, 2000, 3000, 5000, 10000])
+    left_eps: int = 0
+    right_eps: int = 0
+    requests: int = 1000
+    concurrency: int = 50
+
+
+SCENARIOS = {
+    "baseline": Scenario("baseline"),
+    "hot_amounts": Scenario("hot_amounts", amounts=[1000, 5000], concurrency=200, requests=2000),
+    "complements": Scenario("complements", amounts=[1000, 5000], left_eps=-5, right_eps=5, concurrency=200,
+                            requests=2000),
+    "vip": Scenario("vip", vip_detail_share=0.3, vip_payers=200, vip_request_share=0.3),
+    "sparse": Scenario("sparse", teams=3, details_per_team=2, requests=500),
+    "wide": Scenario("wide", teams=200, details_per_team=10, requests=3000, concurrency=100),
+}
+
+
+@dataclass
+class Topology:
+    merchant_id: str
+    vip_payer_ids: list[str]
+
+
+async def _reference_ids(session) -> tuple[int, int, str]:
+    geo_id = (await session.execute(text("SELECT id FROM geo_settings ORDER BY id LIMIT 1"))).scalar()
+    namespace_id = (await session.execute(text("SELECT id FROM namespaces ORDER BY id LIMIT 1"))).scalar()
+    currency_id = (await session.execute(text("SELECT id FROM currency_model ORDER BY id LIMIT 1"))).scalar()
+    if geo_id is None or namespace_id is None or currency_id is None:
+        raise RuntimeError("the database needs a geo with geo_settings, a namespace and a currency")
+    return geo_id, namespace_id, currency_id
+
+
+async def seed(scenario: Scenario) -> Topology:
+    run_id = uuid.uuid4().hex[:8]
+    async with async_session() as session:
+        geo_id, namespace_id, currency_id = await _reference_ids(session)
+
+        merchant = MerchantModel(
+            password_hash=get_password_hash(generate_password()),
+            name=f"bench-{scenario.name}-{run_id}-merchant",
+            role=Role.MERCHANT,
+            is_blocked=False,
+            namespace_id=namespace_id,
+            api_secret=generate_password(),
+            is_inbound_enabled=True,
+            is_outbound_enabled=False,
+            currency_id=currency_id,
+            geo_id=geo_id,
+            left_eps_change_amount_allowed=scenario.left_eps,
+            right_eps_change_amount_allowed=scenario.right_eps,
+        )
+        session.add(merchant)
+        await session.flush()
+        merchant.balance_id = merchant.id
+        users = [merchant]
+
+        vip_profiles = []
+        for t in range(scenario.teams):
+            team = TeamModel(
+                password_hash=get_password_hash(generate_password()),
+                name=f"bench-{scenario.name}-{run_id}-team-{t}",
+                role=Role.TEAM,
+                is_blocked=False,
+                namespace_id=namespace_id,
+                api_secret=generate_password(),
+                is_inbound_enabled=True,
+                is_outbound_enabled=False,
+                geo_id=geo_id,
+            )
+            session.add(team)
+            await session.flush()
+            team.balance_id = team.id
+            users.append(team)
+
+            session.add(TrafficWeightContractModel(
+                is_deleted=False,
+                merchant_id=merchant.id,
+                team_id=team.id,
+                currency_id=currency_id,
+                type=Type.CARD,
+                comment="bench",
+                inbound_traffic_weight=random.randint(1, 100),
+                outbound_traffic_weight=0,
+            ))
+            for d in range(scenario.details_per_team):
+                is_vip = random.random() < scenario.vip_detail_share
+                profile_id = str(uuid.uuid4()) if is_vip else None
+                if is_vip:
+                    vip_profiles.append(profile_id)
+                session.add(BankDetailModel(
+                    team_id=team.id,
+                    name=f"bench {t}-{d}",
+                    bank=random.choice(scenario.banks),
+                    type=Type.CARD,
+                    number=f"{random.randint(10 ** 15, 10 ** 16 - 1)}",
+                    profile_id=profile_id,
+                    is_active=True,
+                    is_auto_active=True,
+                    is_deleted=False,
+                    is_vip=is_vip,
+                    max_vip_payers=10 if is_vip else 0,
+                ))
+
+        vip_payer_ids = [f"bench-vip-{run_id}-{i}" for i in range(scenario.vip_payers)]
+        for payer_id in vip_payer_ids:
+            if vip_profiles and random.random() < 0.5:
+                session.add(VipPayerModel(payer_id=payer_id, bank_detail_id=random.choice(vip_profiles)))
+
+        await add_balance_changes(session, [{"user_id": u.id, "balance_id": u.balance_id} for u in users])
+        await session.commit()
+        return Topology(merchant_id=merchant.id, vip_payer_ids=vip_payer_ids)
+
+
+def generate_stream(scenario: Scenario, topology: Topology) -> list[H2HCreateInbound]:
+    stream = []
+    for _ in range(scenario.requests):
+        is_vip = bool(topology.vip_payer_ids) and random.random() < scenario.vip_request_share
+        stream.append(H2HCreateInbound(
+            amount=random.choice(scenario.amounts) * DECIMALS,
+            type=Type.CARD,
+            bank=random.choice(scenario.banks + [None]),
+            is_vip=is_vip,
+            merchant_id=topology.merchant_id,
+            merchant_payer_id=random.choice(topology.vip_payer_ids) if is_vip else str(uuid.uuid4()),
+            merchant_transaction_id=str(uuid.uuid4()),
+        ))
+    return stream
+
+
+def load_stream(path: str, topology: Topology) -> list[H2HCreateInbound]:
+    stream = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            body = json.loads(line)
+            body["merchant_id"] = topology.merchant_id
+            body["merchant_transaction_id"] = str(uuid.uuid4())
+            stream.append(H2HCreateInbound(**body))
+    return stream
+
+
+def _request() -> Request:
+    return Request({
+        "type": "http",
+        "scheme": "http",
+        "server": ("bench", 80),
+        "path": "/",
+        "root_path": "",
+        "query_string": b"",
+        "headers": [],
+    })
+
+
+async def _sample_lock_waits(samples: list[int], stop: asyncio.Event):
+    async with async_session() as session:
+        while not stop.is_set():
+            waiting = (await session.execute(
+                text(
+                    "SELECT count(*) FROM pg_stat_activity "
+                    "WHERE wait_event_type = 'Lock' AND datname = current_database()"
+                )
+            )).scalar()
+            await session.rollback()
+            samples.append(waiting)
+            try:
+                await asyncio.wait_for(stop.wait(), LOCK_SAMPLE_INTERVAL_S)
+            except asyncio.TimeoutError:
+                pass
+
+
+async def replay(scenario: Scenario, stream: list[H2HCreateInbound]) -> dict:
+    semaphore = asyncio.Semaphore(scenario.concurrency)
+    latencies = []
+    errors_450 = 0
+    errors = {}
+
+    async def one(request: H2HCreateInbound):
+        nonlocal errors_450
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await h2h_create_inbound(request, _request())
+            except exceptions.AllTeamsDisabledException:
+                errors_450 += 1
+            except Exception as e:
+                errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+            latencies.append(time.perf_counter() - start)
+
+    lock_samples = []
+    stop = asyncio.Event()
+    sampler = asyncio.ensure_future(_sample_lock_waits(lock_samples, stop))
+    start = time.perf_counter()
+    await asyncio.gather(*[one(request) for request in stream])
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await sampler
+
+    latencies.sort()
+    return {
+        "scenario": scenario.name,
+        "requests": len(stream),
+        "rps": round(len(stream) / elapsed, 1),
+        "p50_ms": round(statistics.median(latencies) * 1000, 1),
+        "p99_ms": round(latencies[max(int(len(latencies) * 0.99) - 1, 0)] * 1000, 1),
+        "rate_450": round(errors_450 / len(stream), 4),
+        "lock_waits_mean": round(statistics.mean(lock_samples), 2) if lock_samples else 0,
+        "lock_waits_max": max(lock_samples, default=0),
+        "errors": errors,
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("scenarios", nargs="*", default=list(SCENARIOS))
+    parser.add_argument("--stream", help="JSONL file with recorded H2HCreateInbound bodies")
+    args = parser.parse_args()
+
+    for name in args.scenarios:
+        scenario = SCENARIOS[name]
+        topology = await seed(scenario)
+        stream = load_stream(args.stream, topology) if args.stream else generate_stream(scenario, topology)
+        print(json.dumps(await replay(scenario, stream)))
+    await rediss.aclose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,118 @@
+"""Planning time of the inbound routing query: inlined literals vs a reused prepared statement.
+
+Runs the routing statement from ``_inbound_routing_query`` for a real merchant
+under EXPLAIN (ANALYZE) in three modes and prints the mean planning and
+execution time per pay-in:
+
+    literal   - every value inlined, a new statement per pay-in (the old f-string SQL)
+    prepared  - one PREPAREd statement, default plan_cache_mode
+    generic   - one PREPAREd statement, plan_cache_mode = force_generic_plan
+
+Needs the same env as the API, run from the repo root:
+
+    python -m tests.bench_routing_sql_planning <merchant_id> [iterations]
+"""
+import asyncio
+import json
+import random
+import re
+import statistics
+import sys
+import uuid
+
+import asyncpg
+
+from app.core.config import settings
+from app.core.constants import DECIMALS
+from app.functions.external_transaction import _inbound_routing_query
+
+_PARAM = re.compile(r"(?<!:):(\w+)")
+
+
+def _literal(value) -> str:
+    if isinstance(value, list):
+        return "ARRAY[" + ", ".join(_literal(v) for v in value) + "]"
+    if isinstance(value, str):
+        return "'" + value.replace("'", "''") + "'"
+    return str(value)
+
+
+def _inline(sql: str, params: dict) -> str:
+    return _PARAM.sub(lambda m: _literal(params[m.group(1)]), sql)
+
+
+def _positional(sql: str) -> tuple[str, list[str]]:
+    names = []
+
+    def replace(m):
+        if m.group(1) not in names:
+            names.append(m.group(1))
+        return f"${names.index(m.group(1)) + 1}"
+
+    return _PARAM.sub(replace, sql), names
+
+
+async def _explain(conn, sql: str) -> tuple[float, float]:
+    plan = json.loads(await conn.fetchval(f"EXPLAIN (ANALYZE, FORMAT JSON) {sql}"))[0]
+    return plan["Planning Time"], plan["Execution Time"]
+
+
+def _payins(merchant_id: str, candidate_ids: list[str], iterations: int):
+    for _ in range(iterations):
+        amount = random.choice([1000, 2000, 3000, 5000, 10000]) * DECIMALS
+        yield _inbound_routing_query(
+            merchant_id=merchant_id,
+            payer_id=str(uuid.uuid4()),
+            amounts=[amount + i * DECIMALS for i in range(-3, 4)],
+            candidate_ids=candidate_ids,
+            is_vip=False,
+            is_whitelist=False,
+            type="card",
+        )
+
+
+async def run(merchant_id: str, iterations: int):
+    conn = await asyncpg.connect(settings.database_uri.replace("postgresql+asyncpg", "postgresql"))
+    candidate_ids = [r["id"] for r in await conn.fetch(
+        """
+        SELECT BD.id
+        FROM bank_detail_model BD
+        JOIN traffic_weight_contact_model TWC ON TWC.team_id = BD.team_id
+        WHERE TWC.merchant_id = $1 AND BD.is_deleted = FALSE
+        """,
+        merchant_id,
+    )]
+    payins = list(_payins(merchant_id, candidate_ids, iterations))
+
+    results = {}
+    timings = [await _explain(conn, _inline(query.text, params)) for query, params in payins]
+    results["literal"] = timings
+
+    for mode in ("prepared", "generic"):
+        await conn.execute("DEALLOCATE ALL")
+        if mode == "generic":
+            await conn.execute("SET plan_cache_mode = force_generic_plan")
+        query, params = payins[0]
+        sql, names = _positional(query.text)
+        await conn.execute(f"PREPARE routing AS {sql}")
+        timings = []
+        for _, params in payins:
+            args = ", ".join(_literal(params[name]) for name in names)
+            timings.append(await _explain(conn, f"EXECUTE routing({args})"))
+        results[mode] = timings
+        await conn.execute("RESET plan_cache_mode")
+
+    await conn.close()
+
+    baseline = statistics.mean(p for p, _ in results["literal"])
+    for mode, timings in results.items():
+        planning = statistics.mean(p for p, _ in timings)
+        execution = statistics.mean(e for _, e in timings)
+        print(
+            f"{mode:<9} planning = {planning:7.3f} ms, execution = {execution:7.3f} ms, "
+            f"planning saved per pay-in = {baseline - planning:7.3f} ms"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(run(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 200))
@@ -0,0 +1,37 @@
+import random
+
+import pytest
+
+from app.utils.alias import AliasTable
+
+
+def test_alias_table_frequencies_follow_weights():
+    weights = [1, 10, 30, 0, 59]
+    table = AliasTable(weights)
+    rng = random.Random(42)
+    draws = 100000
+    counts = [0] * len(weights)
+    for _ in range(draws):
+        counts[table.pick(rng)] += 1
+    total = sum(weights)
+    for i, w in enumerate(weights):
+        assert counts[i] / draws == pytest.approx(w / total, abs=0.01)
+
+
+def test_alias_table_never_picks_zero_weight():
+    table = AliasTable([0, 3, 0, 1, 0])
+    rng = random.Random(7)
+    assert len(table) == 2
+    assert {table.pick(rng) for _ in range(10000)} == {1, 3}
+
+
+def test_alias_table_single_entry():
+    table = AliasTable([5])
+    rng = random.Random(0)
+    assert len(table) == 1
+    assert all(table.pick(rng) == 0 for _ in range(1000))
+
+
+def test_alias_table_needs_positive_weight():
+    with pytest.raises(ValueError):
+        AliasTable([0, 0])
@@ -0,0 +1,112 @@
+import asyncio
+
+import pytest
+
+from app.functions import balance, balance_snapshot
+
+
+class _Redis:
+    """the snapshot keys in a dict, the scripts as their Lua does them"""
+
+    def __init__(self):
+        self.data = {}
+
+    async def hgetall(self, key):
+        return dict(self.data.get(key, {}))
+
+    async def get(self, key):
+        return self.data.get(key)
+
+    async def invalidate(self, keys, args):
+        self.data.pop(keys[0], None)
+        self.data[keys[1]] = str(int(self.data.get(keys[1], "0")) + 1)
+        return int(self.data[keys[1]])
+
+    async def store(self, keys, args):
+        version = self.data.get(keys[1], "0")
+        if version != args[0]:
+            return 0
+        fields = args[2:]
+        self.data[keys[0]] = {"version": version, **dict(zip(fields[::2], fields[1::2]))}
+        return 1
+
+
+class _Session:
+    def __init__(self):
+        self.info = {}
+
+
+@pytest.fixture
+def ledger(monkeypatch):
+    redis = _Redis()
+    monkeypatch.setattr(balance_snapshot, "rediss", redis)
+    monkeypatch.setattr(balance_snapshot, "_INVALIDATE_SCRIPT", redis.invalidate)
+    monkeypatch.setattr(balance_snapshot, "_STORE_SCRIPT", redis.store)
+
+    class Ledger:
+        balances = [100, 0, 0, 0, 0, 0]
+        on_load = None
+
+        async def commit(self, trust: int):
+            """a committed change, its invalidation not run yet"""
+            self.balances = [self.balances[0] + trust, *self.balances[1:]]
+            session = _Session()
+            balance_snapshot.record(session, "b")
+            balance_snapshot._after_commit(session)
+
+        async def invalidations(self):
+            await asyncio.gather(*balance_snapshot._pending)
+
+        async def read(self):
+            return await balance.get_balance_snapshot("u", session=None, balance_id="b")
+
+    ledger = Ledger()
+
+    async def get_balances(user_id, session, balance_id=None, **kwargs):
+        loaded = list(ledger.balances)
+        if ledger.on_load is not None:
+            on_load, ledger.on_load = ledger.on_load, None
+            await on_load()
+        return tuple(loaded)
+
+    monkeypatch.setattr(balance, "get_balances", get_balances)
+    return ledger
+
+
+def test_store_before_invalidate_is_not_counted_twice(ledger):
+    async def run():
+        await ledger.commit(10)
+        # loads and stores the committed balance before the invalidation runs
+        assert (await ledger.read())[0] == 110
+        await ledger.invalidations()
+        assert (await ledger.read())[0] == 110
+        assert (await ledger.read())[0] == 110
+
+    asyncio.run(run())
+
+
+def test_commit_during_load_is_not_stored(ledger):
+    async def run():
+        async def commit():
+            await ledger.commit(10)
+            await ledger.invalidations()
+
+        ledger.on_load = commit
+        # loaded 100 before the commit, the version moved before the store
+        assert (await ledger.read())[0] == 100
+        assert (await ledger.read())[0] == 110
+
+    asyncio.run(run())
+
+
+def test_snapshot_follows_commits(ledger):
+    async def run():
+        assert (await ledger.read())[0] == 100
+        await ledger.commit(5)
+        await ledger.invalidations()
+        assert (await ledger.read())[0] == 105
+        await ledger.commit(-20)
+        await ledger.invalidations()
+        assert (await ledger.read())[0] == 85
+
+    asyncio.run(run())
@@ -0,0 +1,214 @@
+import asyncio
+import calendar
+import random
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+import app.schemas.ExternalTransactionScheme as ETs
+from app.core.constants import Direction, Limit, Status, Type
+from app.functions import external_transaction
+from app.functions.external_transaction import _device_candidates, _is_device_message_repeated
+
+NOW = datetime(2026, 1, 1, 12)
+WINDOW = timedelta(seconds=Limit.MESSAGE_BACK_TIME_S)
+
+Transaction = namedtuple(
+    "Transaction",
+    "id team_id direction amount status create_timestamp has_merchant transaction_auto_close_time_s",
+)
+# what the batch's candidate query returns, merchants outer joined
+Row = namedtuple("Row", "id team_id amount status create_timestamp transaction_auto_close_time_s")
+# the full row of the batch's candidate query
+CandidateRow = namedtuple(
+    "CandidateRow",
+    "id team_id bank_detail_number device_hash bank type amount status create_timestamp "
+    "transaction_auto_close_time_s comment",
+)
+Message = namedtuple("Message", "text_hash create_timestamp")
+
+
+def epoch(dt: datetime) -> int:
+    return calendar.timegm(dt.timetuple())
+
+
+def random_time(rng) -> datetime:
+    # whole minutes, so that the window bounds are hit exactly now and then
+    return NOW + timedelta(minutes=rng.randint(-150, 30))
+
+
+def random_request(rng) -> ETs.RequestUpdateFromDeviceDB:
+    timestamp = None if rng.random() < 0.4 else epoch(random_time(rng))
+    return ETs.RequestUpdateFromDeviceDB(message="m", api_secret="s", bank="sber", timestamp=timestamp)
+
+
+def reference_candidates(request, amount, team_id, transactions):
+    """the candidate query of _external_transaction_update_from_device, row by row"""
+    ids = []
+    for t in transactions:
+        if t.team_id != team_id or t.direction != Direction.INBOUND or t.amount != amount:
+            continue
+        if request.timestamp is None:
+            if t.status != Status.PENDING:
+                continue
+        else:
+            timestamp = datetime.utcfromtimestamp(request.timestamp)
+            if not t.has_merchant or t.status not in (Status.PENDING, Status.CLOSE):
+                continue
+            # make_interval of NULL is NULL, the comparison drops the row
+            if t.transaction_auto_close_time_s is None:
+                continue
+            if not t.create_timestamp + timedelta(seconds=t.transaction_auto_close_time_s) > timestamp:
+                continue
+            if not t.create_timestamp <= timestamp:
+                continue
+        ids.append(t.id)
+    return sorted(ids)
+
+
+def batch_candidates(request, amount, team_id, amounts, transactions, accepted):
+    """the batch's single candidate query, then _device_candidates over the rows of the amount"""
+    rows = [
+        Row(t.id, t.team_id, t.amount, t.status, t.create_timestamp,
+            t.transaction_auto_close_time_s if t.has_merchant else None)
+        for t in transactions
+        if t.status in (Status.PENDING, Status.CLOSE)
+        and t.team_id == team_id
+        and t.direction == Direction.INBOUND
+        and t.amount in amounts
+    ]
+    return sorted(row.id for row in _device_candidates(request, [row for row in rows if row.amount == amount], accepted))
+
+
+def test_candidates_parity_random():
+    rng = random.Random(16)
+    for _ in range(3000):
+        transactions = [
+            Transaction(
+                id=f"t{i}",
+                team_id=rng.choice(["team-1", "team-2"]),
+                direction=rng.choice([Direction.INBOUND, Direction.INBOUND, Direction.OUTBOUND]),
+                amount=rng.choice([100, 200, 300]),
+                status=rng.choice([Status.PENDING, Status.PENDING, Status.CLOSE, Status.ACCEPT]),
+                create_timestamp=random_time(rng),
+                has_merchant=rng.random() < 0.9,
+                transaction_auto_close_time_s=rng.choice([None, 60, 30 * 60, 2 * 60 * 60]),
+            )
+            for i in range(rng.randint(0, 8))
+        ]
+        # transactions accepted by earlier messages of the batch, the database has them as accepted by now
+        accepted = {t.id for t in transactions if t.status == Status.PENDING and rng.random() < 0.2}
+        after = [t._replace(status=Status.ACCEPT) if t.id in accepted else t for t in transactions]
+        requests = [(random_request(rng), rng.choice([100, 200, 300])) for _ in range(rng.randint(1, 3))]
+        amounts = {amount for _, amount in requests}
+        for request, amount in requests:
+            assert (
+                batch_candidates(request, amount, "team-1", amounts, transactions, accepted)
+                == reference_candidates(request, amount, "team-1", after)
+            )
+
+
+def reference_repeated(request, text_hash, messages):
+    """_is_message_repeated, row by row"""
+    if request.timestamp is None:
+        since = NOW - WINDOW
+    else:
+        since = datetime.utcfromtimestamp(request.timestamp) - WINDOW
+    return any(m.text_hash == text_hash and m.create_timestamp > since for m in messages)
+
+
+def batch_seen(requests, text_hashes, messages):
+    """the batch's query for earlier copies of its texts"""
+    since = NOW - WINDOW
+    timestamps = [datetime.utcfromtimestamp(r.timestamp) for r in requests if r.timestamp is not None]
+    if timestamps:
+        since = min(since, min(timestamps) - WINDOW)
+    return [
+        (m.text_hash, m.create_timestamp, m.create_timestamp > NOW - WINDOW)
+        for m in messages
+        if m.text_hash in set(text_hashes) and m.create_timestamp > since
+    ]
+
+
+def test_repeated_parity_random():
+    rng = random.Random(61)
+    for _ in range(3000):
+        messages = [Message(rng.choice("abcd"), random_time(rng)) for _ in range(rng.randint(0, 6))]
+        requests = [random_request(rng) for _ in range(rng.randint(1, 4))]
+        text_hashes = [rng.choice("abc") for _ in requests]
+        seen = batch_seen(requests, text_hashes, messages)
+        for request, text_hash in zip(requests, text_hashes):
+            assert _is_device_message_repeated(request, text_hash, seen) == reference_repeated(
+                request, text_hash, messages
+            )
+
+
+class _Result:
+    def __init__(self, rows):
+        self._rows = rows
+
+    def all(self):
+        return self._rows
+
+
+class _Session:
+    def __init__(self, rows):
+        self.rows = rows
+        self.rollbacks = 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def execute(self, statement, *args, **kwargs):
+        # the repeat query selects three columns, the candidate query more
+        return _Result([] if len(statement.selected_columns) == 3 else self.rows)
+
+    async def rollback(self):
+        self.rollbacks += 1
+
+
+def test_batch_fails_only_the_message_that_raised(monkeypatch):
+    rows = [
+        CandidateRow(f"t{amount}", "team-1", "2200000000001234", "device-1", "sber", Type.CARD, amount,
+                     Status.PENDING, NOW, 60, None)
+        for amount in (100, 200, 300)
+    ]
+    session = _Session(rows)
+
+    async def claim(text_hashes):
+        return [True] * len(text_hashes)
+
+    async def release(text_hashes):
+        pass
+
+    async def parse(request, header, request_id):
+        return int(request.message), None, None
+
+    async def get_team(api_secret, session):
+        return ("team-1",)
+
+    async def accept(session, request, request_id, text_hash, team_id, amount, bank_detail_digits, new_amount,
+                     t_id, t_bank_detail):
+        if amount == 200:
+            raise RuntimeError("connection lost")
+        return ETs.Response.model_construct(id=t_id)
+
+    monkeypatch.setattr(external_transaction, "_claim_device_messages", claim)
+    monkeypatch.setattr(external_transaction, "_release_device_messages", release)
+    monkeypatch.setattr(external_transaction, "_parse_device_message", parse)
+    monkeypatch.setattr(external_transaction, "_normalize_device_request", lambda request: request.bank)
+    monkeypatch.setattr(external_transaction.team_resolution, "get_team_by_api_secret", get_team)
+    monkeypatch.setattr(external_transaction, "_accept_from_device", accept)
+    monkeypatch.setattr(external_transaction, "async_session", lambda: session)
+
+    requests = [
+        ETs.RequestUpdateFromDeviceDB(message=str(amount), api_secret="s", bank="sber", device_hash="device-1")
+        for amount in (100, 200, 300)
+    ]
+    response = asyncio.run(external_transaction.external_transaction_update_from_device_batch(requests))
+    assert [item.status_code for item in response.results] == [200, 500, 200]
+    assert [item.transaction.id for item in response.results if item.transaction] == ["t100", "t300"]
+    assert session.rollbacks == 1
+
@@ -0,0 +1,41 @@
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from app.api.routes import external_transaction
+from app.core import config
+
+
+@pytest.fixture
+def client(monkeypatch):
+    async def enqueue(request):
+        return "1-0"
+
+    async def enqueue_batch(requests):
+        return [f"{i}-0" for i in range(len(requests))]
+
+    monkeypatch.setattr(config.settings, "DEVICE_EVENTS_ASYNC", True)
+    monkeypatch.setattr(external_transaction.device_events, "enqueue", enqueue)
+    monkeypatch.setattr(external_transaction.device_events, "enqueue_batch", enqueue_batch)
+    app = FastAPI()
+    app.include_router(external_transaction.router)
+    return TestClient(app)
+
+
+def test_accept_from_device_queued(client):
+    response = client.put("/accept-from-device", json={
+        "api_secret": "s", "device_hash": "d", "message": {"title": "sber", "extra_text": "t"},
+    })
+    assert response.status_code == 202
+    assert response.json() == {"detail": "queued", "event_id": "1-0"}
+
+
+def test_accept_from_device_batch_queued(client):
+    response = client.put("/accept-from-device/batch", json={
+        "api_secret": "s", "device_hash": "d",
+        "messages": [{"title": "sber", "extra_text": "t"}, {"title": "sber", "extra_text": "u"}],
+    })
+    assert response.status_code == 200
+    assert [(item["status_code"], item["detail"], item["event_id"]) for item in response.json()["results"]] == [
+        (202, "queued", "0-0"), (202, "queued", "1-0"),
+    ]
@@ -0,0 +1,116 @@
+import random
+from collections import namedtuple
+
+import pytest
+from fastapi import HTTPException
+
+import app.schemas.ExternalTransactionScheme as ETs
+from app import exceptions
+from app.core.constants import Type
+from app.functions.external_transaction import _choose_device_transaction, _filter_by_detail_comment
+
+Row = namedtuple("Row", "id team_id bank_detail_number device_hash bank type comment")
+
+BANKS = [None, "sber", "alfabank", "alfabusiness", "tinkoff"]
+DEVICES = [None, "device-1", "device-2"]
+DIGITS = [None, "", "1234", "5678"]
+
+
+def reference(request, bank_detail_digits, rows):
+    """matching as it was done with two queries and the inline scoring"""
+    transaction_list = rows
+    initial_count = len(transaction_list)
+    if bank_detail_digits:
+        transaction_list = [row for row in rows if row.comment == bank_detail_digits]
+        if len(transaction_list) == 0 and initial_count > 0:
+            raise exceptions.ExternalTransactionDetailCommentException(comment=bank_detail_digits)
+    candidates = []
+    for t_id, t_team_id, t_bank_detail, device_hash, bank, d_type, _ in transaction_list:
+        score = 0
+        if request.device_hash is not None and device_hash == request.device_hash:
+            score -= 8
+        if request.device_hash is not None and device_hash != request.device_hash:
+            score += 32
+        if request.bank != bank:
+            score += 32
+        if bank != request.bank:
+            score += 1
+        if (
+                bank_detail_digits is not None
+                and len(t_bank_detail) > 4
+                and bank_detail_digits in t_bank_detail[-4:]
+        ):
+            score -= 16
+        if d_type == Type.PHONE:
+            score -= 8
+        candidates.append((score, t_id, t_team_id, bank, t_bank_detail))
+    candidates.sort(key=lambda x: x[0])
+    if len(candidates) == 0:
+        raise exceptions.ExternalTransactionNoCandidatesForAmount()
+    if len(candidates) >= 2 and candidates[0][0] == candidates[1][0]:
+        raise exceptions.ExternalTransactionAmountCollisionException()
+    if bank_detail_digits is not None and candidates[0][0] > -16 and request.bank != 'alfabusiness':
+        raise exceptions.ExternalTransactionCardCollisionException()
+    if candidates[0][0] > -8:
+        raise exceptions.ExternalTransactionCardCollisionException()
+    t_id, t_team_id, tr_bank, t_bank_detail = candidates[0][1], candidates[0][2], candidates[0][3], candidates[0][4]
+    if request.bank == "alfabank" and tr_bank != "alfabank":
+        raise exceptions.ExternalTransactionNoCandidatesForAmount()
+    return t_id, t_team_id, tr_bank, t_bank_detail
+
+
+def outcome(f, *args):
+    try:
+        return f(*args)
+    except HTTPException as e:
+        return type(e), e.status_code
+
+
+def choose(request, bank_detail_digits, rows):
+    return _choose_device_transaction(request, bank_detail_digits, _filter_by_detail_comment(rows, bank_detail_digits))
+
+
+def random_row(rng, i):
+    digits = rng.choice(["1234", "5678", "0000"])
+    return Row(
+        id=f"t{i}",
+        team_id=rng.choice(["team-1", "team-2"]),
+        bank_detail_number=rng.choice([f"22000000{digits}{digits}", digits, f"+7999{digits}"]),
+        device_hash=rng.choice(DEVICES),
+        bank=rng.choice(BANKS),
+        type=rng.choice([Type.CARD, Type.PHONE]),
+        comment=rng.choice([None, digits, "1234"]),
+    )
+
+
+def test_matching_parity_random():
+    rng = random.Random(17)
+    for _ in range(20000):
+        request = ETs.RequestUpdateFromDeviceDB(
+            message="m", api_secret="s", bank=rng.choice(BANKS), device_hash=rng.choice(DEVICES)
+        )
+        digits = rng.choice(DIGITS)
+        rows = [random_row(rng, i) for i in range(rng.randint(0, 4))]
+        assert outcome(choose, request, digits, rows) == outcome(reference, request, digits, rows)
+
+
+@pytest.mark.parametrize("bank, digits, rows, expected", [
+    ("sber", None, [], exceptions.ExternalTransactionNoCandidatesForAmount),
+    ("sber", "1234", [Row("t1", "team", "2200000000005678", "device-1", "sber", Type.CARD, "5678")],
+     exceptions.ExternalTransactionDetailCommentException),
+    ("sber", None, [Row("t1", "team", "2200000000001234", "device-1", "sber", Type.CARD, None),
+                    Row("t2", "team", "2200000000005678", "device-1", "sber", Type.CARD, None)],
+     exceptions.ExternalTransactionAmountCollisionException),
+    ("sber", "1234", [Row("t1", "team", "2200000000001234", "device-1", "sber", Type.CARD, "1234")],
+     ("t1", "team", "sber", "2200000000001234")),
+    ("alfabank", None, [Row("t1", "team", "2200000000001234", "device-1", "sber", Type.PHONE, None)],
+     exceptions.ExternalTransactionCardCollisionException),
+])
+def test_matching_cases(bank, digits, rows, expected):
+    request = ETs.RequestUpdateFromDeviceDB(message="m", api_secret="s", bank=bank, device_hash="device-1")
+    result = outcome(choose, request, digits, rows)
+    assert result == outcome(reference, request, digits, rows)
+    if isinstance(expected, type):
+        assert result[0] is expected
+    else:
+        assert result == expected
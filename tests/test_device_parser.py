@@ -0,0 +1,81 @@
+import json
+from pathlib import Path
+
+import pytest
+
+from app import exceptions
+from app.core.constants import Bank, Banks
+from app.functions.device import GENERIC_PARSER, get_bank_by_sender, get_parser, parse_message
+
+CORPUS = Path(__file__).parent / "data" / "device_messages.jsonl"
+
+
+def load_corpus():
+    with open(CORPUS, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def parse(entry):
+    try:
+        return list(parse_message(entry["sms"], entry["header"], entry["bank"]))
+    except exceptions.BlockedCardException:
+        return "blocked"
+
+
+def test_corpus_covers_currencies():
+    currencies = {entry["currency"] for entry in load_corpus()}
+    assert {"RUB", "TJS", "KZT", "UZS", "AZN", "KGS", "INR"} <= currencies
+
+
+def test_golden_corpus():
+    # expected values were recorded from the parser before it was compiled,
+    # every change to parse_message has to keep them byte for byte
+    mismatches = [
+        (entry, parse(entry))
+        for entry in load_corpus()
+        if parse(entry) != entry["expected"]
+    ]
+    assert not mismatches, mismatches[:5]
+
+
+@pytest.mark.parametrize("sms, header, expected", [
+    ("Karta *8944. 04.10.24 20:29. Postuplenie 1008.00 RUB. Tinkoff Card2Card. Balans 8937.00 RUB", "Уралсиб",
+     (1008000000, "8944", None)),
+    ("Rs.1,500.00 credited to your account XX1234 via UPI", "HDFC", (1500000000, None, None)),
+    ("Zachislenie\nSumma 50.00 TJS\nKomis 0.00 TJS\nZachislenie 50.00 TJS\nKarta 9762000163153504\nBalans 2 098.21 TJS",
+     "Eskh.Online", (50000000, "3504", 50000000)),
+])
+def test_parse_message(sms, header, expected):
+    assert parse_message(sms, header) == expected
+
+
+def test_registered_parsers_are_attached_to_banks():
+    for bank in vars(Banks).values():
+        if isinstance(bank, Bank) and bank.parser is not None:
+            assert get_parser(bank.name) is bank.parser
+    assert Banks.SBER.parser is not None
+    assert get_parser(None) is GENERIC_PARSER
+    assert get_parser("unknown-bank") is GENERIC_PARSER
+
+
+@pytest.mark.parametrize("sender, package_name", [
+    ("900", None),
+    ("900", "com.google.android.apps.messaging"),
+    ("VTB", None),
+    ("x", "ru.sberbankmobile"),
+    ("x", "ru.alfabank.oavdo.amc"),
+    ("x", "ru.yoo.money"),
+    ("x", "unknown.sender.app"),
+])
+def test_get_bank_by_sender_matches_first_bank(sender, package_name):
+    check_bank = (package_name or sender).lower()
+    if "messag" in check_bank:
+        check_bank = sender.lower()
+    expected = next(
+        (
+            bank.name for bank in vars(Banks).values()
+            if isinstance(bank, Bank) and any(p.lower() in check_bank for p in bank.package_names)
+        ),
+        None,
+    )
+    assert get_bank_by_sender(sender, "", package_name) == expected
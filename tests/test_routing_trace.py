@@ -0,0 +1,113 @@
+import asyncio
+
+import pytest
+from sqlalchemy.exc import IntegrityError
+
+import app.schemas.v2.ExternalTransactionScheme as v2_ETs
+from app import exceptions
+from app.core.constants import DECIMALS
+from app.functions import external_transaction, routing_trace
+
+
+class _Result:
+    def __init__(self, row):
+        self._row = row
+
+    def first(self):
+        return self._row
+
+
+class _Session:
+    """merchant with fiat limits 100..200, every request below is out of range"""
+
+    def __init__(self):
+        self.info = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def execute(self, *args, **kwargs):
+        return _Result((0, 0, False, 100, 200))
+
+
+@pytest.fixture
+def inbound(monkeypatch):
+    saved = []
+
+    async def add_450error(*args, **kwargs):
+        pass
+
+    async def save(self, outcome, merchant_transaction_id=None):
+        saved.append((self, outcome, merchant_transaction_id))
+
+    monkeypatch.setattr(external_transaction, "async_session", _Session)
+    monkeypatch.setattr(external_transaction, "add_450error", add_450error)
+    monkeypatch.setattr(routing_trace.RoutingTrace, "save", save)
+
+    def create(enabled: bool):
+        async def start(request_id, merchant_id):
+            if not enabled:
+                return routing_trace.NOOP
+            return routing_trace.RoutingTrace(request_id, merchant_id, enabled=True)
+
+        monkeypatch.setattr(routing_trace, "start", start)
+        request = v2_ETs.H2HCreateInbound(
+            amount=10 * DECIMALS,
+            merchant_id="merchant",
+            merchant_payer_id="payer",
+            merchant_transaction_id="mt-1",
+        )
+        with pytest.raises(exceptions.AllTeamsDisabledException):
+            asyncio.run(external_transaction.h2h_create_inbound(request, req=None))
+        return saved
+
+    return create
+
+
+def test_h2h_create_inbound_traced(inbound):
+    saved = inbound(enabled=True)
+    assert len(saved) == 1
+    trace, outcome, merchant_transaction_id = saved[0]
+    assert outcome == "AllTeamsDisabledException"
+    assert merchant_transaction_id == "mt-1"
+    assert "merchant_settings" in trace.stages
+
+
+def test_h2h_create_inbound_untraced(inbound):
+    saved = inbound(enabled=False)
+    assert len(saved) == 1
+    trace, outcome, _ = saved[0]
+    assert trace is routing_trace.NOOP
+    assert outcome == "AllTeamsDisabledException"
+    assert trace.stages == {}
+
+
+def test_h2h_create_inbound_routes_again_when_pair_taken(monkeypatch):
+    requests = []
+
+    async def create(request, req, id, request_id, trace):
+        requests.append(request)
+        if len(requests) == 1:
+            raise IntegrityError("INSERT", {}, Exception(
+                'duplicate key value violates unique constraint "pending_amount_reservation_pkey"'
+            ))
+        return "created"
+
+    async def start(request_id, merchant_id):
+        return routing_trace.NOOP
+
+    monkeypatch.setattr(external_transaction, "_h2h_create_inbound", create)
+    monkeypatch.setattr(routing_trace, "start", start)
+    request = v2_ETs.H2HCreateInbound(
+        amount=150 * DECIMALS,
+        merchant_id="merchant",
+        merchant_payer_id="payer",
+        merchant_transaction_id="mt-2",
+    )
+    assert asyncio.run(external_transaction.h2h_create_inbound(request, req=None)) == "created"
+    assert len(requests) == 2
+    assert requests[0] is not requests[1]
+    assert requests[1].amount == 150 * DECIMALS